@@ -1,25 +1,32 @@
 from fastapi import FastAPI, File, UploadFile, BackgroundTasks, Query, Form, Request, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.base import BaseHTTPMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 import os
 import shutil
+import tempfile
 import subprocess
 import psycopg2
 import asyncio
 import time
 import threading
-import requests
 import io
-import sys
+import json
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
 from file_manager import PHOTOS_DIR, VIDEOS_DIR, DATA_DIR, BASE_DIR, UPLOADS_DIR, create_directories
 from email_service import send_email_smtp
 from smtp_standalone import send_smtp_standalone
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from browser_pool import start_pool, stop_pool, get_pool, get_pool_size, run_script_en_pool, redirigir_salida_del_hilo
+from finnegans_resultado import empresas_con_error, leer_resultado
+from finnegans_timeouts import timeout_job
+from job_scheduler import get_planificador
+from job_store import get_job_store, abrir_log_en_vivo, get_log_en_vivo, cerrar_log_en_vivo, iniciar_latido, detener_latido
+from webhooks import encolar_webhook, iniciar_entregador, detener_entregador
 
 # Cargar variables de entorno
 load_dotenv()
@@ -91,6 +98,8 @@ app.mount("/data", StaticFiles(directory=str(DATA_DIR)), name="data")
 # Directorio para archivos subidos - usar base dinámico
 UPLOAD_DIR = UPLOADS_DIR  # Ya viene del file_manager
 SCRIPTS_DIR = BASE_DIR / "scripts"
+# Resultados estructurados de los jobs en subproceso (fuera de /data, que se sirve por HTTP)
+RESULTADOS_DIR = Path(tempfile.gettempdir()) / "finnegans_resultados"
 
 @app.get("/",
     summary="Estado del servidor",
@@ -2254,56 +2263,170 @@ async def test_timeout(delay_minutes: float):
 # ============= ENDPOINT ASÍNCRONO PARA FINNEGANS LOGIN =============
 
 class FinnegansRequest(BaseModel):
-    company: str
+    company: Optional[str] = None
+    companies: Optional[List[str]] = None  # Varias empresas en orden, con un único login
     webhook_url: Optional[str] = None
     script: Optional[str] = "finnegans_login.py"  # Script a ejecutar: finnegans_login.py o finnegans_mail.py
+    refresh_cache: Optional[bool] = False  # Ignorar la caché local de reportes de Finnegans
 
 class FinnegansJobResponse(BaseModel):
     job_id: str
     status: str
     message: str
     company: str
+    companies: List[str] = []
     webhook_url: Optional[str]
+    coalesced: bool = False  # Pedido idéntico a uno que ya esperaba en la cola: se devuelve ese job
+    queue_position: Optional[int] = None
+
+# Los jobs y sus logs se guardan en PostgreSQL o SQLite (job_store.py)
+def guardar_logs_job(job_id: str, log_capture: "LogCapture") -> None:
+    """Cierra el log en vivo del script y persiste los logs de la API del job en finnegans_job_logs"""
+    cerrar_log_en_vivo(job_id)
+    store = get_job_store()
+    store.agregar_logs(job_id, [log['message'] for log in log_capture.get_logs()], 'api')
+    store.cerrar_logs(job_id)
+
+def get_planificador_jobs():
+    """Cola de jobs de Finnegans (job_scheduler.py) que ejecuta run_finnegans_process"""
+    return get_planificador(run_finnegans_process, get_pool_size())
+
+def resumir_resultado(resultado: Optional[dict]) -> tuple:
+    """
+    (resumen, empresas, pasos) del job a partir del resultado estructurado que
+    escriben los scripts (finnegans_resultado). El total del job es la suma de
+    las empresas; `pasos` es el p50/p95 por paso de la última empresa.
+    """
+    empresas = (resultado or {}).get('empresas') or {}
+    resumen = {
+        clave: sum(e.get(clave, 0) for e in empresas.values())
+        for clave in ('total_remitos', 'exitosos', 'fallidos', 'no_procesados')
+    }
+    pasos = next((e['pasos'] for e in reversed(list(empresas.values())) if e.get('pasos')), {})
+    return resumen, empresas, pasos
+
+def payload_webhook(job_id: str, job: dict, log_completo: Optional[str] = None, logs: Optional[list] = None) -> dict:
+    """
+    Cuerpo del webhook de fin de job. Por defecto es compacto: estado, resumen,
+    totales y fallidos por empresa, y las URLs para leer el log y el detalle.
+    Con FINNEGANS_WEBHOOK_PAYLOAD=completo va además el detalle por empresa,
+    los pasos y los logs, como antes.
+    """
+    load_dotenv()
+    base = os.getenv('FINNEGANS_PUBLIC_URL', '').rstrip('/')
+    payload = {
+        'job_id': job_id,
+        'status': job.get('status'),
+        'company': job.get('company'),
+        'companies': job.get('companies'),
+        'script': job.get('script'),
+        'queued_at': job.get('queued_at'),
+        'started_at': job.get('started_at'),
+        'finished_at': job.get('finished_at'),
+        'duration_seconds': job.get('duration_seconds'),
+        'success': job.get('success', False),
+        'resumen': job.get('resumen'),
+        'empresas': {
+            empresa: {
+                clave: datos.get(clave)
+                for clave in ('total_remitos', 'exitosos', 'fallidos', 'no_procesados', 'fallidos_lista', 'error')
+                if datos.get(clave) is not None
+            }
+            for empresa, datos in (job.get('empresas') or {}).items()
+        },
+        'error': job.get('error'),
+        'status_url': f"{base}/finnegans/status/{job_id}?logs=false",
+        'logs_url': f"{base}/finnegans/logs/{job_id}",
+    }
+    if os.getenv('FINNEGANS_WEBHOOK_PAYLOAD', 'compacto').strip().lower() == 'completo':
+        payload.update({
+            'empresas': job.get('empresas'),
+            'pasos': job.get('pasos'),
+            'logs': logs or [],
+            'log_completo': log_completo,
+        })
+    return payload
+
+def notificar_webhook(job_id: str, webhook_url: str, payload: dict) -> None:
+    """Encola la notificación del job (webhooks.py la entrega con reintentos)"""
+    # Antes de encolar: el primer intento puede terminar antes de que vuelva encolar_webhook
+    get_job_store().actualizar(job_id, webhook_estado='pendiente')
+    if encolar_webhook(webhook_url, payload, origen='finnegans', referencia=job_id):
+        print(f"[{job_id}] Webhook encolado para {webhook_url} (status {payload.get('status')})")
+    else:
+        get_job_store().actualizar(job_id, webhook_estado='fallido', webhook_error='No se pudo encolar el webhook')
+
+def registrar_intento_webhook_job(entrega: dict, intento: dict) -> None:
+    """Guarda en el job cada intento de entrega de su webhook (los últimos 20)"""
+    job = get_job_store().obtener(entrega['referencia'])
+    if job is None:
+        return
+    intentos = (job.get('webhook_intentos') or []) + [intento]
+    campos = {
+        'webhook_intentos': intentos[-20:],
+        'webhook_estado': intento['estado'],
+        'webhook_notified': intento['estado'] == 'entregado',
+    }
+    if intento['error']:
+        campos['webhook_error'] = intento['error']
+    get_job_store().actualizar(entrega['referencia'], **campos)
+
+def ejecutar_script_en_vivo(cmd: List[str], env: dict, timeout: int, log) -> int:
+    """
+    Ejecuta el script leyendo su salida línea por línea hacia el log en vivo
+    del job. Retorna el código de salida; si excede `timeout` segundos mata el
+    proceso y lanza subprocess.TimeoutExpired.
+    """
+    env = {**env, 'PYTHONUNBUFFERED': '1'}
+    proceso = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+        env=env,
+    )
 
-# Almacenamiento en memoria de trabajos (en producción usar Redis)
-jobs_storage = {}
+    def leer():
+        for linea in proceso.stdout:
+            log.escribir(linea)
+
+    lector = threading.Thread(target=leer, name="job-log", daemon=True)
+    lector.start()
+    try:
+        returncode = proceso.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proceso.kill()
+        proceso.wait()
+        raise
+    finally:
+        lector.join(timeout=10)
+    return returncode
 
 class LogCapture:
-    """Clase para capturar logs de stdout/stderr"""
+    """
+    Captura lo que imprime el hilo del job. No cambia sys.stdout: la salida de
+    cada hilo se reparte por browser_pool.redirigir_salida_del_hilo, así los
+    jobs que corren a la vez no se mezclan.
+    """
     def __init__(self):
         self.logs = []
-        self.original_stdout = None
-        self.original_stderr = None
 
     def start(self):
-        """Inicia la captura de logs"""
-        self.original_stdout = sys.stdout
-        self.original_stderr = sys.stderr
-        sys.stdout = self
-        sys.stderr = self
+        """Inicia la captura de logs del hilo actual"""
+        redirigir_salida_del_hilo(self.write)
 
     def stop(self):
-        """Detiene la captura de logs"""
-        if self.original_stdout:
-            sys.stdout = self.original_stdout
-        if self.original_stderr:
-            sys.stderr = self.original_stderr
+        """Detiene la captura de logs del hilo actual"""
+        redirigir_salida_del_hilo(None)
 
     def write(self, text):
-        """Captura el texto escrito"""
+        """Captura el texto escrito (la salida original la escribe igual la consola)"""
         if text and text.strip():
             self.logs.append({
                 'timestamp': datetime.now().isoformat(),
                 'message': text.strip()
             })
-        # También escribir al stdout original para mantener logs en consola
-        if self.original_stdout:
-            self.original_stdout.write(text)
-
-    def flush(self):
-        """Método requerido para compatibilidad con stdout"""
-        if self.original_stdout:
-            self.original_stdout.flush()
 
     def get_logs(self):
         """Obtiene todos los logs capturados"""
@@ -2313,40 +2436,78 @@ class LogCapture:
         """Obtiene los logs como texto plano"""
         return '\n'.join([log['message'] for log in self.logs])
 
-def run_finnegans_process(job_id: str, company: str, webhook_url: Optional[str] = None, script: str = "finnegans_login.py"):
-    """Ejecuta el proceso de facturación en background y notifica vía webhook"""
+def run_finnegans_process(job_id: str, companies: List[str], webhook_url: Optional[str] = None, script: str = "finnegans_login.py", refresh_cache: bool = False, encolado_at: Optional[datetime] = None):
+    """
+    Ejecuta el proceso de facturación en background y notifica vía webhook.
+    Las empresas se procesan en orden en una misma sesión del navegador.
+    Lo lanza el planificador de jobs (job_scheduler.py) cuando hay lugar.
+    """
 
     # Capturar logs
     log_capture = LogCapture()
     log_capture.start()
 
     inicio = datetime.now()
-
+    company = ', '.join(companies)
+    # Tiempo que el job esperó en la cola del planificador
+    espera = {
+        'queued_at': (encolado_at or inicio).isoformat(),
+        'wait_seconds': round((inicio - (encolado_at or inicio)).total_seconds(), 1),
+    }
+    # Límite del job: aprendido de la duración de ejecuciones anteriores (30 minutos sin historia)
+    limite_segundos = 1800
     try:
+        # La salida del script se lee mientras corre: buffer acotado + tabla de logs
+        log = abrir_log_en_vivo(job_id)
+
         # Actualizar estado del job
-        jobs_storage[job_id] = {
+        get_job_store().guardar(job_id, {
             'status': 'running',
             'company': company,
+            'companies': companies,
             'script': script,
             'started_at': inicio.isoformat(),
-            'logs': []
-        }
+            **espera,
+        })
 
-        print(f"[{job_id}] Iniciando proceso para {company} con script {script} webhook: {webhook_url}")
+        limite_segundos = timeout_job(companies, 'mail' if script == 'finnegans_mail.py' else 'facturacion')
+        print(f"[{job_id}] Iniciando proceso para {company} con script {script} webhook: {webhook_url} (límite {limite_segundos / 60:.0f} min)")
 
         # Ejecutar el script de finnegans
         env = os.environ.copy()
         env['PLAYWRIGHT_BROWSERS_PATH'] = '/ms-playwright'
+        # Los spans de tiempos de la ejecución quedan asociados al job
+        env['FINNEGANS_RUN_ID'] = job_id
 
-        script_path = SCRIPTS_DIR / script
-
-        result = subprocess.run(
-            ["python", str(script_path), "--company", company],
-            capture_output=True,
-            text=True,
-            env=env,
-            timeout=1800  # 30 minutos timeout
-        )
+        if get_pool():
+            # Sesión ya logueada del pool de navegadores: sin arranque de Chromium ni login
+            future = run_script_en_pool(script, companies, refresh_cache, job_id=job_id, salida=log.escribir)
+            try:
+                resultado, _ = future.result(timeout=limite_segundos)
+                returncode = 0
+            except FuturesTimeoutError:
+                # Se informa como timeout, pero el flujo sigue en el worker del pool: sus
+                # empresas quedan reservadas hasta que termine (no se facturan dos veces)
+                get_planificador_jobs().retener(job_id, future)
+                raise
+            except Exception as e:
+                log.agregar(f"{type(e).__name__}: {e}")
+                resultado = None
+                returncode = 1
+        else:
+            script_path = SCRIPTS_DIR / script
+            cmd = ["python", str(script_path), "--company", *companies]
+            if refresh_cache:
+                cmd.append("--refresh-cache")
+
+            # El script escribe su resultado estructurado en este archivo al terminar cada empresa
+            archivo_resultado = RESULTADOS_DIR / f"{job_id}.json"
+            env['FINNEGANS_RESULT_FILE'] = str(archivo_resultado)
+            try:
+                returncode = ejecutar_script_en_vivo(cmd, env, limite_segundos, log)
+                resultado = leer_resultado(archivo_resultado)
+            finally:
+                archivo_resultado.unlink(missing_ok=True)
 
         # Detener captura de logs
         log_capture.stop()
@@ -2354,173 +2515,91 @@ def run_finnegans_process(job_id: str, company: str, webhook_url: Optional[str]
         fin = datetime.now()
         duracion = (fin - inicio).total_seconds()
 
-        # Determinar si fue exitoso
-        success = result.returncode == 0
+        # Determinar si fue exitoso: el proceso terminó bien y ninguna empresa tuvo error
+        fallidas = empresas_con_error(resultado)
+        success = returncode == 0 and not fallidas
 
-        # Parsear el output para extraer estadísticas
-        log_completo = result.stdout + "\n" + result.stderr
+        # Logs primero: cuando el job deja de figurar "running" su log ya está completo
+        guardar_logs_job(job_id, log_capture)
 
-        # Buscar el resumen en el log
-        resumen = {
-            'total_remitos': 0,
-            'exitosos': 0,
-            'fallidos': 0,
-            'no_procesados': 0
-        }
+        resumen, empresas, pasos = resumir_resultado(resultado)
+        # Para el webhook: las últimas líneas (el log completo queda en la tabla)
+        log_completo = log.ultimas()
 
-        for line in log_completo.split('\n'):
-            if 'Total de remitos encontrados:' in line:
-                try:
-                    resumen['total_remitos'] = int(line.split(':')[-1].strip())
-                except:
-                    pass
-            elif 'Remitos procesados exitosamente:' in line:
-                try:
-                    resumen['exitosos'] = int(line.split(':')[-1].strip())
-                except:
-                    pass
-            elif 'Remitos con errores:' in line:
-                try:
-                    resumen['fallidos'] = int(line.split(':')[-1].strip())
-                except:
-                    pass
-            elif 'Remitos no procesados:' in line:
-                try:
-                    resumen['no_procesados'] = int(line.split(':')[-1].strip())
-                except:
-                    pass
-
-        # Actualizar job con resultado
-        jobs_storage[job_id] = {
+        # Actualizar job con resultado (los logs van a su propia tabla)
+        get_job_store().guardar(job_id, {
             'status': 'completed' if success else 'failed',
             'company': company,
+            'companies': companies,
             'started_at': inicio.isoformat(),
             'finished_at': fin.isoformat(),
             'duration_seconds': duracion,
             'success': success,
-            'returncode': result.returncode,
+            'returncode': returncode,
+            'modo': 'pool' if get_pool() else 'subprocess',
+            'script': script,
             'resumen': resumen,
-            'logs': log_capture.get_logs(),
-            'log_completo': log_completo
-        }
+            'empresas': empresas,
+            'pasos': pasos,
+            'error': f"Error en {', '.join(fallidas)}" if fallidas else None,
+            **espera,
+        })
 
         # Notificar vía webhook si se proporcionó
         if webhook_url:
-            try:
-                webhook_payload = {
-                    'job_id': job_id,
-                    'status': 'completed' if success else 'failed',
-                    'company': company,
-                    'started_at': inicio.isoformat(),
-                    'finished_at': fin.isoformat(),
-                    'duration_seconds': duracion,
-                    'success': success,
-                    'resumen': resumen,
-                    'logs': log_capture.get_logs(),
-                    'log_completo': log_completo
-                }
-
-                print(f"[{job_id}] ========================================")
-                print(f"[{job_id}] ENVIANDO WEBHOOK")
-                print(f"[{job_id}] URL:    {webhook_url}")
-                print(f"[{job_id}] Method: POST")
-                print(f"[{job_id}] Headers: {{'Content-Type': 'application/json'}}")
-                print(f"[{job_id}] ========================================")
-
-                response = requests.post(
-                    webhook_url,
-                    json=webhook_payload,
-                    timeout=30
-                )
-
-                print(f"[{job_id}] ========================================")
-                print(f"[{job_id}] RESPUESTA DEL WEBHOOK")
-                print(f"[{job_id}] Status Code: {response.status_code}")
-                print(f"[{job_id}] Response Body: {response.text[:200]}")
-                print(f"[{job_id}] ========================================")
-
-                if response.status_code == 200:
-                    print(f"[{job_id}] ✅ Webhook notificado exitosamente")
-                    jobs_storage[job_id]['webhook_notified'] = True
-                else:
-                    print(f"[{job_id}] ❌ Error al notificar webhook: HTTP {response.status_code}")
-                    jobs_storage[job_id]['webhook_error'] = f"HTTP {response.status_code}"
-                    jobs_storage[job_id]['webhook_response'] = response.text[:500]
-
-            except Exception as e:
-                print(f"[{job_id}] Error enviando webhook: {str(e)}")
-                jobs_storage[job_id]['webhook_error'] = str(e)
+            job = get_job_store().obtener(job_id) or {}
+            notificar_webhook(job_id, webhook_url, payload_webhook(job_id, job, log_completo, log_capture.get_logs()))
 
         print(f"[{job_id}] Proceso finalizado. Status: {'exitoso' if success else 'fallido'}")
 
-    except subprocess.TimeoutExpired:
+    except (subprocess.TimeoutExpired, FuturesTimeoutError):
         log_capture.stop()
         fin = datetime.now()
         duracion = (fin - inicio).total_seconds()
 
-        jobs_storage[job_id] = {
+        job = {
             'status': 'timeout',
             'company': company,
+            'companies': companies,
+            'script': script,
             'started_at': inicio.isoformat(),
             'finished_at': fin.isoformat(),
             'duration_seconds': duracion,
-            'error': 'Proceso excedió el tiempo límite de 30 minutos',
-            'logs': log_capture.get_logs()
+            'error': f'Proceso excedió el tiempo límite de {limite_segundos / 60:.0f} minutos',
+            **espera,
         }
+        guardar_logs_job(job_id, log_capture)
+        get_job_store().guardar(job_id, job)
 
         # Notificar timeout vía webhook
         if webhook_url:
-            try:
-                print(f"[{job_id}] ========================================")
-                print(f"[{job_id}] ENVIANDO WEBHOOK (TIMEOUT)")
-                print(f"[{job_id}] URL:    {webhook_url}")
-                print(f"[{job_id}] Method: POST")
-                print(f"[{job_id}] ========================================")
-
-                response = requests.post(
-                    webhook_url,
-                    json=jobs_storage[job_id],
-                    timeout=30
-                )
-
-                print(f"[{job_id}] Webhook timeout notificado - Status: {response.status_code}")
-            except Exception as webhook_error:
-                print(f"[{job_id}] Error enviando webhook timeout: {str(webhook_error)}")
+            notificar_webhook(job_id, webhook_url, payload_webhook(job_id, job, logs=log_capture.get_logs()))
 
     except Exception as e:
         log_capture.stop()
         fin = datetime.now()
         duracion = (fin - inicio).total_seconds()
 
-        jobs_storage[job_id] = {
+        job = {
             'status': 'error',
             'company': company,
+            'companies': companies,
+            'script': script,
             'started_at': inicio.isoformat(),
             'finished_at': fin.isoformat(),
             'duration_seconds': duracion,
             'error': str(e),
-            'logs': log_capture.get_logs()
+            **espera,
         }
+        guardar_logs_job(job_id, log_capture)
+        get_job_store().guardar(job_id, job)
 
         # Notificar error vía webhook
         if webhook_url:
-            try:
-                print(f"[{job_id}] ========================================")
-                print(f"[{job_id}] ENVIANDO WEBHOOK (ERROR)")
-                print(f"[{job_id}] URL:    {webhook_url}")
-                print(f"[{job_id}] Method: POST")
-                print(f"[{job_id}] Error:  {str(e)}")
-                print(f"[{job_id}] ========================================")
-
-                response = requests.post(
-                    webhook_url,
-                    json=jobs_storage[job_id],
-                    timeout=30
-                )
+            notificar_webhook(job_id, webhook_url, payload_webhook(job_id, job, logs=log_capture.get_logs()))
 
-                print(f"[{job_id}] Webhook error notificado - Status: {response.status_code}")
-            except Exception as webhook_error:
-                print(f"[{job_id}] Error enviando webhook error: {str(webhook_error)}")
+    finally:
+        cerrar_log_en_vivo(job_id)
 
 @app.post("/finnegans/start",
     summary="Iniciar proceso de facturación Finnegans (async)",
@@ -2536,28 +2615,37 @@ def run_finnegans_process(job_id: str, company: str, webhook_url: Optional[str]
                         "status": "started",
                         "message": "Proceso iniciado en background",
                         "company": "Das Dach",
-                        "webhook_url": "https://n8n.tudominio.com/webhook/finnegans-result"
+                        "companies": ["Das Dach"],
+                        "webhook_url": "https://n8n.tudominio.com/webhook/finnegans-result",
+                        "coalesced": False,
+                        "queue_position": None
                     }
                 }
             }
         }
     })
-async def start_finnegans_process(
-    request: FinnegansRequest,
-    background_tasks: BackgroundTasks
-):
+async def start_finnegans_process(request: FinnegansRequest):
     """
     Inicia el proceso de facturación de Finnegans de forma asíncrona.
 
     **Parámetros:**
     - **company**: Nombre de la empresa a procesar (ej: "Das Dach", "AVIANCA")
+    - **companies** (opcional): lista de empresas a procesar en orden con un único login
+      (ej: `["Das Dach", "AVIANCA"]`); reemplaza a `company`
     - **webhook_url** (opcional): URL de webhook para recibir notificación cuando finalice
+    - **refresh_cache** (opcional): si es `true` se ignoran los reportes de Finnegans guardados en caché
 
     **Funcionamiento:**
     1. El endpoint retorna inmediatamente con un `job_id`
     2. El proceso se ejecuta en background
     3. Cuando finaliza (exitoso o con error), envía los resultados al `webhook_url`
 
+    Los jobs pasan por una cola con un máximo de jobs simultáneos
+    (FINNEGANS_MAX_JOBS) y una empresa no se procesa en dos jobs a la vez: si
+    no hay lugar o alguna empresa está ocupada el job queda `queued` y arranca
+    solo cuando se libera. Un pedido idéntico a uno que todavía espera en la
+    cola devuelve el mismo `job_id` con `coalesced: true`.
+
     **Payload del webhook:**
     ```json
     {
@@ -2574,11 +2662,22 @@ async def start_finnegans_process(
             "fallidos": 1,
             "no_procesados": 0
         },
-        "logs": [...],
-        "log_completo": "..."
+        "empresas": {
+            "Das Dach": {"total_remitos": 15, "exitosos": 14, "fallidos": 1, "no_procesados": 0,
+                         "fallidos_lista": [{"comprobante": "R-0001-00001234", "error": "..."}]}
+        },
+        "status_url": "https://tu-servidor.com/finnegans/status/finn_20250117_123456_abc123?logs=false",
+        "logs_url": "https://tu-servidor.com/finnegans/logs/finn_20250117_123456_abc123"
     }
     ```
 
+    El log y el detalle por remito no viajan en el webhook: se leen de
+    `logs_url` y `status_url` (FINNEGANS_PUBLIC_URL es la base de las URLs).
+    Con FINNEGANS_WEBHOOK_PAYLOAD=completo se envían también `logs`,
+    `log_completo`, `pasos` y el detalle por empresa. La entrega se reintenta
+    con espera exponencial si el webhook no responde 2xx; cada intento queda
+    en `webhook_intentos` del job.
+
     **Ejemplo de uso desde n8n:**
 
     Nodo 1 - HTTP Request (Iniciar proceso):
@@ -2602,8 +2701,9 @@ async def start_finnegans_process(
     import uuid
     job_id = f"finn_{timestamp}_{str(uuid.uuid4())[:8]}"
 
-    # Validar company
-    if not request.company:
+    # Validar company / companies (sin repetir, en el orden recibido)
+    companies = list(dict.fromkeys(c.strip() for c in (request.companies or [request.company]) if c and c.strip()))
+    if not companies:
         raise HTTPException(status_code=400, detail="Company es requerido")
 
     # Validar script (solo permitir scripts conocidos por seguridad)
@@ -2611,21 +2711,40 @@ async def start_finnegans_process(
     if request.script not in allowed_scripts:
         raise HTTPException(status_code=400, detail=f"Script no permitido. Scripts válidos: {allowed_scripts}")
 
-    # Iniciar proceso en background usando threading
+    def registrar_encolado(job_id: str, encolado_at: datetime):
+        # Antes de que el planificador lo pueda arrancar (el job luego pasa a "running")
+        get_job_store().guardar(job_id, {
+            'status': 'queued',
+            'company': ', '.join(companies),
+            'companies': companies,
+            'script': request.script,
+            'queued_at': encolado_at.isoformat(),
+        })
+
+    # Cada job corre en su propio hilo cuando el planificador le da lugar
     # (BackgroundTasks no funciona bien para procesos muy largos)
-    thread = threading.Thread(
-        target=run_finnegans_process,
-        args=(job_id, request.company, request.webhook_url, request.script),
-        daemon=True
+    job_id, coalescido = get_planificador_jobs().encolar(
+        job_id, companies, request.script, request.webhook_url, bool(request.refresh_cache),
+        al_encolar=registrar_encolado,
     )
-    thread.start()
+    posicion = get_planificador_jobs().posicion(job_id)
+
+    if coalescido:
+        mensaje = "Ya había un pedido idéntico en la cola: se devuelve ese job."
+    elif posicion:
+        mensaje = f"Proceso encolado (posición {posicion}). Recibirás notificación en el webhook cuando finalice."
+    else:
+        mensaje = "Proceso iniciado en background. Recibirás notificación en el webhook cuando finalice."
 
     return FinnegansJobResponse(
         job_id=job_id,
-        status="started",
-        message="Proceso iniciado en background. Recibirás notificación en el webhook cuando finalice.",
-        company=request.company,
-        webhook_url=request.webhook_url
+        status="queued" if posicion else "started",
+        message=mensaje,
+        company=', '.join(companies),
+        companies=companies,
+        webhook_url=request.webhook_url,
+        coalesced=coalescido,
+        queue_position=posicion,
     )
 
 @app.get("/finnegans/status/{job_id}",
@@ -2673,12 +2792,16 @@ async def start_finnegans_process(
             "description": "Job no encontrado"
         }
     })
-async def get_finnegans_job_status(job_id: str):
+async def get_finnegans_job_status(
+    job_id: str,
+    logs: bool = Query(True, description="Incluir `logs` y `log_completo` (pueden ser grandes)"),
+):
     """
     Consulta el estado de un proceso de facturación.
 
     **Parámetros:**
     - **job_id**: ID del job retornado al iniciar el proceso
+    - **logs** (opcional): con `false` se omiten los logs
 
     **Estados posibles:**
     - `running`: Proceso en ejecución
@@ -2690,39 +2813,266 @@ async def get_finnegans_job_status(job_id: str):
     Útil para hacer polling desde n8n si no se quiere usar webhook.
     """
 
-    if job_id not in jobs_storage:
+    store = get_job_store()
+    job_data = store.obtener(job_id)
+    if job_data is None:
         raise HTTPException(status_code=404, detail="Job no encontrado")
 
-    job_data = jobs_storage[job_id]
-    job_data['job_id'] = job_id
+    if logs:
+        job_data['logs'] = [
+            {'timestamp': linea['timestamp'], 'message': linea['message']}
+            for linea in store.obtener_logs(job_id, stream='api')
+        ]
+        job_data['log_completo'] = '\n'.join(linea['message'] for linea in store.obtener_logs(job_id, stream='script'))
 
     return job_data
 
+@app.get("/finnegans/logs/{job_id}",
+    summary="Seguir el log de un job en vivo (SSE)",
+    description="Envía las líneas del log del job como Server-Sent Events a medida que el script las escribe. Se puede retomar desde un offset con `desde` o con el header `Last-Event-ID`.")
+async def stream_finnegans_logs(
+    job_id: str,
+    request: Request,
+    desde: int = Query(0, ge=0, description="Primera línea (seq) a enviar"),
+    seguir: bool = Query(True, description="Seguir esperando líneas hasta que el job termine"),
+):
+    """
+    Cada línea es un evento `log` con `id` = seq y data
+    `{"seq", "stream", "timestamp", "message"}`. Un job `queued` se espera
+    hasta que arranque. Al terminar el job (o con `seguir=false`, al enviar lo
+    que hay) se envía un evento `fin` con el estado.
+    """
+    store = get_job_store()
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, store.obtener, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+
+    ultimo_id = request.headers.get('last-event-id', '')
+    if ultimo_id.isdigit():
+        desde = int(ultimo_id) + 1
+
+    async def eventos():
+        seq = desde
+        ultimo_envio = time.monotonic()
+        while not await request.is_disconnected():
+            log = get_log_en_vivo(job_id)
+            lineas = log.desde(seq) if log else None
+            if lineas is None:
+                lineas = await loop.run_in_executor(None, lambda: store.obtener_logs(job_id, desde=seq, limite=500))
+
+            for linea in lineas:
+                yield f"id: {linea['seq']}\nevent: log\ndata: {json.dumps(linea, ensure_ascii=False)}\n\n"
+                seq = linea['seq'] + 1
+            if lineas:
+                ultimo_envio = time.monotonic()
+                continue
+
+            if log is None:
+                # Sin log en vivo: el job terminó, todavía espera en la cola (se sigue
+                # esperando) o corre en otro worker de la API y se lee de la tabla
+                job = await loop.run_in_executor(None, store.obtener, job_id)
+                status = job['status'] if job else None
+                if status not in ('queued', 'running') or not seguir:
+                    yield f"event: fin\ndata: {json.dumps({'status': status, 'seq': seq})}\n\n"
+                    return
+            elif not seguir:
+                yield f"event: fin\ndata: {json.dumps({'status': 'running', 'seq': seq})}\n\n"
+                return
+
+            if time.monotonic() - ultimo_envio > 15:
+                # Comentario SSE para que los proxies no corten la conexión
+                yield ": ping\n\n"
+                ultimo_envio = time.monotonic()
+            await asyncio.sleep(0.5 if log else 2)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
 @app.get("/finnegans/jobs",
-    summary="Listar todos los jobs de facturación",
-    description="Obtiene la lista de todos los jobs ejecutados")
-async def list_finnegans_jobs():
+    summary="Listar los jobs de facturación",
+    description="Lista paginada de los jobs, filtrable por estado, empresa y fecha de inicio")
+async def list_finnegans_jobs(
+    status: Optional[str] = Query(None, description="Estado (queued, running, completed, failed, timeout, error, interrupted)"),
+    company: Optional[str] = Query(None, description="Empresa (incluye los jobs con varias empresas)"),
+    desde: Optional[str] = Query(None, description="Iniciados desde (ISO, p.ej. 2025-01-17)"),
+    hasta: Optional[str] = Query(None, description="Iniciados antes de (ISO)"),
+    limit: int = Query(50, ge=1, le=500, description="Cantidad de jobs por página"),
+    offset: int = Query(0, ge=0, description="Jobs a saltear"),
+):
     """
-    Lista todos los jobs de facturación ejecutados.
+    Lista los jobs de facturación guardados, del más reciente al más antiguo,
+    junto con el estado de la cola (`cola`: jobs en curso y encolados, espera).
 
     Útil para debugging y monitoreo.
     """
 
-    jobs_list = []
-    for job_id, job_data in jobs_storage.items():
-        jobs_list.append({
-            'job_id': job_id,
-            'status': job_data.get('status'),
-            'company': job_data.get('company'),
-            'started_at': job_data.get('started_at'),
-            'finished_at': job_data.get('finished_at'),
-            'success': job_data.get('success')
-        })
+    total, jobs = get_job_store().listar(status=status, company=company, desde=desde, hasta=hasta, limit=limit, offset=offset)
+
+    return {
+        'total': total,
+        'limit': limit,
+        'offset': offset,
+        'cola': get_planificador_jobs().stats(),
+        'jobs': [
+            {
+                'job_id': job['job_id'],
+                'status': job.get('status'),
+                'company': job.get('company'),
+                'companies': job.get('companies'),
+                'started_at': job.get('started_at'),
+                'finished_at': job.get('finished_at'),
+                'success': job.get('success'),
+                'resumen': job.get('resumen'),
+                'queued_at': job.get('queued_at'),
+                'wait_seconds': job.get('wait_seconds'),
+            }
+            for job in jobs
+        ]
+    }
 
-    # Ordenar por fecha de inicio descendente
-    jobs_list.sort(key=lambda x: x.get('started_at', ''), reverse=True)
+@app.get("/finnegans/spans",
+    summary="Tendencia de tiempos por paso",
+    description="p50/p95 diarios de la duración de cada paso de los flujos de Finnegans")
+async def get_finnegans_spans(
+    paso: Optional[str] = Query(None, description="Paso (p.ej. remito, factura.ui, espera.total bruto)"),
+    company: Optional[str] = Query(None, description="Empresa"),
+    dias: int = Query(30, ge=1, le=365, description="Días hacia atrás"),
+):
+    """
+    Agrega la tabla `finnegans_spans` (un registro por paso medido en cada
+    ejecución) por día y paso: cantidad, errores, p50, p95 y máximo en ms.
+    """
+    condiciones = ["inicio >= NOW() - (%s * INTERVAL '1 day')"]
+    parametros = [dias]
+    if paso:
+        condiciones.append("paso = %s")
+        parametros.append(paso)
+    if company:
+        condiciones.append("empresa = %s")
+        parametros.append(company)
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT DATE(inicio) AS dia, paso, COUNT(*),
+                       SUM(CASE WHEN ok THEN 0 ELSE 1 END),
+                       PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY duracion_ms),
+                       PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY duracion_ms),
+                       MAX(duracion_ms)
+                FROM finnegans_spans
+                WHERE {' AND '.join(condiciones)}
+                GROUP BY DATE(inicio), paso
+                ORDER BY dia DESC, paso
+            """, parametros)
+            filas = cur.fetchall()
+        finally:
+            conn.close()
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": f"Error consultando spans: {str(e)}"})
+
+    return {
+        'dias': dias,
+        'tendencia': [
+            {
+                'dia': dia.isoformat(),
+                'paso': nombre,
+                'n': n,
+                'errores': errores,
+                'p50_ms': round(float(p50), 1),
+                'p95_ms': round(float(p95), 1),
+                'max_ms': float(maximo),
+            }
+            for dia, nombre, n, errores, p50, p95, maximo in filas
+        ]
+    }
+
+@app.get("/finnegans/timeouts",
+    summary="Timeouts aprendidos por paso",
+    description="Timeout vigente de cada paso por empresa, derivado del percentil histórico de su duración")
+async def get_finnegans_timeouts(
+    company: Optional[str] = Query(None, description="Empresa"),
+):
+    """
+    Lista la tabla `finnegans_timeouts`: por empresa y paso, el percentil de la
+    duración (FINNEGANS_TIMEOUT_PERCENTIL, p99 por defecto), la cantidad de
+    muestras y el timeout que usa la automatización (percentil x factor de
+    seguridad, acotado). Los pasos `ejecucion.<flujo>` son el límite de los jobs.
+    """
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT empresa, paso, timeout_ms, percentil_ms, muestras, actualizado
+                FROM finnegans_timeouts
+                WHERE %s IS NULL OR empresa = %s
+                ORDER BY empresa, paso
+                """,
+                (company, company),
+            )
+            filas = cur.fetchall()
+        finally:
+            conn.close()
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": f"Error consultando timeouts: {str(e)}"})
 
     return {
-        'total': len(jobs_list),
-        'jobs': jobs_list
-    }
\ No newline at end of file
+        'timeouts': [
+            {
+                'empresa': empresa,
+                'paso': paso,
+                'timeout_ms': timeout_ms,
+                'percentil_ms': float(percentil_ms),
+                'muestras': muestras,
+                'actualizado': actualizado.isoformat(),
+            }
+            for empresa, paso, timeout_ms, percentil_ms, muestras, actualizado in filas
+        ]
+    }
+
+@app.on_event("startup")
+def iniciar_pool_navegadores():
+    """Inicia el pool de navegadores logueados si FINNEGANS_POOL_SIZE > 0"""
+    start_pool()
+
+@app.on_event("startup")
+def iniciar_latido_jobs():
+    """Renueva el lease de los jobs vivos y marca 'interrupted' los que quedaron sin dueño (reinicio, redeploy)"""
+    iniciar_latido(lambda: get_planificador_jobs().job_ids())
+
+@app.on_event("startup")
+def iniciar_entregador_webhooks():
+    """Entrega en segundo plano los webhooks encolados (también los que quedaron de antes de reiniciar)"""
+    iniciar_entregador({'finnegans': registrar_intento_webhook_job})
+
+@app.on_event("shutdown")
+def detener_pool_navegadores():
+    stop_pool()
+
+@app.on_event("shutdown")
+def detener_entregador_webhooks():
+    detener_entregador()
+
+@app.on_event("shutdown")
+def detener_latido_jobs():
+    detener_latido()
+
+@app.get("/finnegans/pool",
+    summary="Estado del pool de navegadores",
+    description="Tamaño del pool, contextos libres/ocupados, jobs en cola, espera de alquiler y reciclajes")
+async def get_finnegans_pool():
+    """
+    Estado del pool de navegadores de Finnegans.
+
+    Con `FINNEGANS_POOL_SIZE=0` (por defecto) el pool está desactivado y cada
+    job lanza su propio subproceso con login completo.
+    """
+    pool = get_pool()
+    if not pool:
+        return {'activo': False, 'size': 0}
+    return {'activo': True, **pool.stats()}
\ No newline at end of file
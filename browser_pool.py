@@ -0,0 +1,357 @@
+"""
+Pool de navegadores Chromium con sesiones de Finnegans ya logueadas.
+
+Cada worker del pool es un hilo dueño de su propio Playwright (la API sync de
+Playwright no se puede compartir entre hilos), un navegador y un contexto
+autenticado. Los jobs se encolan y el primer worker libre los "alquila": el
+flujo (facturación o mails) corre en el hilo del worker con la sesión ya
+abierta, y al terminar el contexto vuelve al pool o se recicla.
+"""
+import os
+import sys
+import io
+import time
+import queue
+import threading
+import importlib
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts")
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+
+
+# Destino extra de lo que imprime cada hilo (el job al que pertenece)
+_salida_local = threading.local()
+
+
+class _SalidaPorHilo(io.TextIOBase):
+    """
+    Reemplazo de sys.stdout / sys.stderr que además de escribir en la salida
+    original pasa lo que imprime cada hilo (un worker del pool, el hilo de un
+    job de la API) a la salida de su job.
+    """
+    def __init__(self, original):
+        self.original = original
+
+    def write(self, text):
+        escribir = getattr(_salida_local, 'escribir', None)
+        if escribir is not None:
+            escribir(text)
+        return self.original.write(text)
+
+    def flush(self):
+        self.original.flush()
+
+
+_salida_lock = threading.Lock()
+_salida_instalada = False
+
+
+def _instalar_salida():
+    """Se instala una sola vez: sys.stdout no se vuelve a cambiar por job"""
+    global _salida_instalada
+    with _salida_lock:
+        if not _salida_instalada:
+            sys.stdout = _SalidaPorHilo(sys.stdout)
+            sys.stderr = _SalidaPorHilo(sys.stderr)
+            _salida_instalada = True
+
+
+def redirigir_salida_del_hilo(escribir: Optional[Callable[[str], None]]) -> None:
+    """Lo que imprime el hilo actual se pasa además a `escribir` (None deja de hacerlo)"""
+    _instalar_salida()
+    _salida_local.escribir = escribir
+
+
+def salida_del_hilo() -> Optional[Callable[[str], None]]:
+    """Destino extra de la salida del hilo actual, para pasarlo a los hilos que lance"""
+    return getattr(_salida_local, 'escribir', None)
+
+
+class _Trabajo:
+    def __init__(self, nombre: str, funcion: Callable, salida: Optional[Callable[[str], None]] = None):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.salida = salida
+        self.future = Future()
+        self.encolado = time.monotonic()
+
+
+class BrowserPool:
+    """
+    Mantiene `size` contextos logueados. Un contexto se recicla (se cierra y se
+    vuelve a abrir) después de `max_usos` jobs, si tiene más de `max_edad`
+    segundos, si estuvo ocioso más de `max_ocioso` segundos o si el job falló.
+    """
+
+    def __init__(self, size: int, max_usos: int = 20, max_edad: int = 3600, max_ocioso: int = 900):
+        self.size = size
+        self.max_usos = max_usos
+        self.max_edad = max_edad
+        self.max_ocioso = max_ocioso
+        self.cola = queue.Queue()
+        self.lock = threading.Lock()
+        self.detener = threading.Event()
+        self.hilos = []
+        self.workers = {}
+        self.esperas = []
+        self.alquileres = 0
+        self.reciclajes = {}
+        self.iniciado = None
+
+    # ---------- API pública ----------
+
+    def start(self):
+        _instalar_salida()
+        self.iniciado = datetime.now().isoformat()
+        for i in range(self.size):
+            hilo = threading.Thread(target=self._worker, args=(i,), name=f"browser-pool-{i}", daemon=True)
+            self.hilos.append(hilo)
+            hilo.start()
+        print(f"[browser-pool] Iniciado con {self.size} contextos")
+
+    def stop(self):
+        self.detener.set()
+        for _ in self.hilos:
+            self.cola.put(None)
+
+    def submit(self, nombre: str, funcion: Callable, salida: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        Encola `funcion(sesion)` donde sesion = (browser, context, page). El
+        Future resuelve con (resultado, log) del job. Con `salida`, lo que
+        imprime el job se le pasa a medida que se escribe y el log queda vacío.
+        """
+        trabajo = _Trabajo(nombre, funcion, salida)
+        self.cola.put(trabajo)
+        return trabajo.future
+
+    def stats(self) -> dict:
+        with self.lock:
+            workers = [dict(w) for w in self.workers.values()]
+            esperas = sorted(self.esperas)
+            reciclajes = dict(self.reciclajes)
+            alquileres = self.alquileres
+        ocupados = sum(1 for w in workers if w['estado'] == 'ocupado')
+        libres = sum(1 for w in workers if w['estado'] == 'libre')
+        return {
+            'size': self.size,
+            'libres': libres,
+            'ocupados': ocupados,
+            'en_cola': self.cola.qsize(),
+            'alquileres': alquileres,
+            'espera_alquiler_ms': {
+                'promedio': round(sum(esperas) / len(esperas), 1) if esperas else None,
+                'p95': esperas[int(len(esperas) * 0.95)] if esperas else None,
+                'max': esperas[-1] if esperas else None,
+            },
+            'reciclajes': reciclajes,
+            'iniciado': self.iniciado,
+            'workers': workers,
+        }
+
+    # ---------- Worker ----------
+
+    def _estado(self, indice: int, **cambios):
+        with self.lock:
+            self.workers.setdefault(indice, {'worker': indice}).update(cambios)
+
+    def _reciclar(self, motivo: str):
+        with self.lock:
+            self.reciclajes[motivo] = self.reciclajes.get(motivo, 0) + 1
+
+    def _abrir_contexto(self, indice: int, browser):
+        from finnegans_common import open_finnegans_context
+
+        self._estado(indice, estado='abriendo')
+        inicio = time.monotonic()
+        context, page = open_finnegans_context(browser)
+        if not page:
+            return None, None, None
+        self._estado(
+            indice,
+            estado='libre',
+            usos=0,
+            creado=datetime.now().isoformat(),
+            login_segundos=round(time.monotonic() - inicio, 1),
+        )
+        return context, page, page.url
+
+    def _worker(self, indice: int):
+        from playwright.sync_api import sync_playwright
+        from finnegans_common import launch_browser
+
+        espera_reintento = 5
+        with sync_playwright() as playwright:
+            browser = None
+            context = page = url_inicio = None
+            creado = ultimo_uso = time.monotonic()
+            usos = 0
+            while not self.detener.is_set():
+                try:
+                    if browser is None or not browser.is_connected():
+                        if browser is not None:
+                            self._reciclar('navegador_desconectado')
+                        browser = launch_browser(playwright)
+                        context = None
+                    if context is None:
+                        context, page, url_inicio = self._abrir_contexto(indice, browser)
+                        if context is None:
+                            self._estado(indice, estado='error_login')
+                            time.sleep(espera_reintento)
+                            espera_reintento = min(espera_reintento * 2, 300)
+                            continue
+                        espera_reintento = 5
+                        creado = ultimo_uso = time.monotonic()
+                        usos = 0
+                except Exception as e:
+                    print(f"[browser-pool] Worker {indice}: error abriendo el navegador: {e}")
+                    self._estado(indice, estado='error', error=str(e))
+                    browser = context = None
+                    time.sleep(espera_reintento)
+                    espera_reintento = min(espera_reintento * 2, 300)
+                    continue
+
+                try:
+                    trabajo = self.cola.get(timeout=30)
+                except queue.Empty:
+                    if time.monotonic() - ultimo_uso > self.max_ocioso:
+                        # La sesión pudo vencer mientras estaba ociosa
+                        self._reciclar('ocioso')
+                        self._cerrar(context)
+                        context = None
+                    continue
+                if trabajo is None:
+                    break
+                if not trabajo.future.set_running_or_notify_cancel():
+                    continue
+
+                espera_ms = round((time.monotonic() - trabajo.encolado) * 1000, 1)
+                with self.lock:
+                    self.alquileres += 1
+                    self.esperas = (self.esperas + [espera_ms])[-200:]
+                self._estado(indice, estado='ocupado', job=trabajo.nombre, alquilado=datetime.now().isoformat())
+                print(f"[browser-pool] Worker {indice} alquilado a {trabajo.nombre} (espera {espera_ms} ms)")
+
+                buffer = []
+                redirigir_salida_del_hilo(trabajo.salida or buffer.append)
+                fallo = False
+                try:
+                    resultado = trabajo.funcion((browser, context, page))
+                    trabajo.future.set_result((resultado, ''.join(buffer)))
+                except BaseException as e:
+                    fallo = True
+                    e.log = ''.join(buffer)
+                    trabajo.future.set_exception(e)
+                finally:
+                    redirigir_salida_del_hilo(None)
+
+                usos += 1
+                ultimo_uso = time.monotonic()
+                motivo = None
+                if fallo:
+                    motivo = 'error_job'
+                elif usos >= self.max_usos:
+                    motivo = 'max_usos'
+                elif ultimo_uso - creado > self.max_edad:
+                    motivo = 'max_edad'
+                if motivo:
+                    self._reciclar(motivo)
+                    self._cerrar(context)
+                    context = None
+                else:
+                    try:
+                        # Volver a la pantalla inicial para el próximo job
+                        page.goto(url_inicio)
+                    except Exception:
+                        self._reciclar('reset_fallido')
+                        self._cerrar(context)
+                        context = None
+                self._estado(indice, estado='libre' if context else 'reciclando', usos=usos, job=None)
+
+            self._cerrar(context)
+            if browser is not None:
+                try:
+                    browser.close()
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _cerrar(context):
+        if context is None:
+            return
+        try:
+            context.close()
+        except Exception:
+            pass
+
+
+_pool: Optional[BrowserPool] = None
+
+
+def get_pool_size() -> int:
+    """Cantidad de contextos del pool (FINNEGANS_POOL_SIZE, 0 = desactivado)"""
+    load_dotenv()
+    try:
+        return max(0, int(os.getenv('FINNEGANS_POOL_SIZE', '0')))
+    except ValueError:
+        return 0
+
+
+def start_pool() -> Optional[BrowserPool]:
+    """Crea e inicia el pool si FINNEGANS_POOL_SIZE > 0"""
+    global _pool
+    size = get_pool_size()
+    if _pool is None and size > 0:
+        # Misma ubicación de navegadores que usan los subprocesos de los jobs
+        if os.path.isdir('/ms-playwright'):
+            os.environ.setdefault('PLAYWRIGHT_BROWSERS_PATH', '/ms-playwright')
+        _pool = BrowserPool(
+            size,
+            max_usos=int(os.getenv('FINNEGANS_POOL_MAX_USES', '20')),
+            max_edad=int(os.getenv('FINNEGANS_POOL_MAX_AGE', '3600')),
+            max_ocioso=int(os.getenv('FINNEGANS_POOL_MAX_IDLE', '900')),
+        )
+        _pool.start()
+    return _pool
+
+
+def get_pool() -> Optional[BrowserPool]:
+    return _pool
+
+
+def stop_pool():
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
+
+
+def run_script_en_pool(script: str, companies: list, refresh_cache: bool = False, job_id: str = None,
+                       salida: Optional[Callable[[str], None]] = None) -> Future:
+    """
+    Ejecuta process_company del script (finnegans_login.py o finnegans_mail.py)
+    para cada empresa, en orden, con una misma sesión del pool. `salida` recibe
+    lo que imprime el flujo mientras corre.
+    """
+    modulo = importlib.import_module(os.path.splitext(script)[0])
+    flujo = 'mail' if 'mail' in script else 'facturacion'
+
+    def ejecutar(sesion):
+        from finnegans_common import procesar_empresas
+        from finnegans_reports import set_force_refresh
+        from finnegans_spans import set_run_id
+
+        set_run_id(job_id)
+        # Por hilo: no afecta a los jobs que corren en los otros workers
+        set_force_refresh(refresh_cache)
+        try:
+            return procesar_empresas(modulo.process_company, companies, sesion=sesion, flujo=flujo)
+        finally:
+            set_force_refresh(False)
+
+    return _pool.submit(f"{script}:{','.join(companies)}", ejecutar, salida)
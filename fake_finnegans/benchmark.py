@@ -0,0 +1,246 @@
+"""
+Benchmark de la automatización contra el Finnegans falso.
+
+Levanta fake_finnegans/server.py, ejecuta finnegans_login.py (y opcionalmente
+finnegans_mail.py) apuntando a él y calcula, a partir de los spans que emiten
+los scripts, el throughput y los percentiles por remito y por paso. Cada
+corrida se agrega a un historial JSONL y se compara con la mediana de las
+últimas corridas con la misma configuración: si el p50 por remito empeora o el
+throughput cae más que la tolerancia, termina con código 1.
+
+    python fake_finnegans/benchmark.py --remitos 20 --latencia 200 --repeticiones 3
+
+El flujo de mails lee las facturas de PostgreSQL: requiere --db con una base de
+pruebas. Sin --db los scripts no tienen base (no se registra nada).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import requests
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+SCRIPTS_DIR = BASE_DIR / "scripts"
+HISTORIAL_DEFAULT = BASE_DIR / "data" / "benchmarks" / "finnegans_bench.jsonl"
+COMPANY = "Das Dach"
+
+
+def _percentil(valores: List[float], p: float) -> Optional[float]:
+    if not valores:
+        return None
+    valores = sorted(valores)
+    return round(valores[min(len(valores) - 1, int(round(p * (len(valores) - 1))))], 1)
+
+
+def iniciar_fake(port: int, remitos: int, latencia: int, falla_cae: float) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        'FAKE_FINNEGANS_REMITOS': str(remitos),
+        'FAKE_FINNEGANS_LATENCIA_MS': str(latencia),
+        'FAKE_FINNEGANS_FALLA_CAE': str(falla_cae),
+    }
+    proceso = subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve().parent / "server.py"), "--port", str(port)],
+        env=env,
+    )
+    limite = time.monotonic() + 20
+    while time.monotonic() < limite:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/fake/estado", timeout=1)
+            return proceso
+        except requests.RequestException:
+            if proceso.poll() is not None:
+                raise RuntimeError("El Finnegans falso terminó al iniciar")
+            time.sleep(0.2)
+    proceso.terminate()
+    raise RuntimeError("El Finnegans falso no respondió a tiempo")
+
+
+def entorno_scripts(base_url: str, trabajo: Path, args, run_id: str) -> Dict[str, str]:
+    """Variables para que los scripts usen el fake, sin caché de reportes ni ledger"""
+    env = {
+        **os.environ,
+        'WEBPAGE_FINNEGANS': f"{base_url}/login",
+        'FINNEGANS_API_URL': f"{base_url}/api",
+        'FINNEGANS_SALDOS_API_URL': f"{base_url}/api",
+        'FINNEGANS_ALICUOTAS_URL': f"{base_url}/alicuotas/",
+        'FINNEGANS_CLIENT_ID': 'benchmark',
+        'FINNEGANS_SECRET': 'benchmark',
+        'USER_FINNEGANS': 'benchmark',
+        'PASSWORD_FINNEGANS': 'benchmark',
+        'WORKSPACE_FINNEGANS': '',
+        'HEADLESS': 'true',
+        'FINNEGANS_SESSION_DIR': str(trabajo / "session"),
+        'FINNEGANS_CACHE_DIR': str(trabajo / "cache"),
+        'FINNEGANS_CACHE_TTL': '0',
+        'FINNEGANS_SPANS_FILE': str(trabajo / "spans.jsonl"),
+        'FINNEGANS_RUN_ID': run_id,
+        'FINNEGANS_FACTURA_BACKEND': args.backend,
+        'FINNEGANS_FACTURACION_WORKERS': str(args.workers),
+        'FINNEGANS_MAIL_BACKEND': 'ui',
+        # Los remitos del fake se regeneran con los mismos comprobantes en cada corrida
+        'FINNEGANS_LEDGER': 'false',
+    }
+    if args.db:
+        env['DB_NAME'] = args.db
+    else:
+        # Puerto cerrado: los scripts fallan rápido al registrar y siguen
+        env['DB_HOST'] = '127.0.0.1'
+        env['DB_PORT'] = '1'
+    return env
+
+
+def ejecutar_script(script: str, env: Dict[str, str], log_path: Path) -> Dict[str, Any]:
+    inicio = time.monotonic()
+    spans = []
+    with open(log_path, 'a', encoding='utf-8') as log:
+        proceso = subprocess.Popen(
+            [sys.executable, str(SCRIPTS_DIR / script), "--company", COMPANY, "--refresh-cache"],
+            cwd=str(BASE_DIR),
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+        for linea in proceso.stdout:
+            log.write(linea)
+            if linea.startswith("SPAN "):
+                try:
+                    spans.append(json.loads(linea[5:]))
+                except json.JSONDecodeError:
+                    pass
+        proceso.wait()
+    return {'returncode': proceso.returncode, 'segundos': time.monotonic() - inicio, 'spans': spans}
+
+
+def resumir(flujo: str, ejecucion: Dict[str, Any], facturas_fake: int) -> Dict[str, Any]:
+    spans = ejecucion['spans']
+    paso_item = 'remito' if flujo == 'facturacion' else 'mail.factura'
+    items = [s for s in spans if s['paso'] == paso_item]
+    duraciones = [s['duracion_ms'] for s in items if s['ok']]
+    exitosos = len([s for s in items if s['ok'] and s.get('resultado', 'facturado') == 'facturado'])
+    pasos = {}
+    for s in spans:
+        pasos.setdefault(s['paso'], []).append(s['duracion_ms'])
+    return {
+        'flujo': flujo,
+        'returncode': ejecucion['returncode'],
+        'segundos': round(ejecucion['segundos'], 1),
+        'items': len(items),
+        'exitosos': exitosos,
+        'fallidos': len([s for s in items if not s['ok']]),
+        'facturas_fake': facturas_fake,
+        'por_minuto': round(exitosos / ejecucion['segundos'] * 60, 2) if ejecucion['segundos'] else 0,
+        'p50_ms': _percentil(duraciones, 0.50),
+        'p95_ms': _percentil(duraciones, 0.95),
+        'pasos_p50_ms': {paso: _percentil(v, 0.50) for paso, v in sorted(pasos.items())},
+    }
+
+
+def clave_config(args, flujo: str) -> str:
+    return f"{flujo}|remitos={args.remitos}|latencia={args.latencia}|workers={args.workers}|backend={args.backend}"
+
+
+def leer_historial(path: Path) -> List[Dict[str, Any]]:
+    if not path.exists():
+        return []
+    registros = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try:
+                registros.append(json.loads(linea))
+            except json.JSONDecodeError:
+                pass
+    return registros
+
+
+def comparar(resultado: Dict[str, Any], historial: List[Dict[str, Any]], tolerancia: float, ventana: int = 5) -> List[str]:
+    """Regresiones del resultado contra la mediana de las últimas `ventana` corridas con la misma clave"""
+    previos = [r for r in historial if r.get('clave') == resultado['clave'] and r.get('p50_ms')][-ventana:]
+    if not previos or not resultado.get('p50_ms'):
+        return []
+    regresiones = []
+    base_p50 = statistics.median(r['p50_ms'] for r in previos)
+    base_ritmo = statistics.median(r['por_minuto'] for r in previos)
+    if resultado['p50_ms'] > base_p50 * (1 + tolerancia):
+        regresiones.append(f"p50 por ítem {resultado['p50_ms']:.0f} ms vs {base_p50:.0f} ms de referencia")
+    if resultado['por_minuto'] < base_ritmo * (1 - tolerancia):
+        regresiones.append(f"throughput {resultado['por_minuto']:.2f}/min vs {base_ritmo:.2f}/min de referencia")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de la automatización contra el Finnegans falso')
+    parser.add_argument('--flujo', choices=('facturacion', 'mail', 'ambos'), default='facturacion')
+    parser.add_argument('--remitos', type=int, default=20)
+    parser.add_argument('--latencia', type=int, default=200, help='Latencia base (ms) del fake')
+    parser.add_argument('--falla-cae', type=float, default=0.0, help='Probabilidad de factura sin CAE')
+    parser.add_argument('--repeticiones', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1, help='FINNEGANS_FACTURACION_WORKERS')
+    parser.add_argument('--backend', choices=('ui', 'api', 'auto'), default='ui', help='FINNEGANS_FACTURA_BACKEND')
+    parser.add_argument('--db', help='Base de PostgreSQL de pruebas (necesaria para el flujo de mails)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tolerancia', type=float, default=0.15)
+    parser.add_argument('--historial', type=Path, default=HISTORIAL_DEFAULT)
+    parser.add_argument('--sin-historial', action='store_true', help='No guardar ni comparar resultados')
+    args = parser.parse_args()
+
+    if args.flujo in ('mail', 'ambos') and not args.db:
+        parser.error("El flujo de mails necesita --db (lee las facturas pendientes de PostgreSQL)")
+    flujos = {'facturacion': ['facturacion'], 'mail': ['mail'], 'ambos': ['facturacion', 'mail']}[args.flujo]
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    trabajo = Path(tempfile.mkdtemp(prefix='finnegans_bench_'))
+    historial = [] if args.sin_historial else leer_historial(args.historial)
+    fake = iniciar_fake(args.port, args.remitos, args.latencia, args.falla_cae)
+    hubo_regresion = False
+    try:
+        for repeticion in range(1, args.repeticiones + 1):
+            requests.post(f"{base_url}/fake/reset", json={'remitos': args.remitos}, timeout=10)
+            for flujo in flujos:
+                run_id = f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{flujo}_{repeticion}"
+                script = 'finnegans_login.py' if flujo == 'facturacion' else 'finnegans_mail.py'
+                print(f"[{repeticion}/{args.repeticiones}] {flujo}: {script} contra {base_url} (log en {trabajo / (run_id + '.log')})")
+                ejecucion = ejecutar_script(script, entorno_scripts(base_url, trabajo, args, run_id), trabajo / f"{run_id}.log")
+                facturas = len(requests.get(f"{base_url}/fake/estado", timeout=10).json()['facturas'])
+                resultado = {
+                    'run_id': run_id,
+                    'fecha': datetime.now().isoformat(),
+                    'clave': clave_config(args, flujo),
+                    **resumir(flujo, ejecucion, facturas),
+                }
+                regresiones = comparar(resultado, historial, args.tolerancia)
+                resultado['regresiones'] = regresiones
+                print(
+                    f"    {resultado['exitosos']}/{resultado['items']} ok en {resultado['segundos']}s - "
+                    f"{resultado['por_minuto']}/min - p50 {resultado['p50_ms']} ms - p95 {resultado['p95_ms']} ms"
+                )
+                for paso, p50 in resultado['pasos_p50_ms'].items():
+                    print(f"      {paso:<40} p50 {p50} ms")
+                for regresion in regresiones:
+                    print(f"    REGRESIÓN: {regresion}")
+                if not resultado['items']:
+                    print("    ERROR: no se procesó ningún ítem, revisar el log")
+                hubo_regresion = hubo_regresion or bool(regresiones) or ejecucion['returncode'] != 0 or not resultado['items']
+                if not args.sin_historial:
+                    args.historial.parent.mkdir(parents=True, exist_ok=True)
+                    with open(args.historial, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(resultado, ensure_ascii=False) + '\n')
+                    historial.append(resultado)
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+    sys.exit(1 if hubo_regresion else 0)
+
+
+if __name__ == "__main__":
+    main()
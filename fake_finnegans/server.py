@@ -0,0 +1,455 @@
+"""
+Finnegans falso para pruebas y benchmarks de la automatización.
+
+Sirve pantallas HTML que imitan las de Finnegans (login, menú de Favoritos,
+selector de empresa, lista de facturas, asistente de facturación con grillas
+webix, formulario con los widgets wdg_TotalBruto / wdg_NumeroDocumento /
+wdg_cai, diálogo de impresión y de mail en iframes) y la API REST que usan los
+scripts (oauth/token, reports, pedidoVenta, facturaVenta) más /alicuotas/.
+
+Uso:
+    python fake_finnegans/server.py --port 8765
+
+y en el entorno de los scripts:
+    WEBPAGE_FINNEGANS=http://127.0.0.1:8765/login
+    FINNEGANS_API_URL=http://127.0.0.1:8765/api
+    FINNEGANS_SALDOS_API_URL=http://127.0.0.1:8765/api
+    FINNEGANS_ALICUOTAS_URL=http://127.0.0.1:8765/alicuotas/
+
+Latencias (ms) configurables con FAKE_FINNEGANS_LATENCIA_MS (base) y
+FAKE_FINNEGANS_LATENCIA_<OPERACION>_MS, o en caliente con POST /fake/config.
+"""
+import asyncio
+import json
+import os
+import random
+import secrets
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
+
+# Operaciones con latencia propia
+OPERACIONES = ('login', 'token', 'reporte', 'pedido', 'grilla', 'filtro', 'preparar', 'guardar', 'cae', 'mail', 'factura_api')
+
+EMPRESAS = ('Das Dach', 'AVIANCA')
+COOKIE_SESION = 'fake_finnegans_sesion'
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except ValueError:
+        return defecto
+
+
+def _env_float(nombre: str, defecto: float) -> float:
+    try:
+        return float(os.getenv(nombre, str(defecto)))
+    except ValueError:
+        return defecto
+
+
+class EstadoFake:
+    """Datos en memoria: remitos pendientes, facturas emitidas, sesiones y configuración"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, remitos: Optional[int] = None, semilla: Optional[int] = None):
+        base = _env_int('FAKE_FINNEGANS_LATENCIA_MS', 200)
+        self.config = {
+            'latencias': {op: _env_int(f'FAKE_FINNEGANS_LATENCIA_{op.upper()}_MS', base) for op in OPERACIONES},
+            # Variación aleatoria de cada latencia (0.2 = ±20 %)
+            'jitter': _env_float('FAKE_FINNEGANS_JITTER', 0.2),
+            # Probabilidad de que una factura guardada no obtenga CAE
+            'falla_cae': _env_float('FAKE_FINNEGANS_FALLA_CAE', 0.0),
+        }
+        cantidad = remitos if remitos is not None else _env_int('FAKE_FINNEGANS_REMITOS', 20)
+        self.random = random.Random(semilla if semilla is not None else _env_int('FAKE_FINNEGANS_SEMILLA', 1))
+        self.sesiones = set()
+        self.empresa_actual = {}
+        self.alicuotas: Dict[str, float] = {}
+        self.remitos: Dict[str, Dict[str, Any]] = {}
+        self.facturas: Dict[str, Dict[str, Any]] = {}
+        self.proximo_numero = 1
+        ayer = datetime.now() - timedelta(days=1)
+        for i in range(cantidad):
+            comprobante = f"R-0001-{10000 + i:08d}"
+            cuit = f"30{70000000 + i:08d}{i % 10}"
+            provincia = 'Buenos Aires' if i % 3 == 0 else 'Córdoba'
+            if provincia == 'Buenos Aires':
+                self.alicuotas[cuit] = 3.0
+            gravado = round(self.random.uniform(1000, 50000), 2)
+            no_gravado = round(self.random.uniform(100, 5000), 2)
+            self.remitos[comprobante] = {
+                'COMPROBANTE': comprobante,
+                'DOCNROINT': str(500000 + i),
+                'EMPRESA': 'Das Dach',
+                'FECHACOMPROBANTE': ayer.strftime('%Y-%m-%d'),
+                'CLIENTE': f"Cliente {i:03d} S.A.",
+                'CONDICIONPAGO': 'Cuenta corriente 30 días',
+                'PROVINCIADESTINO': provincia,
+                'IDENTIFICACIONTRIBUTARIA': 'C.U.I.T.',
+                'NRODEIDENTIFICACION': f"{cuit[:2]}-{cuit[2:10]}-{cuit[10:]}",
+                'TOTALBRUTO': round(gravado + no_gravado, 2),
+                'TOTAL': round(gravado * 1.21 + no_gravado, 2),
+                'IMPORTE': round(gravado + no_gravado, 2),
+                'GRAVADO': gravado,
+                'NO GRAVADO': no_gravado,
+                'USR_FechaEntrega': ayer.strftime('%Y-%m-%dT00:00:00'),
+                'USROCNUM': f"OC-{7000 + i}",
+                'facturado': False,
+            }
+
+    def latencia(self, operacion: str) -> float:
+        ms = self.config['latencias'].get(operacion, 0)
+        jitter = self.config['jitter']
+        if jitter:
+            ms = ms * self.random.uniform(1 - jitter, 1 + jitter)
+        return max(0.0, ms) / 1000
+
+    def percepcion(self, remito: Dict[str, Any]) -> float:
+        cuit = remito['NRODEIDENTIFICACION'].replace('-', '')
+        return round(remito['NO GRAVADO'] * self.alicuotas.get(cuit, 0.0) / 100, 2)
+
+    def pendientes(self, empresa: Optional[str] = None) -> List[Dict[str, Any]]:
+        return [
+            r for r in self.remitos.values()
+            if not r['facturado'] and (empresa is None or r['EMPRESA'] == empresa)
+        ]
+
+    def emitir_factura(self, comprobante: str) -> Dict[str, Any]:
+        """Marca el remito como facturado y crea la factura (sin CAE todavía)"""
+        with self.lock:
+            remito = self.remitos[comprobante]
+            if remito['facturado']:
+                raise ValueError(f"El remito {comprobante} ya fue facturado")
+            remito['facturado'] = True
+            numero = f"A-0005-{self.proximo_numero:08d}"
+            self.proximo_numero += 1
+            factura = {
+                'id': str(900000 + self.proximo_numero),
+                'numero': numero,
+                'comprobante': comprobante,
+                'cuit': remito['NRODEIDENTIFICACION'].replace('-', ''),
+                'total_bruto': remito['TOTALBRUTO'],
+                'total_retenciones': self.percepcion(remito),
+                'cae': None,
+                'sin_cae': self.random.random() < self.config['falla_cae'],
+                'mails': 0,
+                'emitida': datetime.now().isoformat(),
+            }
+            self.facturas[numero] = factura
+            return factura
+
+    def asignar_cae(self, factura: Dict[str, Any]) -> Optional[str]:
+        if factura['cae'] is None and not factura['sin_cae']:
+            factura['cae'] = f"7{self.random.randint(10**12, 10**13 - 1)}"
+        return factura['cae']
+
+
+estado = EstadoFake()
+app = FastAPI(title="Finnegans falso", description="Pantallas y API simuladas de Finnegans para pruebas de la automatización")
+
+
+async def demorar(operacion: str):
+    await asyncio.sleep(estado.latencia(operacion))
+
+
+def _fixture(nombre: str) -> HTMLResponse:
+    return HTMLResponse((FIXTURES_DIR / nombre).read_text(encoding='utf-8'))
+
+
+def _autenticado(request: Request) -> bool:
+    return request.cookies.get(COOKIE_SESION) in estado.sesiones
+
+
+def _factura_por_id(factura_id: str) -> Optional[Dict[str, Any]]:
+    return next((f for f in estado.facturas.values() if f['id'] == factura_id or f['numero'] == factura_id), None)
+
+
+# ---------- Pantallas ----------
+
+@app.get("/", include_in_schema=False)
+async def raiz():
+    return RedirectResponse("/app")
+
+
+@app.get("/login", response_class=HTMLResponse)
+async def login_form():
+    return _fixture("login.html")
+
+
+@app.post("/login")
+async def login(request: Request):
+    form = await request.form()
+    await demorar('login')
+    if not form.get('userName') or not form.get('password'):
+        return RedirectResponse("/login?error=1", status_code=303)
+    token = secrets.token_hex(16)
+    estado.sesiones.add(token)
+    respuesta = RedirectResponse("/app", status_code=303)
+    respuesta.set_cookie(COOKIE_SESION, token, httponly=True)
+    return respuesta
+
+
+@app.get("/app", response_class=HTMLResponse)
+async def aplicacion(request: Request):
+    if not _autenticado(request):
+        return RedirectResponse("/login")
+    return _fixture("app.html")
+
+
+@app.get("/ui/{pantalla}", response_class=HTMLResponse)
+async def pantalla(pantalla: str, request: Request):
+    if not _autenticado(request):
+        return HTMLResponse("Sesión vencida", status_code=401)
+    archivo = {'facturas': 'facturas.html', 'impresion': 'impresion.html', 'mail': 'mail.html', 'editor': 'editor.html'}.get(pantalla)
+    if not archivo:
+        return HTMLResponse("No encontrado", status_code=404)
+    return _fixture(archivo)
+
+
+# GIF transparente de 1x1 para los íconos de las grillas
+_GIF_1X1 = bytes.fromhex('47494638396101000100800000ffffff00000021f90401000000002c00000000010001000002024401003b')
+
+
+@app.get("/static/{nombre}.gif", include_in_schema=False)
+async def icono(nombre: str):
+    return Response(_GIF_1X1, media_type='image/gif')
+
+
+# ---------- XHR de las pantallas ----------
+
+@app.get("/ui/api/empresa")
+async def get_empresa(request: Request):
+    return {'empresas': list(EMPRESAS), 'actual': estado.empresa_actual.get(request.cookies.get(COOKIE_SESION), EMPRESAS[0])}
+
+
+@app.post("/ui/api/empresa")
+async def set_empresa(request: Request):
+    datos = await request.json()
+    estado.empresa_actual[request.cookies.get(COOKIE_SESION)] = datos.get('empresa')
+    return {'actual': datos.get('empresa')}
+
+
+@app.get("/ui/api/operaciones")
+async def operaciones(request: Request, comprobante: str = ''):
+    """Grilla de remitos pendientes del asistente (filtrable por comprobante)"""
+    await demorar('filtro' if comprobante else 'grilla')
+    empresa = estado.empresa_actual.get(request.cookies.get(COOKIE_SESION), EMPRESAS[0])
+    filas = [
+        {'comprobante': r['COMPROBANTE'], 'cliente': r['CLIENTE'], 'fecha': r['FECHACOMPROBANTE'], 'total': r['TOTALBRUTO']}
+        for r in estado.pendientes(empresa)
+        if not comprobante or comprobante in r['COMPROBANTE']
+    ]
+    return {'filas': filas}
+
+
+@app.post("/ui/api/factura/preparar")
+async def preparar_factura(request: Request):
+    datos = await request.json()
+    await demorar('preparar')
+    remito = estado.remitos.get(datos.get('comprobante'))
+    if not remito or remito['facturado']:
+        return JSONResponse({'error': 'Remito inexistente o ya facturado'}, status_code=400)
+    return {
+        'comprobante': remito['COMPROBANTE'],
+        'cliente': remito['CLIENTE'],
+        'total_bruto': f"{remito['TOTALBRUTO']:.2f}",
+        'total_retenciones': f"{estado.percepcion(remito):.2f}",
+    }
+
+
+@app.post("/ui/api/factura/guardar")
+async def guardar_factura(request: Request):
+    datos = await request.json()
+    await demorar('guardar')
+    try:
+        factura = estado.emitir_factura(datos.get('comprobante'))
+    except (KeyError, ValueError) as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    return {'id': factura['id'], 'numero': factura['numero']}
+
+
+@app.get("/ui/api/factura/{numero}/cae")
+async def cae_factura(numero: str):
+    """El CAE llega después del guardado (AFIP), con su propia latencia"""
+    factura = estado.facturas.get(numero)
+    if not factura:
+        return JSONResponse({'error': 'Factura inexistente'}, status_code=404)
+    await demorar('cae')
+    return {'cae': estado.asignar_cae(factura)}
+
+
+@app.get("/ui/api/facturas")
+async def lista_facturas(numero: str = ''):
+    return {'filas': [
+        {'numero': f['numero'], 'comprobante': f['comprobante'], 'cuit': f['cuit'], 'total': f['total_bruto'], 'mails': f['mails']}
+        for f in estado.facturas.values()
+        if not numero or numero in f['numero']
+    ]}
+
+
+@app.get("/ui/api/factura/{numero}")
+async def detalle_factura(numero: str):
+    factura = estado.facturas.get(numero)
+    if not factura:
+        return JSONResponse({'error': 'Factura inexistente'}, status_code=404)
+    return factura
+
+
+@app.post("/ui/api/factura/{numero}/mail")
+async def enviar_mail(numero: str, request: Request):
+    datos = await request.json()
+    await demorar('mail')
+    factura = estado.facturas.get(numero)
+    if not factura:
+        return JSONResponse({'error': 'Factura inexistente'}, status_code=404)
+    factura['mails'] += 1
+    factura['ultimo_mail'] = {'asunto': datos.get('asunto'), 'cuerpo': datos.get('cuerpo')}
+    return {'mails': factura['mails']}
+
+
+# ---------- API REST ----------
+
+@app.get("/api/oauth/token", response_class=PlainTextResponse)
+async def token(client_id: str = '', client_secret: str = ''):
+    await demorar('token')
+    if not client_id or not client_secret:
+        return PlainTextResponse("invalid_client", status_code=401)
+    return secrets.token_hex(16)
+
+
+@app.get("/api/reports/{nombre}")
+async def reporte(nombre: str):
+    await demorar('reporte')
+    if nombre == 'analisisDespachoVenta':
+        campos_internos = ('facturado', 'USR_FechaEntrega', 'USROCNUM')
+        return [{k: v for k, v in r.items() if k not in campos_internos} for r in estado.pendientes()]
+    if nombre == 'COMPOSICIONSALDOSCLIENTES':
+        vencimiento = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
+        return [{'COMPROBANTE': f['numero'], 'FECHACASHFLOW': vencimiento, 'CUIT': f['cuit']} for f in estado.facturas.values()]
+    return []
+
+
+@app.get("/api/pedidoVenta/{docnroint}")
+async def pedido_venta(docnroint: str):
+    await demorar('pedido')
+    remito = next((r for r in estado.remitos.values() if r['DOCNROINT'] == docnroint), None)
+    if not remito:
+        return JSONResponse({'error': 'Pedido inexistente'}, status_code=404)
+    return {'DOCNROINT': docnroint, 'USR_FechaEntrega': remito['USR_FechaEntrega'], 'USROCNUM': remito['USROCNUM']}
+
+
+def _factura_api(factura: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'DocNroInt': factura['id'],
+        'NumeroDocumento': factura['numero'],
+        'CAE': factura['cae'],
+        'TotalRetenciones': f"{factura['total_retenciones']:.2f}",
+    }
+
+
+@app.post("/api/facturaVenta")
+async def crear_factura(request: Request):
+    datos = await request.json()
+    await demorar('factura_api')
+    comprobante = datos.get('RemitoComprobante')
+    if comprobante not in estado.remitos:
+        return JSONResponse({'error': f"Remito {comprobante} inexistente"}, status_code=422)
+    try:
+        factura = estado.emitir_factura(comprobante)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=409)
+    await demorar('cae')
+    estado.asignar_cae(factura)
+    return _factura_api(factura)
+
+
+@app.get("/api/facturaVenta/{factura_id}")
+async def leer_factura(factura_id: str):
+    factura = _factura_por_id(factura_id)
+    if not factura:
+        return JSONResponse({'error': 'Factura inexistente'}, status_code=404)
+    return _factura_api(factura)
+
+
+@app.get("/alicuotas/")
+async def alicuotas(cuits: str = ''):
+    resultados = []
+    for cuit in [c.strip() for c in cuits.split(',') if c.strip()]:
+        alicuota = estado.alicuotas.get(cuit)
+        resultados.append({'cuit': cuit, 'alicuota': alicuota, 'encontrado': alicuota is not None})
+    # Igual que la API real: primero los encontrados
+    resultados.sort(key=lambda r: not r['encontrado'])
+    encontrados = sum(1 for r in resultados if r['encontrado'])
+    return {
+        'resultados': resultados,
+        'total_consultados': len(resultados),
+        'encontrados': encontrados,
+        'no_encontrados': len(resultados) - encontrados,
+    }
+
+
+# ---------- Control del fake ----------
+
+@app.get("/fake/estado")
+async def fake_estado():
+    return {
+        'config': estado.config,
+        'remitos': len(estado.remitos),
+        'pendientes': len(estado.pendientes()),
+        'facturas': list(estado.facturas.values()),
+    }
+
+
+@app.post("/fake/config")
+async def fake_config(request: Request):
+    """Cambia latencias ({'latencias': {'guardar': 1500}}), jitter o falla_cae en caliente"""
+    datos = await request.json()
+    with estado.lock:
+        estado.config['latencias'].update({k: int(v) for k, v in (datos.get('latencias') or {}).items() if k in OPERACIONES})
+        for clave in ('jitter', 'falla_cae'):
+            if clave in datos:
+                estado.config[clave] = float(datos[clave])
+    return estado.config
+
+
+@app.post("/fake/reset")
+async def fake_reset(request: Request):
+    """
+    Vuelve a generar los remitos ({'remitos': 50, 'semilla': 3}). Conserva la
+    configuración de latencias y las sesiones abiertas (la sesión guardada de
+    los scripts sigue valiendo entre corridas del benchmark).
+    """
+    try:
+        datos = await request.json()
+    except json.JSONDecodeError:
+        datos = {}
+    config, sesiones = estado.config, estado.sesiones
+    estado.reset(datos.get('remitos'), datos.get('semilla'))
+    estado.config, estado.sesiones = config, sesiones
+    return {'remitos': len(estado.remitos)}
+
+
+def main():
+    import argparse
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='Finnegans falso para pruebas de la automatización')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('FAKE_FINNEGANS_PORT', '8765')))
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,7 @@ VIDEOS_DIR = BASE_DIR / "media" / "videos"      # Para videos
 DATA_DIR = BASE_DIR / "data"                    # Para archivos de datos
 TEMP_DIR = BASE_DIR / "temp"                    # Para archivos temporales
 UPLOADS_DIR = BASE_DIR / "uploads"              # Para archivos subidos via API
+STATE_DIR = BASE_DIR / "state"                  # Estado interno (jobs, sesión): no se sirve en /data
 
 # Crear todos los directorios
 def create_directories():
@@ -0,0 +1,244 @@
+"""
+Cola de jobs de Finnegans con límite de concurrencia.
+
+Cada job abre al menos un Chromium, así que se ejecutan como mucho
+`max_concurrentes` a la vez (FINNEGANS_MAX_JOBS, o lo que permitan la memoria
+y los CPU del contenedor). Una empresa no se procesa en dos jobs a la vez: un
+job cuyas empresas están ocupadas espera en la cola sin frenar a los que
+vienen detrás. Si un job vence pero su flujo sigue corriendo en el pool de
+navegadores, sus empresas quedan reservadas hasta que el flujo termine. Un pedido idéntico a uno que todavía espera en la cola (mismas
+empresas, script, refresh_cache y webhook) no crea otro job: se le devuelve
+el job_id del que ya está encolado.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+
+class _JobEncolado:
+    def __init__(self, job_id: str, companies: List[str], script: str, webhook_url: Optional[str], refresh_cache: bool):
+        self.job_id = job_id
+        self.companies = companies
+        self.script = script
+        self.webhook_url = webhook_url
+        self.refresh_cache = refresh_cache
+        self.encolado = time.monotonic()
+        self.encolado_at = datetime.now()
+        self.pedidos = 1
+
+    @property
+    def clave(self) -> tuple:
+        return (tuple(self.companies), self.script, self.refresh_cache, self.webhook_url)
+
+
+class PlanificadorJobs:
+    """
+    Despacha los jobs encolados en orden de llegada: el primero cuyas empresas
+    estén libres, mientras haya lugar. `ejecutar(job_id, companies, webhook_url,
+    script, refresh_cache, encolado_at)` corre en un hilo propio por job.
+    """
+
+    def __init__(self, max_concurrentes: int, ejecutar: Callable):
+        self.max_concurrentes = max_concurrentes
+        self.ejecutar = ejecutar
+        self.lock = threading.Lock()
+        self.cola: List[_JobEncolado] = []
+        self.en_curso: Dict[str, _JobEncolado] = {}
+        self.empresas_en_curso: Dict[str, str] = {}
+        # Jobs vencidos cuyo flujo sigue en el pool: {job_id: future}
+        self.retenidos: Dict[str, Future] = {}
+        self.esperas: List[float] = []
+        self.coalescidos = 0
+
+    def encolar(self, job_id: str, companies: List[str], script: str, webhook_url: Optional[str] = None,
+                refresh_cache: bool = False, al_encolar: Callable[[str, datetime], None] = None) -> Tuple[str, bool]:
+        """
+        Encola el job. Retorna (job_id, coalescido): si ya había un pedido
+        idéntico en la cola se devuelve su job_id y no se encola otro.
+        `al_encolar(job_id, encolado_at)` se llama antes de que el job sea visible
+        en la cola (si falla, el job no se encola).
+        """
+        nuevo = _JobEncolado(job_id, companies, script, webhook_url, refresh_cache)
+        with self.lock:
+            for encolado in self.cola:
+                if encolado.clave == nuevo.clave:
+                    encolado.pedidos += 1
+                    self.coalescidos += 1
+                    return encolado.job_id, True
+            # Dentro del lock y antes de entrar a la cola: el job queda guardado
+            # antes de que se pueda despachar o devolver a un pedido coalescido
+            if al_encolar:
+                al_encolar(job_id, nuevo.encolado_at)
+            self.cola.append(nuevo)
+        self._despachar()
+        return job_id, False
+
+    def posicion(self, job_id: str) -> Optional[int]:
+        """Posición (1 = el próximo) del job en la cola, None si no está encolado"""
+        with self.lock:
+            for numero, encolado in enumerate(self.cola, 1):
+                if encolado.job_id == job_id:
+                    return numero
+        return None
+
+    def job_ids(self) -> List[str]:
+        """Jobs vivos de este proceso: en cola y en curso (el latido de job_store los mantiene vigentes)"""
+        with self.lock:
+            return [encolado.job_id for encolado in self.cola] + list(self.en_curso)
+
+    def retener(self, job_id: str, future: Future) -> None:
+        """
+        El job vence pero su flujo sigue corriendo en el pool: sus empresas y
+        su lugar quedan ocupados hasta que `future` termine.
+        """
+        with self.lock:
+            self.retenidos[job_id] = future
+
+    def _despachar(self):
+        with self.lock:
+            listos = []
+            for encolado in list(self.cola):
+                if len(self.en_curso) + len(listos) >= self.max_concurrentes:
+                    break
+                ocupadas = set(self.empresas_en_curso)
+                for listo in listos:
+                    ocupadas.update(listo.companies)
+                if ocupadas.intersection(encolado.companies):
+                    continue
+                self.cola.remove(encolado)
+                listos.append(encolado)
+            for listo in listos:
+                self.en_curso[listo.job_id] = listo
+                for company in listo.companies:
+                    self.empresas_en_curso[company] = listo.job_id
+                self.esperas = (self.esperas + [time.monotonic() - listo.encolado])[-200:]
+        for listo in listos:
+            threading.Thread(target=self._correr, args=(listo,), name=f"job-{listo.job_id}", daemon=True).start()
+
+    def _correr(self, job: _JobEncolado):
+        try:
+            self.ejecutar(job.job_id, job.companies, job.webhook_url, job.script, job.refresh_cache, job.encolado_at)
+        except Exception as e:
+            print(f"[jobs] Error no controlado en el job {job.job_id}: {e}")
+        finally:
+            with self.lock:
+                future = self.retenidos.get(job.job_id)
+            if future is not None and not future.done():
+                print(f"[jobs] El job {job.job_id} venció pero su flujo sigue en el pool: "
+                      f"{', '.join(job.companies)} quedan reservadas hasta que termine")
+                future.add_done_callback(lambda _: self._liberar(job))
+            else:
+                self._liberar(job)
+
+    def _liberar(self, job: _JobEncolado):
+        with self.lock:
+            self.retenidos.pop(job.job_id, None)
+            self.en_curso.pop(job.job_id, None)
+            for company in job.companies:
+                if self.empresas_en_curso.get(company) == job.job_id:
+                    del self.empresas_en_curso[company]
+        self._despachar()
+
+    def stats(self) -> dict:
+        ahora = time.monotonic()
+        with self.lock:
+            cola = [
+                {
+                    'job_id': j.job_id,
+                    'companies': j.companies,
+                    'script': j.script,
+                    'queued_at': j.encolado_at.isoformat(),
+                    'espera_segundos': round(ahora - j.encolado, 1),
+                    'pedidos': j.pedidos,
+                    # Empresas ocupadas por otro job (si está vacío, espera un lugar libre)
+                    'esperando_empresas': [c for c in j.companies if c in self.empresas_en_curso],
+                }
+                for j in self.cola
+            ]
+            en_curso = [
+                {'job_id': j.job_id, 'companies': j.companies, 'script': j.script,
+                 # Vencido, esperando que el pool termine su flujo
+                 'retenido': j.job_id in self.retenidos}
+                for j in self.en_curso.values()
+            ]
+            esperas = sorted(self.esperas)
+            coalescidos = self.coalescidos
+        return {
+            'max_concurrentes': self.max_concurrentes,
+            'en_curso': len(en_curso),
+            'en_cola': len(cola),
+            'coalescidos': coalescidos,
+            'espera_segundos': {
+                'promedio': round(sum(esperas) / len(esperas), 1) if esperas else None,
+                'p95': round(esperas[int(len(esperas) * 0.95)], 1) if esperas else None,
+                'max': round(esperas[-1], 1) if esperas else None,
+            },
+            'jobs_en_curso': en_curso,
+            'jobs_en_cola': cola,
+        }
+
+
+def _memoria_mb() -> Optional[int]:
+    """Memoria disponible para el contenedor (límite del cgroup o la del sistema)"""
+    for ruta in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(ruta) as f:
+                valor = f.read().strip()
+            # Sin límite: "max" (cgroup v2) o un número enorme (v1)
+            if valor.isdigit() and int(valor) < 1 << 50:
+                return int(valor) // (1024 * 1024)
+        except OSError:
+            pass
+    try:
+        with open('/proc/meminfo') as f:
+            for linea in f:
+                if linea.startswith('MemTotal:'):
+                    return int(linea.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_max_jobs(pool_size: int = 0) -> int:
+    """
+    Jobs de Finnegans simultáneos: FINNEGANS_MAX_JOBS; si no está definido, el
+    tamaño del pool de navegadores o lo que entra en el contenedor (un
+    Chromium por job de FINNEGANS_JOB_MEMORIA_MB, uno por CPU).
+    """
+    load_dotenv()
+    try:
+        configurado = int(os.getenv('FINNEGANS_MAX_JOBS', '0'))
+    except ValueError:
+        configurado = 0
+    if configurado > 0:
+        return configurado
+    if pool_size > 0:
+        return pool_size
+    try:
+        memoria_por_job = max(1, int(os.getenv('FINNEGANS_JOB_MEMORIA_MB', '1024')))
+    except ValueError:
+        memoria_por_job = 1024
+    limite = os.cpu_count() or 1
+    memoria = _memoria_mb()
+    if memoria:
+        limite = min(limite, memoria // memoria_por_job)
+    return max(1, limite)
+
+
+_planificador: Optional[PlanificadorJobs] = None
+_planificador_lock = threading.Lock()
+
+
+def get_planificador(ejecutar: Callable = None, pool_size: int = 0) -> PlanificadorJobs:
+    """Planificador del proceso; se crea con `ejecutar` la primera vez"""
+    global _planificador
+    with _planificador_lock:
+        if _planificador is None:
+            _planificador = PlanificadorJobs(get_max_jobs(pool_size), ejecutar)
+            print(f"[jobs] Hasta {_planificador.max_concurrentes} jobs de Finnegans simultáneos")
+        return _planificador
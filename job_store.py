@@ -0,0 +1,620 @@
+"""
+Almacenamiento persistente de los jobs de Finnegans.
+
+Reemplaza el dict en memoria `jobs_storage`: cada job es una fila de
+`finnegans_jobs` (índices por estado, empresa y fecha de inicio) y sus logs van
+a `finnegans_job_logs`, una tabla de solo inserción con una fila por línea.
+Así la memoria de la API no crece con los logs, y el estado de los jobs
+sobrevive a los reinicios y se comparte entre varios workers de uvicorn.
+
+Mientras un job corre, su salida pasa por un LogEnVivo: las últimas líneas
+quedan en un buffer circular en memoria (para seguirlas en vivo desde
+/finnegans/logs/{job_id}) y un hilo propio las guarda en la tabla por lotes.
+
+Usa PostgreSQL (la misma base de los scripts) y, si no está disponible o con
+FINNEGANS_JOBS_STORE=sqlite, un archivo SQLite local.
+"""
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+from dotenv import load_dotenv
+
+# Columnas propias de la fila; el resto del job va en `datos` (JSON)
+_COLUMNAS = ('status', 'company', 'script', 'started_at', 'finished_at', 'duration_seconds', 'success')
+# Campos del job que son logs: no se guardan en la fila
+_CAMPOS_LOG = ('logs', 'log_completo')
+
+_ESQUEMA_POSTGRES = (
+    """
+    CREATE TABLE IF NOT EXISTS finnegans_jobs (
+        job_id VARCHAR(100) PRIMARY KEY,
+        status VARCHAR(30) NOT NULL,
+        company VARCHAR(500),
+        script VARCHAR(100),
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP,
+        duration_seconds NUMERIC(12,1),
+        success BOOLEAN,
+        datos JSONB NOT NULL DEFAULT '{}'::jsonb,
+        actualizado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS finnegans_job_logs (
+        id BIGSERIAL PRIMARY KEY,
+        job_id VARCHAR(100) NOT NULL,
+        seq INTEGER NOT NULL,
+        stream VARCHAR(20) NOT NULL,
+        ts TIMESTAMP NOT NULL,
+        linea TEXT NOT NULL
+    )
+    """,
+)
+
+_ESQUEMA_SQLITE = (
+    """
+    CREATE TABLE IF NOT EXISTS finnegans_jobs (
+        job_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        company TEXT,
+        script TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        duration_seconds REAL,
+        success INTEGER,
+        datos TEXT NOT NULL DEFAULT '{}',
+        actualizado TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS finnegans_job_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        stream TEXT NOT NULL,
+        ts TEXT NOT NULL,
+        linea TEXT NOT NULL
+    )
+    """,
+)
+
+_INDICES = (
+    "CREATE INDEX IF NOT EXISTS idx_finnegans_jobs_status ON finnegans_jobs (status)",
+    "CREATE INDEX IF NOT EXISTS idx_finnegans_jobs_company ON finnegans_jobs (company)",
+    "CREATE INDEX IF NOT EXISTS idx_finnegans_jobs_started_at ON finnegans_jobs (started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_finnegans_job_logs_job_seq ON finnegans_job_logs (job_id, seq)",
+)
+
+
+def _iso(valor) -> Optional[str]:
+    if valor is None:
+        return None
+    return valor.isoformat() if hasattr(valor, 'isoformat') else str(valor)
+
+
+class JobStore:
+    """
+    Jobs y logs en PostgreSQL (`backend='postgres'`) o SQLite. Abre una
+    conexión por operación, como el resto del proyecto: se usa desde los hilos
+    de los jobs y desde los endpoints.
+    """
+
+    def __init__(self, backend: str = 'postgres', db_config: dict = None, sqlite_path: Path = None,
+                 instancia: str = None):
+        self.backend = backend
+        # Instancia de la API que crea los jobs (para marcar los suyos al reiniciar)
+        self.instancia = instancia
+        self.db_config = db_config or {}
+        self.sqlite_path = Path(sqlite_path) if sqlite_path else None
+        # Secuencia de la próxima línea de log de cada job en curso (los logs de un job los escribe un solo hilo)
+        self._seq: Dict[str, int] = {}
+        self._seq_lock = threading.Lock()
+        if backend == 'sqlite':
+            self.sqlite_path.parent.mkdir(parents=True, exist_ok=True)
+        self._crear_tablas()
+
+    # ---------- Conexión ----------
+
+    def _conectar(self):
+        if self.backend == 'sqlite':
+            conn = sqlite3.connect(str(self.sqlite_path), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            return conn
+        return psycopg2.connect(**self.db_config, connect_timeout=10)
+
+    def _sql(self, consulta: str) -> str:
+        return consulta.replace('%s', '?') if self.backend == 'sqlite' else consulta
+
+    def _ejecutar(self, consulta: str, parametros=(), muchos: bool = False, traer: bool = False):
+        conn = self._conectar()
+        try:
+            cur = conn.cursor()
+            if muchos:
+                cur.executemany(self._sql(consulta), parametros)
+            else:
+                cur.execute(self._sql(consulta), parametros)
+            filas = cur.fetchall() if traer else None
+            conn.commit()
+            return filas
+        finally:
+            conn.close()
+
+    def _crear_tablas(self):
+        conn = self._conectar()
+        try:
+            cur = conn.cursor()
+            for consulta in (_ESQUEMA_SQLITE if self.backend == 'sqlite' else _ESQUEMA_POSTGRES) + _INDICES:
+                cur.execute(consulta)
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ---------- Jobs ----------
+
+    def _upsert(self, job_id: str, job: Dict[str, Any]) -> Tuple[str, list]:
+        """(consulta, parámetros) que crean o reemplazan la fila del job"""
+        datos = {k: v for k, v in job.items() if k not in _COLUMNAS and k not in _CAMPOS_LOG and k != 'job_id'}
+        if self.instancia:
+            datos.setdefault('instancia', self.instancia)
+        fila = [job.get(c) for c in _COLUMNAS]
+        consulta = f"""
+            INSERT INTO finnegans_jobs (job_id, {', '.join(_COLUMNAS)}, datos, actualizado)
+            VALUES (%s, {', '.join(['%s'] * len(_COLUMNAS))}, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (job_id) DO UPDATE SET
+                {', '.join(f'{c} = excluded.{c}' for c in _COLUMNAS)},
+                datos = excluded.datos,
+                actualizado = CURRENT_TIMESTAMP
+            """
+        return consulta, [job_id, *fila, json.dumps(datos, ensure_ascii=False, default=str)]
+
+    def guardar(self, job_id: str, job: Dict[str, Any]) -> None:
+        """Crea o reemplaza el job (sin los logs, que van a finnegans_job_logs)"""
+        self._ejecutar(*self._upsert(job_id, job))
+
+    def actualizar(self, job_id: str, **campos) -> None:
+        """
+        Agrega o cambia campos de un job existente (p.ej. el resultado del
+        webhook). La lectura y la escritura van en una misma transacción con la
+        fila bloqueada (SELECT ... FOR UPDATE; BEGIN IMMEDIATE en SQLite): dos
+        actualizaciones simultáneas no se pisan los campos.
+        """
+        self._modificar(job_id, lambda job: job.update(campos) or True)
+
+    def _modificar(self, job_id: str, cambiar: Callable[[Dict[str, Any]], bool]) -> bool:
+        """
+        Lee el job con la fila bloqueada, lo pasa a `cambiar` y lo guarda si
+        retorna True, todo en una transacción. Retorna si se guardó.
+        """
+        conn = self._conectar()
+        try:
+            cur = conn.cursor()
+            consulta = f"SELECT job_id, {', '.join(_COLUMNAS)}, datos FROM finnegans_jobs WHERE job_id = %s"
+            if self.backend == 'sqlite':
+                # Toma el lock de escritura antes de leer (el resto de las conexiones espera)
+                conn.isolation_level = None
+                cur.execute("BEGIN IMMEDIATE")
+            else:
+                consulta += " FOR UPDATE"
+            cur.execute(self._sql(consulta), [job_id])
+            fila = cur.fetchone()
+            if fila is None:
+                conn.rollback()
+                return False
+            job = self._fila_a_job(fila)
+            if not cambiar(job):
+                conn.rollback()
+                return False
+            upsert, parametros = self._upsert(job_id, job)
+            cur.execute(self._sql(upsert), parametros)
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _fila_a_job(self, fila) -> Dict[str, Any]:
+        job_id, *columnas, datos = fila
+        job = json.loads(datos) if isinstance(datos, str) else dict(datos or {})
+        for nombre, valor in zip(_COLUMNAS, columnas):
+            if nombre in ('started_at', 'finished_at'):
+                valor = _iso(valor)
+            elif nombre == 'duration_seconds' and valor is not None:
+                valor = float(valor)
+            elif nombre == 'success' and valor is not None:
+                valor = bool(valor)
+            job[nombre] = valor
+        job['job_id'] = job_id
+        return job
+
+    def obtener(self, job_id: str) -> Optional[Dict[str, Any]]:
+        filas = self._ejecutar(
+            f"SELECT job_id, {', '.join(_COLUMNAS)}, datos FROM finnegans_jobs WHERE job_id = %s",
+            [job_id],
+            traer=True,
+        )
+        return self._fila_a_job(filas[0]) if filas else None
+
+    def listar(
+        self,
+        status: Optional[str] = None,
+        company: Optional[str] = None,
+        desde: Optional[str] = None,
+        hasta: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """(total, jobs) filtrados y ordenados por fecha de inicio descendente (los encolados primero)"""
+        condiciones, parametros = [], []
+        if status:
+            condiciones.append("status = %s")
+            parametros.append(status)
+        if company:
+            # Los jobs con varias empresas guardan "A, B" en company
+            condiciones.append("(company = %s OR ', ' || company || ', ' LIKE %s)")
+            parametros += [company, f"%, {company}, %"]
+        if desde:
+            condiciones.append("started_at >= %s")
+            parametros.append(desde)
+        if hasta:
+            condiciones.append("started_at < %s")
+            parametros.append(hasta)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        total = self._ejecutar(f"SELECT COUNT(*) FROM finnegans_jobs {where}", parametros, traer=True)[0][0]
+        filas = self._ejecutar(
+            f"""
+            SELECT job_id, {', '.join(_COLUMNAS)}, datos FROM finnegans_jobs {where}
+            ORDER BY started_at DESC NULLS FIRST
+            LIMIT %s OFFSET %s
+            """,
+            parametros + [limit, offset],
+            traer=True,
+        )
+        return total, [self._fila_a_job(f) for f in filas]
+
+    # ---------- Logs ----------
+
+    def agregar_logs(self, job_id: str, lineas: List[str], stream: str = 'script') -> None:
+        """Agrega líneas al log del job (tabla de solo inserción)"""
+        if not lineas:
+            return
+        with self._seq_lock:
+            if job_id not in self._seq:
+                filas = self._ejecutar("SELECT MAX(seq) FROM finnegans_job_logs WHERE job_id = %s", [job_id], traer=True)
+                self._seq[job_id] = filas[0][0] + 1 if filas and filas[0][0] is not None else 0
+            inicio = self._seq[job_id]
+            self._seq[job_id] += len(lineas)
+        ahora = datetime.now().isoformat()
+        self._ejecutar(
+            "INSERT INTO finnegans_job_logs (job_id, seq, stream, ts, linea) VALUES (%s, %s, %s, %s, %s)",
+            [(job_id, inicio + i, stream, ahora, linea) for i, linea in enumerate(lineas)],
+            muchos=True,
+        )
+
+    def cerrar_logs(self, job_id: str) -> None:
+        """Libera la secuencia en memoria de un job terminado"""
+        with self._seq_lock:
+            self._seq.pop(job_id, None)
+
+    def obtener_logs(self, job_id: str, desde: int = 0, limite: Optional[int] = None, stream: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Líneas del log con seq >= desde, en orden"""
+        condiciones, parametros = ["job_id = %s", "seq >= %s"], [job_id, desde]
+        if stream:
+            condiciones.append("stream = %s")
+            parametros.append(stream)
+        consulta = f"SELECT seq, stream, ts, linea FROM finnegans_job_logs WHERE {' AND '.join(condiciones)} ORDER BY seq"
+        if limite:
+            consulta += " LIMIT %s"
+            parametros.append(limite)
+        return [
+            {'seq': seq, 'stream': s, 'timestamp': _iso(ts), 'message': linea}
+            for seq, s, ts, linea in self._ejecutar(consulta, parametros, traer=True)
+        ]
+
+    # ---------- Mantenimiento ----------
+
+    def latir(self, job_ids: List[str]) -> None:
+        """Renueva el lease de los jobs vivos de este proceso (columna `actualizado`)"""
+        if job_ids:
+            self._ejecutar(
+                "UPDATE finnegans_jobs SET actualizado = CURRENT_TIMESTAMP "
+                "WHERE job_id = %s AND status IN ('queued', 'running')",
+                [(job_id,) for job_id in job_ids],
+                muchos=True,
+            )
+
+    def marcar_interrumpidos(self, lease_segundos: int, propios: bool = False) -> List[str]:
+        """
+        La cola y los jobs en curso viven en memoria de la API que los corre, que
+        renueva su lease (latir) mientras viven. Los jobs 'queued' o 'running'
+        sin latido durante `lease_segundos` (su API se cayó o se redesplegó con
+        otro hostname) pasan a 'interrupted'; con `propios`, al iniciar, también
+        los de esta instancia sin esperar el lease. Retorna sus job_id.
+        """
+        if self.backend == 'sqlite':
+            vencido, parametros = "actualizado < datetime('now', %s)", [f"-{int(lease_segundos)} seconds"]
+        else:
+            vencido, parametros = "actualizado < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'", [int(lease_segundos)]
+        filas = self._ejecutar(
+            f"SELECT job_id, {', '.join(_COLUMNAS)}, datos, {vencido} FROM finnegans_jobs "
+            "WHERE status IN ('queued', 'running')",
+            parametros,
+            traer=True,
+        )
+        candidatos = []
+        for *fila, es_vencido in filas:
+            job = self._fila_a_job(fila)
+            # Los jobs de antes de guardar la instancia se consideran propios
+            if es_vencido or (propios and job.get('instancia', self.instancia) == self.instancia):
+                candidatos.append(job['job_id'])
+
+        ahora = datetime.now()
+
+        def interrumpir(job: Dict[str, Any]) -> bool:
+            # Pudo terminar entre la consulta y el bloqueo de la fila
+            if job['status'] not in ('queued', 'running'):
+                return False
+            estado = job['status']
+            job.update(
+                status='interrupted',
+                success=False,
+                finished_at=ahora.isoformat(),
+                error=f"La API que corría el job se reinició o dejó de responder (estado {estado})",
+            )
+            if job.get('started_at'):
+                job['duration_seconds'] = round((ahora - datetime.fromisoformat(job['started_at'])).total_seconds(), 1)
+            return True
+
+        return [job_id for job_id in candidatos if self._modificar(job_id, interrumpir)]
+
+    def purgar(self, dias: int) -> int:
+        """Borra los jobs (y sus logs) iniciados hace más de `dias` días"""
+        limite = (datetime.now() - timedelta(days=dias)).isoformat()
+        viejos = self._ejecutar("SELECT job_id FROM finnegans_jobs WHERE started_at < %s", [limite], traer=True)
+        ids = [(f[0],) for f in viejos]
+        if ids:
+            self._ejecutar("DELETE FROM finnegans_job_logs WHERE job_id = %s", ids, muchos=True)
+            self._ejecutar("DELETE FROM finnegans_jobs WHERE job_id = %s", ids, muchos=True)
+        return len(ids)
+
+
+def _sacar_de_data(anterior: Path, destino: Path) -> None:
+    """Mueve la base SQLite de su ubicación anterior (pública en /data) a `destino`"""
+    if not anterior.exists() or anterior.resolve() == destino.resolve():
+        return
+    try:
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        ya_existe = destino.exists()
+        for sufijo in ('', '-wal', '-shm'):
+            viejo = anterior.with_name(anterior.name + sufijo)
+            if not viejo.exists():
+                continue
+            if ya_existe:
+                viejo.unlink()
+            else:
+                shutil.move(str(viejo), str(destino.with_name(destino.name + sufijo)))
+        print(f"[jobs] {anterior} movido fuera del directorio público: {destino}")
+    except Exception as e:
+        print(f"[jobs] No se pudo sacar {anterior} del directorio público: {e}")
+
+
+_store: Optional[JobStore] = None
+_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    """
+    Store de jobs del proceso. FINNEGANS_JOBS_STORE=postgres (por defecto) usa
+    la base de DB_*; si no se puede conectar, o con `sqlite`, usa
+    FINNEGANS_JOBS_SQLITE (state/finnegans_jobs.db: tiene los logs completos
+    de los jobs, nunca en data/, que la API sirve sin autenticación).
+    """
+    global _store
+    with _store_lock:
+        if _store is not None:
+            return _store
+        load_dotenv()
+        from file_manager import DATA_DIR, STATE_DIR
+
+        sqlite_path = Path(os.getenv('FINNEGANS_JOBS_SQLITE') or Path(os.getenv('FINNEGANS_STATE_DIR') or STATE_DIR) / "finnegans_jobs.db")
+        _sacar_de_data(DATA_DIR / "finnegans_jobs.db", sqlite_path)
+        instancia = os.getenv('FINNEGANS_INSTANCE_ID') or socket.gethostname()
+        if os.getenv('FINNEGANS_JOBS_STORE', 'postgres').strip().lower() != 'sqlite':
+            db_config = {
+                'host': os.getenv('DB_HOST', 'localhost'),
+                'port': os.getenv('DB_PORT', '5432'),
+                'database': os.getenv('DB_NAME', 'railway'),
+                'user': os.getenv('DB_USER', 'postgres'),
+                'password': os.getenv('DB_PASSWORD', ''),
+            }
+            try:
+                _store = JobStore('postgres', db_config=db_config, instancia=instancia)
+            except Exception as e:
+                print(f"[jobs] PostgreSQL no disponible para los jobs ({e}), se usa SQLite en {sqlite_path}")
+        if _store is None:
+            _store = JobStore('sqlite', sqlite_path=sqlite_path, instancia=instancia)
+        try:
+            dias = int(os.getenv('FINNEGANS_JOBS_RETENCION_DIAS', '90'))
+            if dias > 0:
+                borrados = _store.purgar(dias)
+                if borrados:
+                    print(f"[jobs] {borrados} jobs de más de {dias} días eliminados")
+        except Exception as e:
+            print(f"[jobs] No se pudieron purgar los jobs viejos: {e}")
+        return _store
+
+
+def get_lease_segundos() -> int:
+    """Segundos sin latido tras los que un job 'queued'/'running' se da por interrumpido"""
+    load_dotenv()
+    return max(30, int(os.getenv('FINNEGANS_JOB_LEASE_S', '120')))
+
+
+_latido_detener = threading.Event()
+_latido_hilo: Optional[threading.Thread] = None
+
+
+def iniciar_latido(job_ids_vivos: Callable[[], List[str]]):
+    """
+    Cada tercio del lease renueva los jobs vivos de este proceso y marca
+    'interrupted' los que nadie renueva (p.ej. los de un contenedor anterior,
+    aunque se haya redesplegado con otro hostname). Al iniciar marca además
+    los de esta instancia sin esperar el lease.
+    """
+    global _latido_hilo
+    if _latido_hilo is not None:
+        return
+    lease = get_lease_segundos()
+
+    def loop():
+        propios = True
+        while True:
+            try:
+                store = get_job_store()
+                store.latir(job_ids_vivos())
+                interrumpidos = store.marcar_interrumpidos(lease, propios=propios)
+                propios = False
+                if interrumpidos:
+                    print(f"[jobs] {len(interrumpidos)} jobs interrumpidos (reinicio o sin latido por {lease}s): {', '.join(interrumpidos)}")
+            except Exception as e:
+                print(f"[jobs] Error en el latido de los jobs: {e}")
+            if _latido_detener.wait(lease / 3):
+                return
+
+    _latido_detener.clear()
+    _latido_hilo = threading.Thread(target=loop, name="jobs-latido", daemon=True)
+    _latido_hilo.start()
+
+
+def detener_latido():
+    global _latido_hilo
+    _latido_detener.set()
+    _latido_hilo = None
+
+
+class LogEnVivo:
+    """
+    Salida de un job en curso, línea por línea. Las últimas `maximo` líneas
+    quedan en memoria y un hilo escritor las guarda en finnegans_job_logs cada
+    `lote` líneas o `intervalo` segundos: quien lee la salida del script nunca
+    espera a la base. Es el único que escribe el log del script mientras el
+    job corre, así que los seq coinciden con los de la tabla.
+    """
+
+    def __init__(self, store: JobStore, job_id: str, maximo: int = 2000, lote: int = 50, intervalo: float = 1.0):
+        self.store = store
+        self.job_id = job_id
+        self.lineas = deque(maxlen=max(maximo, lote))
+        self.lote = lote
+        self.intervalo = intervalo
+        self.pendientes: List[str] = []
+        self.parcial = ''
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.guardado_lock = threading.Lock()
+        self.hay_lote = threading.Event()
+        self.cerrado = threading.Event()
+        self.escritor = threading.Thread(target=self._escribir_lotes, name=f"log-{job_id}", daemon=True)
+        self.escritor.start()
+
+    def escribir(self, texto: str) -> None:
+        """Agrega texto de la salida (puede traer varias líneas o una línea incompleta)"""
+        *completas, self.parcial = (self.parcial + texto).split('\n')
+        for linea in completas:
+            self.agregar(linea)
+
+    def agregar(self, linea: str) -> None:
+        linea = linea.rstrip('\r')
+        with self.lock:
+            self.lineas.append({
+                'seq': self.seq,
+                'stream': 'script',
+                'timestamp': datetime.now().isoformat(),
+                'message': linea,
+            })
+            self.seq += 1
+            self.pendientes.append(linea)
+            lote_completo = len(self.pendientes) >= self.lote
+        if lote_completo:
+            self.hay_lote.set()
+
+    def _escribir_lotes(self) -> None:
+        """Hilo escritor: guarda lo pendiente al completarse un lote o cada `intervalo` segundos"""
+        while not self.cerrado.is_set():
+            self.hay_lote.wait(self.intervalo)
+            self.hay_lote.clear()
+            self.guardar()
+
+    def guardar(self) -> None:
+        # Los lotes se insertan en orden: la tabla asigna los seq en el orden de llegada
+        with self.guardado_lock:
+            with self.lock:
+                lineas, self.pendientes = self.pendientes, []
+            if not lineas:
+                return
+            try:
+                self.store.agregar_logs(self.job_id, lineas, 'script')
+            except Exception as e:
+                print(f"[jobs] No se pudo guardar el log de {self.job_id}: {e}")
+
+    def cerrar(self) -> None:
+        """Agrega la última línea incompleta, detiene el hilo escritor y guarda lo pendiente"""
+        if self.parcial:
+            self.agregar(self.parcial)
+            self.parcial = ''
+        self.cerrado.set()
+        self.hay_lote.set()
+        self.escritor.join()
+        self.guardar()
+
+    def desde(self, seq: int) -> Optional[List[Dict[str, Any]]]:
+        """Líneas con seq >= `seq`, o None si `seq` ya salió del buffer (hay que leerlas de la tabla)"""
+        with self.lock:
+            if self.lineas and seq < self.lineas[0]['seq']:
+                return None
+            return [linea for linea in self.lineas if linea['seq'] >= seq]
+
+    def ultimas(self) -> str:
+        """Texto de las líneas que siguen en el buffer"""
+        with self.lock:
+            return '\n'.join(linea['message'] for linea in self.lineas)
+
+
+_en_vivo: Dict[str, LogEnVivo] = {}
+_en_vivo_lock = threading.Lock()
+
+
+def abrir_log_en_vivo(job_id: str) -> LogEnVivo:
+    """Crea el log en vivo del job (FINNEGANS_LOG_BUFFER líneas en memoria)"""
+    try:
+        maximo = int(os.getenv('FINNEGANS_LOG_BUFFER', '2000'))
+    except ValueError:
+        maximo = 2000
+    log = LogEnVivo(get_job_store(), job_id, maximo=maximo)
+    with _en_vivo_lock:
+        _en_vivo[job_id] = log
+    return log
+
+
+def get_log_en_vivo(job_id: str) -> Optional[LogEnVivo]:
+    with _en_vivo_lock:
+        return _en_vivo.get(job_id)
+
+
+def cerrar_log_en_vivo(job_id: str) -> None:
+    """Cierra el log en vivo del job; las próximas lecturas van a la tabla"""
+    log = get_log_en_vivo(job_id)
+    if log is not None:
+        log.cerrar()
+        with _en_vivo_lock:
+            _en_vivo.pop(job_id, None)
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 # pip install psycopg2-binary python-dotenv requests
-import os, sys, psycopg2, time, requests
+import os, sys, psycopg2, time
 from datetime import datetime
 from dotenv import load_dotenv
+from webhooks import encolar_webhook, entregar
 
 SQL_CREATE = """
 DROP TABLE IF EXISTS padron_rgs_raw;
@@ -114,8 +115,15 @@ def enviar_evento(nombre_archivo, estado, mensaje=None, fecha_hora=None):
             body["mensaje"] = mensaje
         
         webhook_url = os.getenv('WEBHOOK_URL', 'https://primary-production-bixen.up.railway.app/webhook-test/event_info')
-        response = requests.post(webhook_url, json=body, timeout=10)
-        print_with_timestamp(f"Evento enviado: {estado} - Status: {response.status_code}")
+        # Envío directo; si falla se encola y lo reintenta el entregador de la API
+        # (webhooks.py): solo se entrega si la API está corriendo con la misma base
+        ok, status, error, _ = entregar(webhook_url, body, comprimir=False, timeout=10)
+        if ok:
+            print_with_timestamp(f"Evento enviado: {estado} - Status: {status}")
+            return
+        print_with_timestamp(f"No se pudo enviar el evento {estado} ({error})")
+        if encolar_webhook(webhook_url, body, origen='padron_dgr', referencia=nombre_archivo):
+            print_with_timestamp(f"Evento encolado para reintentar: {estado}")
         
     except Exception as e:
         print_with_timestamp(f"Error al enviar evento: {e}")
@@ -1,3 +1,4 @@
+import json
 import os
 import threading
 import psycopg2
@@ -113,7 +114,7 @@ def guardar_factura_generada(
             conn.close()
 
 
-def get_facturas_envio_pendiente() -> list[dict]:
+def get_facturas_envio_pendiente(empresa: str = 'Das Dach') -> list[dict]:
     conn = None
     try:
         conn = psycopg2.connect(**get_db_config())
@@ -128,7 +129,7 @@ def get_facturas_envio_pendiente() -> list[dict]:
                   AND nro_cae IS NOT NULL
                   AND nro_cae <> ''
                 """,
-                ('Das Dach', 'Generado'),
+                (empresa, 'Generado'),
             )
             return cur.fetchall()
     except Exception as e:
@@ -178,3 +179,386 @@ def update_factura_estado(factura_id: int | None, comprobante: str | None, estad
                 conn.close()
             except Exception:
                 pass
+
+
+
+def _ensure_spans_table(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS finnegans_spans (
+            id BIGSERIAL PRIMARY KEY,
+            run_id VARCHAR(100) NOT NULL,
+            empresa VARCHAR(200),
+            flujo VARCHAR(50),
+            paso VARCHAR(100) NOT NULL,
+            inicio TIMESTAMP NOT NULL,
+            duracion_ms NUMERIC(12,1) NOT NULL,
+            ok BOOLEAN NOT NULL,
+            atributos JSONB
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_finnegans_spans_paso_inicio ON finnegans_spans (paso, inicio)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_finnegans_spans_empresa_inicio ON finnegans_spans (empresa, inicio)")
+
+
+def guardar_spans(spans: list[dict], empresa: str, flujo: str) -> None:
+    """Inserta los spans de una ejecución en finnegans_spans. Propaga los errores de conexión."""
+    from psycopg2.extras import Json, execute_values
+
+    base = ('run_id', 'paso', 'inicio', 'duracion_ms', 'ok')
+    filas = [
+        (
+            s['run_id'], empresa, flujo, s['paso'], s['inicio'], s['duracion_ms'], s['ok'],
+            Json({k: v for k, v in s.items() if k not in base}, dumps=lambda o: json.dumps(o, default=str)),
+        )
+        for s in spans
+    ]
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor() as cur:
+            _ensure_spans_table(cur)
+            execute_values(
+                cur,
+                """
+                INSERT INTO finnegans_spans (run_id, empresa, flujo, paso, inicio, duracion_ms, ok, atributos)
+                VALUES %s
+                """,
+                filas,
+            )
+        conn.commit()
+        print_with_time(f"{len(filas)} spans guardados en PostgreSQL")
+    finally:
+        conn.close()
+
+
+def _ensure_progreso_table(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS facturacion_progreso (
+            run_id VARCHAR(100) NOT NULL,
+            empresa VARCHAR(200) NOT NULL,
+            comprobante VARCHAR(100) NOT NULL,
+            docnroint VARCHAR(100),
+            estado VARCHAR(30) NOT NULL,
+            detalle TEXT,
+            historial JSONB NOT NULL DEFAULT '[]'::jsonb,
+            creado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            actualizado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (run_id, comprobante)
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_facturacion_progreso_empresa ON facturacion_progreso (empresa, comprobante, actualizado)")
+
+
+def get_progreso_remitos(empresa: str, comprobantes: list[str], dias: int = 7) -> dict:
+    """
+    Estado de los remitos en ejecuciones anteriores de la empresa:
+    {comprobante: {'run_id', 'estado', 'fallos', 'numero_factura', 'estado_factura'}}.
+    `estado` es el último estado registrado en facturacion_progreso y
+    `numero_factura`/`estado_factura` salen de facturas_generadas.
+    Propaga los errores de conexión.
+    """
+    if not comprobantes:
+        return {}
+    _ensure_facturas_table()
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            _ensure_progreso_table(cur)
+            conn.commit()
+            cur.execute(
+                """
+                SELECT comprobante,
+                       (array_agg(run_id ORDER BY actualizado DESC))[1] AS run_id,
+                       (array_agg(estado ORDER BY actualizado DESC))[1] AS estado,
+                       COUNT(*) FILTER (WHERE estado IN ('fallido', 'en_curso')) AS fallos
+                FROM facturacion_progreso
+                WHERE empresa = %s
+                  AND comprobante = ANY(%s)
+                  AND actualizado > NOW() - make_interval(days => %s)
+                GROUP BY comprobante
+                """,
+                (empresa, list(comprobantes), dias),
+            )
+            progreso = {row['comprobante']: dict(row) for row in cur.fetchall()}
+            cur.execute(
+                """
+                SELECT DISTINCT ON (comprobante) comprobante, numero_factura, estado
+                FROM facturas_generadas
+                WHERE empresa = %s
+                  AND comprobante = ANY(%s)
+                ORDER BY comprobante, fecha_hora DESC
+                """,
+                (empresa, list(comprobantes)),
+            )
+            for row in cur.fetchall():
+                registro = progreso.setdefault(row['comprobante'], {'comprobante': row['comprobante'], 'run_id': None, 'estado': None, 'fallos': 0})
+                registro['numero_factura'] = row['numero_factura']
+                registro['estado_factura'] = row['estado']
+        return progreso
+    finally:
+        conn.close()
+
+
+def registrar_progreso(run_id: str, empresa: str, remitos: list[dict], estado: str, detalle: str | None = None) -> None:
+    """
+    Registra la transición de estado de los remitos en la ejecución `run_id`
+    (alta si no existían). Cada transición se agrega al historial de la fila.
+    Propaga los errores de conexión.
+    """
+    from psycopg2.extras import execute_values
+
+    if not remitos:
+        return
+    transicion = json.dumps([{'estado': estado, 'fecha': datetime.datetime.now().isoformat(), 'detalle': detalle}])
+    filas = [
+        (run_id, empresa, r['comprobante'], r.get('docnroint'), estado, detalle, transicion)
+        for r in remitos
+    ]
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor() as cur:
+            _ensure_progreso_table(cur)
+            execute_values(
+                cur,
+                """
+                INSERT INTO facturacion_progreso (run_id, empresa, comprobante, docnroint, estado, detalle, historial)
+                VALUES %s
+                ON CONFLICT (run_id, comprobante) DO UPDATE
+                SET estado = EXCLUDED.estado,
+                    detalle = EXCLUDED.detalle,
+                    historial = facturacion_progreso.historial || EXCLUDED.historial,
+                    actualizado = CURRENT_TIMESTAMP
+                """,
+                filas,
+                template="(%s, %s, %s, %s, %s, %s, %s::jsonb)",
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _ensure_timeouts_table(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS finnegans_timeouts (
+            empresa VARCHAR(200) NOT NULL,
+            paso VARCHAR(100) NOT NULL,
+            timeout_ms INTEGER NOT NULL,
+            percentil_ms NUMERIC(12,1) NOT NULL,
+            muestras INTEGER NOT NULL,
+            actualizado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (empresa, paso)
+        )
+        """
+    )
+
+
+def get_timeouts_pasos(empresa: str) -> dict:
+    """{paso: timeout_ms} aprendidos para la empresa. Propaga los errores de conexión."""
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor() as cur:
+            _ensure_timeouts_table(cur)
+            cur.execute("SELECT paso, timeout_ms FROM finnegans_timeouts WHERE empresa = %s", (empresa,))
+            filas = cur.fetchall()
+        conn.commit()
+        return {paso: int(timeout_ms) for paso, timeout_ms in filas}
+    finally:
+        conn.close()
+
+
+def actualizar_timeouts_pasos(
+    empresa: str,
+    percentil: float,
+    factor: float,
+    min_ms: int,
+    max_ms: int,
+    muestras: int,
+    dias: int,
+    paso_ejecucion: str = 'ejecucion',
+    max_ejecucion_ms: int = 7200000,
+    muestras_ejecucion: int = 5,
+) -> None:
+    """
+    Recalcula desde finnegans_spans (últimos `dias`) el timeout de cada paso
+    de la empresa: percentil x factor acotado entre min_ms y max_ms, para los
+    pasos con al menos `muestras` registros. Entran también los pasos que no
+    terminaron bien: un timeout dura lo que duraba el límite, y dejarlos afuera
+    haría que el aprendido solo viera los días rápidos. La
+    duración total de cada ejecución se guarda como `<paso_ejecucion>.<flujo>`.
+    """
+    parametros = {
+        'empresa': empresa, 'percentil': percentil, 'factor': factor, 'min_ms': min_ms, 'max_ms': max_ms,
+        'muestras': muestras, 'dias': dias, 'paso_ejecucion': paso_ejecucion,
+        'max_ejecucion_ms': max_ejecucion_ms, 'muestras_ejecucion': muestras_ejecucion,
+    }
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor() as cur:
+            _ensure_spans_table(cur)
+            _ensure_timeouts_table(cur)
+            cur.execute(
+                """
+                INSERT INTO finnegans_timeouts (empresa, paso, timeout_ms, percentil_ms, muestras, actualizado)
+                SELECT empresa, paso,
+                       LEAST(GREATEST(p * %(factor)s, %(min_ms)s), %(max_ms)s),
+                       p, n, NOW()
+                FROM (
+                    SELECT empresa, paso, COUNT(*) AS n,
+                           PERCENTILE_CONT(%(percentil)s) WITHIN GROUP (ORDER BY duracion_ms) AS p
+                    FROM finnegans_spans
+                    WHERE empresa = %(empresa)s
+                      AND inicio >= NOW() - (%(dias)s * INTERVAL '1 day')
+                    GROUP BY empresa, paso
+                    HAVING COUNT(*) >= %(muestras)s
+                ) pasos
+                UNION ALL
+                SELECT empresa, %(paso_ejecucion)s || '.' || flujo,
+                       LEAST(p * %(factor)s, %(max_ejecucion_ms)s),
+                       p, n, NOW()
+                FROM (
+                    SELECT empresa, flujo, COUNT(*) AS n,
+                           PERCENTILE_CONT(%(percentil)s) WITHIN GROUP (ORDER BY total_ms) AS p
+                    FROM (
+                        SELECT run_id, empresa, flujo,
+                               EXTRACT(EPOCH FROM MAX(inicio + duracion_ms * INTERVAL '1 millisecond') - MIN(inicio)) * 1000 AS total_ms
+                        FROM finnegans_spans
+                        WHERE empresa = %(empresa)s AND flujo IS NOT NULL
+                          AND inicio >= NOW() - (%(dias)s * INTERVAL '1 day')
+                        GROUP BY run_id, empresa, flujo
+                    ) ejecuciones
+                    GROUP BY empresa, flujo
+                    HAVING COUNT(*) >= %(muestras_ejecucion)s
+                ) totales
+                ON CONFLICT (empresa, paso) DO UPDATE SET
+                    timeout_ms = EXCLUDED.timeout_ms,
+                    percentil_ms = EXCLUDED.percentil_ms,
+                    muestras = EXCLUDED.muestras,
+                    actualizado = EXCLUDED.actualizado
+                """,
+                parametros,
+            )
+            actualizados = cur.rowcount
+        conn.commit()
+        print_with_time(f"Timeouts aprendidos de {empresa} recalculados ({actualizados} pasos)")
+    finally:
+        conn.close()
+
+
+def _ensure_webhooks_table(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS webhook_entregas (
+            id BIGSERIAL PRIMARY KEY,
+            origen VARCHAR(50) NOT NULL,
+            referencia VARCHAR(200),
+            destino TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            comprimir BOOLEAN NOT NULL DEFAULT FALSE,
+            estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            proximo_intento TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            ultimo_status INTEGER,
+            ultimo_error TEXT,
+            creado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            entregado TIMESTAMP
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_webhook_entregas_pendientes ON webhook_entregas (estado, proximo_intento)")
+
+
+def insertar_webhook(origen: str, referencia: str | None, destino: str, payload: dict, comprimir: bool = False) -> int:
+    """Agrega una entrega pendiente a webhook_entregas. Propaga los errores de conexión."""
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor() as cur:
+            _ensure_webhooks_table(cur)
+            cur.execute(
+                """
+                INSERT INTO webhook_entregas (origen, referencia, destino, payload, comprimir)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+                """,
+                (origen, referencia, destino, json.dumps(payload, ensure_ascii=False, default=str), comprimir),
+            )
+            entrega_id = cur.fetchone()[0]
+        conn.commit()
+        return entrega_id
+    finally:
+        conn.close()
+
+
+def tomar_webhooks_pendientes(limite: int, reserva_segundos: int) -> list[dict]:
+    """
+    Entregas pendientes cuyo próximo intento ya venció. Quedan reservadas
+    `reserva_segundos` (otro proceso de la API no las toma mientras tanto).
+    """
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            _ensure_webhooks_table(cur)
+            cur.execute(
+                """
+                UPDATE webhook_entregas
+                SET proximo_intento = CURRENT_TIMESTAMP + (%s * INTERVAL '1 second')
+                WHERE id IN (
+                    SELECT id FROM webhook_entregas
+                    WHERE estado = 'pendiente' AND proximo_intento <= CURRENT_TIMESTAMP
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, origen, referencia, destino, payload, comprimir, intentos
+                """,
+                (reserva_segundos, limite),
+            )
+            filas = [dict(f) for f in cur.fetchall()]
+        conn.commit()
+        return filas
+    finally:
+        conn.close()
+
+
+def registrar_intento_webhook(entrega_id: int, estado: str, status: int | None, error: str | None,
+                              reintentar_en: int | None = None) -> None:
+    """Guarda el resultado de un intento: 'entregado', 'fallido' o 'pendiente' (reintenta en `reintentar_en` segundos)"""
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE webhook_entregas
+                SET estado = %s,
+                    intentos = intentos + 1,
+                    ultimo_status = %s,
+                    ultimo_error = %s,
+                    proximo_intento = CURRENT_TIMESTAMP + (%s * INTERVAL '1 second'),
+                    entregado = CASE WHEN %s = 'entregado' THEN CURRENT_TIMESTAMP ELSE entregado END
+                WHERE id = %s
+                """,
+                (estado, status, error, reintentar_en or 0, estado, entrega_id),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def purgar_webhooks(dias: int) -> int:
+    """Borra las entregas terminadas (entregadas o fallidas) de hace más de `dias` días"""
+    conn = psycopg2.connect(**get_db_config(), connect_timeout=10)
+    try:
+        with conn.cursor() as cur:
+            _ensure_webhooks_table(cur)
+            cur.execute(
+                "DELETE FROM webhook_entregas WHERE estado <> 'pendiente' AND creado < NOW() - (%s * INTERVAL '1 day')",
+                (dias,),
+            )
+            borradas = cur.rowcount
+        conn.commit()
+        return borradas
+    finally:
+        conn.close()
@@ -1,12 +1,23 @@
 
+import json
 import os
+import re
 import requests
+import threading
 import time
+import traceback
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
 
-from util import print_with_time, timestamp, get_video_path, save_screenshot, install_hud
+from util import print_with_time, get_state_dir, get_video_path, capturar, volcar_capturas, install_hud, sacar_de_data
+from finnegans_resultado import registrar_resultado_empresa, tomar_items, tomar_resultado
+from finnegans_spans import get_run_id, registrar_span, span
+from finnegans_timeouts import set_empresa, timeout_para
 from dotenv import load_dotenv
-from playwright.sync_api import Playwright
-import traceback
+from playwright.sync_api import Playwright, sync_playwright, TimeoutError as PlaywrightTimeoutError
 
 def get_token() -> str:
     """Obtiene el token de autenticación desde la variable de entorno"""
@@ -14,7 +25,8 @@ def get_token() -> str:
     
     client_id = os.getenv('FINNEGANS_CLIENT_ID', '')
     client_secret = os.getenv('FINNEGANS_SECRET', '')
-    url=f"https://api.teamplace.finneg.com/api/oauth/token?grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}"
+    api_url = os.getenv('FINNEGANS_API_URL', 'https://api.teamplace.finneg.com/api').rstrip('/')
+    url=f"{api_url}/oauth/token?grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}"
     
     if not client_id or not client_secret:
         print_with_time("Error: FINNEGANS_CLIENT_ID and FINNEGANS_SECRET must be set in .env file")
@@ -43,7 +55,13 @@ def select_company( page, company_labels, company_checkboxs, company_checkboxes_
             if not checked:
                 print_with_time(f"Selecting company: {company}")
                 company_checkboxes_angular.nth(i).click()
-                time.sleep(1)  # Esperar un momento para que el cambio se registre
+                # Esperar a que el cambio se registre en el checkbox
+                try:
+                    esperar("empresa seleccionada", lambda timeout: page.wait_for_function(
+                        "(el) => el.checked", arg=company_checkboxs.nth(i).element_handle(), timeout=timeout
+                    ), timeout=5000)
+                except PasoTimeout as e:
+                    print_with_time(f"{e} (se continúa)")
             else:
                 print_with_time(f"Company {company} is already selected")
                 page.keyboard.press("Escape")
@@ -54,10 +72,10 @@ def select_company( page, company_labels, company_checkboxs, company_checkboxes_
 def select_company_action(page, target_company: str) -> bool:
     print_with_time("Selecting company...")
     page.get_by_text('Empresa', exact=True).click()
-    time.sleep(1)
     
     dialog = page.locator('.mdc-dialog__container')
     company_labels = dialog.locator("label")
+    esperar("dialogo de empresas", visible(company_labels.first), timeout=10000)
     print_with_time(f"Found {company_labels.count()} companies in the list")
     
     company_checkboxs = dialog.locator("input[type='checkbox']")
@@ -76,8 +94,269 @@ def wait_for_widget_value(element, widget_name, timeout=15000):
     )
     # devolver valor una vez que está disponible
     return element.locator(selector).get_attribute("value")
+
+# ==================== Capa de esperas por condición ====================
+# Cada paso del flujo declara la condición que espera (selector, grilla estable,
+# XHR inactivos, valor de widget) con su timeout, en lugar de un time.sleep fijo.
+
+class PasoTimeout(Exception):
+    """Se agotó el timeout de la condición de un paso"""
+    pass
+
+def esperar(paso: str, condicion, timeout: int = 15000, reducible: bool = True):
+    """
+    Ejecuta `condicion(timeout_ms)` y registra cuánto tardó el paso.
+    `timeout` es el límite fijo del paso: si hay historia suficiente de la
+    empresa se usa el aprendido (finnegans_timeouts); con `reducible=False`
+    el aprendido no puede ser menor que el fijo. Los timeouts de Playwright
+    se convierten en PasoTimeout con el nombre del paso.
+    """
+    timeout = timeout_para(f"espera.{paso}", timeout, reducible=reducible)
+    inicio = time.monotonic()
+    ok = False
+    try:
+        resultado = condicion(timeout)
+        ok = True
+        return resultado
+    except PlaywrightTimeoutError as e:
+        raise PasoTimeout(f"Timeout ({timeout} ms) esperando: {paso}") from e
+    finally:
+        registrar_span(f"espera.{paso}", inicio, ok)
+
+def visible(locator):
+    return lambda timeout: locator.wait_for(state="visible", timeout=timeout)
+
+def oculto(locator):
+    return lambda timeout: locator.wait_for(state="hidden", timeout=timeout)
+
+def valor_widget(frame, widget_name):
+    return lambda timeout: wait_for_widget_value(frame, widget_name, timeout=timeout)
+
+_GRILLA_ESTABLE_JS = """
+([selector, antes, quieto, inactivo, token]) => {
+    const w = window;
+    const body = [...document.querySelectorAll(selector)].find(b => b.offsetParent !== null);
+    if (!body) return false;
+    if (w.__a4bGridToken !== token || w.__a4bGridBody !== body) {
+        if (w.__a4bGridObs) w.__a4bGridObs.disconnect();
+        w.__a4bGridToken = token;
+        w.__a4bGridBody = body;
+        w.__a4bGridLastMut = performance.now();
+        w.__a4bGridObs = new MutationObserver(() => { w.__a4bGridLastMut = performance.now(); });
+        w.__a4bGridObs.observe(body, {childList: true, subtree: true, characterData: true});
+    }
+    const celdas = body.querySelectorAll('.webix_cell').length;
+    const sinCambios = performance.now() - w.__a4bGridLastMut;
+    return (celdas !== antes && sinCambios >= quieto) || sinCambios >= inactivo;
+}
+"""
+
+def contar_celdas_grilla(frame, selector: str = "div.webix_ss_body") -> int:
+    """Cantidad de celdas de la grilla webix visible del frame"""
+    return frame.evaluate(
+        """(selector) => {
+            const body = [...document.querySelectorAll(selector)].find(b => b.offsetParent !== null);
+            return body ? body.querySelectorAll('.webix_cell').length : -1;
+        }""",
+        selector,
+    )
+
+def grilla_estable(frame, celdas_antes: int, selector: str = "div.webix_ss_body", quieto_ms: int = 250, inactivo_ms: int = 1500):
+    """
+    Condición: la grilla webix visible cambió su cantidad de celdas respecto de
+    `celdas_antes` y no tuvo mutaciones durante `quieto_ms`; o no hubo ningún
+    cambio durante `inactivo_ms` (el filtro no alteró el resultado).
+    """
+    token = f"{time.monotonic_ns()}"
+    return lambda timeout: frame.wait_for_function(
+        _GRILLA_ESTABLE_JS,
+        arg=[selector, celdas_antes, quieto_ms, inactivo_ms, token],
+        timeout=timeout,
+        polling=100,
+    )
+
+_GRILLA_FILTRADA_JS = """
+([selector, texto]) => {
+    const body = [...document.querySelectorAll(selector)].find(b => b.offsetParent !== null);
+    if (!body) return false;
+    const celda = [...body.querySelectorAll('.webix_cell')].find(c => c.textContent.trim() === texto);
+    const columna = celda && celda.closest('.webix_column');
+    if (!columna) return false;
+    return [...columna.querySelectorAll('.webix_cell')]
+        .map(c => c.textContent.trim())
+        .every(valor => valor === '' || valor === texto);
+}
+"""
+
+def grilla_filtrada(frame, texto: str, selector: str = "div.webix_ss_body"):
+    """
+    Condición: la grilla webix visible ya muestra solo filas de `texto`: una
+    celda es exactamente `texto` y el resto de su columna también (o vacía).
+    Con la grilla sin filtrar todavía (XHR lento) no se cumple, así no se
+    marca la fila de otro comprobante.
+    """
+    return lambda timeout: frame.wait_for_function(
+        _GRILLA_FILTRADA_JS,
+        arg=[selector, texto],
+        timeout=timeout,
+        polling=100,
+    )
+
+class MonitorRed:
+    """Cuenta los XHR/fetch en curso de una página para esperar a que la app quede inactiva"""
+
+    def __init__(self, page):
+        self.en_curso = set()
+        self.ultima_actividad = time.monotonic()
+        page.on("request", self._inicio)
+        page.on("requestfinished", self._fin)
+        page.on("requestfailed", self._fin)
+
+    def _inicio(self, request):
+        if request.resource_type in ("xhr", "fetch"):
+            self.en_curso.add(request)
+            self.ultima_actividad = time.monotonic()
+
+    def _fin(self, request):
+        if request in self.en_curso:
+            self.en_curso.discard(request)
+            self.ultima_actividad = time.monotonic()
+
+def instalar_monitor_red(page) -> MonitorRed:
+    monitor = getattr(page, "_a4b_monitor_red", None)
+    if monitor is None:
+        monitor = MonitorRed(page)
+        page._a4b_monitor_red = monitor
+    return monitor
+
+def xhr_inactivos(page, quieto_ms: int = 300):
+    """Condición: ningún XHR/fetch en curso durante `quieto_ms`"""
+    monitor = instalar_monitor_red(page)
+
+    def condicion(timeout):
+        limite = time.monotonic() + timeout / 1000
+        while True:
+            sin_actividad = (time.monotonic() - monitor.ultima_actividad) * 1000
+            if not monitor.en_curso and sin_actividad >= quieto_ms:
+                return True
+            if time.monotonic() > limite:
+                raise PlaywrightTimeoutError(f"{len(monitor.en_curso)} XHR en curso")
+            # wait_for_timeout procesa los eventos de Playwright mientras espera
+            page.wait_for_timeout(50)
+    return condicion
+# Claves (en minúsculas y sin separadores) con el CAE en las respuestas JSON de Finnegans
+_CLAVES_CAE = ('cae', 'cai', 'nrocae', 'numerocae', 'caenumero', 'nrocai')
+
+def _buscar_cae(datos) -> tuple:
+    """(encontrado, cae) de la primera clave de CAE del JSON; cae es None si vino vacía"""
+    if isinstance(datos, dict):
+        for clave, valor in datos.items():
+            if re.sub(r'[^a-z]', '', str(clave).lower()) in _CLAVES_CAE and not isinstance(valor, (dict, list)):
+                return True, (str(valor).strip() or None) if valor is not None else None
+        hijos = list(datos.values())
+    elif isinstance(datos, list):
+        hijos = datos
+    else:
+        return False, None
+    for hijo in hijos:
+        encontrado, cae = _buscar_cae(hijo)
+        if encontrado:
+            return encontrado, cae
+    return False, None
+
+def _get_cae_url_pattern():
+    """URLs de las respuestas de guardado / autorización de la factura (FINNEGANS_CAE_URL)"""
+    load_dotenv()
+    patron = os.getenv('FINNEGANS_CAE_URL', r'guardar|grabar|save|autoriz|authoriz')
+    try:
+        return re.compile(patron, re.IGNORECASE)
+    except re.error:
+        print_with_time(f"FINNEGANS_CAE_URL no es una expresión regular válida: {patron}")
+        return re.compile(r'guardar|grabar|save|autoriz|authoriz', re.IGNORECASE)
+
+class CapturaCae:
+    """
+    Escucha las respuestas XHR/fetch del guardado o la autorización de una
+    factura (FINNEGANS_CAE_URL) para tomar el CAE apenas Finnegans lo devuelve.
+    Solo esas respuestas cuentan: una consulta o un listado con un campo `cae`
+    vacío (o con el CAE de otra factura) no dice nada de la que se guarda. Si la
+    respuesta del guardado trae el CAE vacío (AFIP no lo otorgó) queda marcada
+    `sin_cae`. Las respuestas se leen en `revisar()`, desde el hilo del flujo,
+    no dentro del evento.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.cae = None
+        self.sin_cae = False
+        self._pendientes = []
+        self._patron_url = _get_cae_url_pattern()
+        page.on("response", self._respuesta)
+
+    def _respuesta(self, response):
+        if response.request.resource_type in ("xhr", "fetch") and self._patron_url.search(urlparse(response.url).path):
+            self._pendientes.append(response)
+
+    def revisar(self):
+        while self._pendientes:
+            response = self._pendientes.pop(0)
+            try:
+                if 'json' not in (response.headers.get('content-type') or ''):
+                    continue
+                encontrado, cae = _buscar_cae(response.json())
+            except Exception:
+                continue
+            if encontrado:
+                if cae:
+                    self.cae = cae
+                    print_with_time(f"CAE recibido en {urlparse(response.url).path}")
+                else:
+                    self.sin_cae = True
+
+    def detener(self):
+        try:
+            self.page.remove_listener("response", self._respuesta)
+        except Exception:
+            pass
+
+_CAE_WIDGET_JS = """
+() => {
+    const input = document.querySelector('div.widget[name="wdg_cai"] input');
+    return input ? (input.value || '').trim() : null;
+}
+"""
+
+def cae_disponible(frame, captura: CapturaCae):
+    """
+    Condición: el CAE llegó en la respuesta del guardado o apareció en el
+    widget wdg_cai. Retorna el CAE, o None apenas la respuesta del guardado
+    informa que no hay CAE (sin esperar el timeout).
+    """
+    def condicion(timeout):
+        limite = time.monotonic() + timeout / 1000
+        while True:
+            captura.revisar()
+            if captura.cae:
+                return captura.cae
+            valor = frame.evaluate(_CAE_WIDGET_JS)
+            if valor:
+                return valor
+            if captura.sin_cae:
+                return None
+            if time.monotonic() > limite:
+                raise PlaywrightTimeoutError("el CAE no apareció")
+            # wait_for_timeout procesa los eventos de Playwright mientras espera
+            frame.page.wait_for_timeout(100)
+    return condicion
+
 def close_finnegans_session(browser, context):
     if context:
+        stats = get_bloqueo_stats(context)
+        if stats:
+            print_with_time(
+                f"Recursos bloqueados: {stats['bloqueados']} "
+                f"(~{stats['bytes_estimados'] / 1024:.0f} KB ahorrados) por tipo: {stats['por_tipo']}"
+            )
         # Obtener el path del video antes de cerrar el contexto (solo si está habilitado)
         enable_video = os.getenv('ENABLE_VIDEO_RECORDING', 'false').lower() == 'true'
         if enable_video:
@@ -98,13 +377,16 @@ def close_finnegans_session(browser, context):
     if browser:
         browser.close()
     print_with_time("Session closed")
-def navigate_to_section(page, section_name: str) -> bool:
-    
-    time.sleep(2)
+def navigate_to_section(page, section_name: str, listo: str = None, timeout: int = 30000) -> bool:
+    """
+    Navega a una sección desde Favoritos. Si se indica `listo`, espera a que
+    ese selector aparezca en algún frame antes de dar la sección por cargada.
+    """
     print_with_time(f"Trying to navigate to: {section_name}")
     
     try:
         print_with_time(f"Navigating to {section_name} section...")
+        esperar("menu principal", visible(page.locator("#menu_button i")), timeout=timeout)
         page.locator("#menu_button i").click()
         
         page.get_by_role("button", name="Favoritos").click()
@@ -112,11 +394,10 @@ def navigate_to_section(page, section_name: str) -> bool:
         
         page.get_by_text(section_name, exact=True).click()
         #new_page = new_page_info.value
-        time.sleep(2)
-        #page.wait_for_load_state('networkidle', timeout=10000)
+        if listo:
+            esperar(f"seccion {section_name}", lambda t: wait_in_all_frames(page, listo, timeout=t), timeout=timeout)
         print_with_time(f"Navigated to {section_name} section")
-        screenshot_bytes = page.screenshot()
-        save_screenshot(screenshot_bytes, "finnegans_facturacion_loaded.png")
+        capturar(page, "finnegans_facturacion_loaded.png")
         
     
         return True
@@ -124,31 +405,183 @@ def navigate_to_section(page, section_name: str) -> bool:
         print_with_time(f"Error navigating to {section_name}: {e}")
         return False
     
-def wait_in_all_frames(page, selector, timeout=15000):
+# ==================== Navegación entre pantallas de facturas ====================
+# Máquina de estados simple: se detecta en qué pantalla está la SPA y se vuelve
+# a la lista de facturas con las acciones de la propia app (cerrar, menú). La
+# recarga completa queda solo para recuperarse después de un error.
+
+SECCION_FACTURAS = "Facturas de Venta - Das Dach"
+
+# Orden de detección: la primera pantalla cuyo selector esté visible
+_PANTALLAS = (
+    ('factura', 'div.widget[name="wdg_NumeroDocumento"], div.widget[name="wdg_TotalBruto"]'),
+    ('asistente', "input[name='WizardWorkflowSelect'], #OPERACIONSIGUIENTEPASO1_0, #OPERACIONSIGUIENTEPASO2_0, #OPERACIONFINALIZAR_0"),
+    ('lista', '#ActionNewDF'),
+)
+
+# Por run_id (los jobs del pool corren en el mismo proceso): se modifican con _stats_lock
+_navegacion_stats = {}
+_stats_lock = threading.Lock()
+# Lectura-modificación-escritura de session_meta.json / session_stats.json
+_sesion_lock = threading.Lock()
+
+def _contar_navegacion(clave: str) -> None:
+    with _stats_lock:
+        stats = _navegacion_stats.setdefault(get_run_id(), {'en_app': 0, 'menu': 0, 'recargas': 0})
+        stats[clave] += 1
+
+def tomar_navegacion_stats() -> dict:
     """
-    Espera hasta que selector exista en algún frame.
-    Devuelve el frame en el que apareció.
+    Vueltas a la lista de la ejecución actual (por acciones de la app, por el
+    menú y por recarga) desde la última vez que se tomaron; las reinicia.
     """
-    import time
-    start = time.time()
+    with _stats_lock:
+        return _navegacion_stats.pop(get_run_id(), None) or {'en_app': 0, 'menu': 0, 'recargas': 0}
 
-    while True:
+def detectar_pantalla(page) -> tuple:
+    """Retorna (pantalla, frame): 'factura', 'asistente', 'lista' o 'desconocida'"""
+    for pantalla, selector in _PANTALLAS:
         for frame in page.frames:
             try:
-                if frame.locator(selector).count() > 0:
-                    # si el objeto existe pero no es visible, esperar visibilidad
-                    try:
-                        frame.locator(selector).wait_for(state="visible", timeout=2000)
-                    except:
-                        pass
-                    return frame
-            except:
+                if frame.locator(selector).first.is_visible():
+                    return pantalla, frame
+            except Exception:
                 pass
+    return 'desconocida', None
 
-        if (time.time() - start) * 1000 > timeout:
-            raise TimeoutError(f"No apareció el selector '{selector}' en ningún frame.")
-        
-        time.sleep(0.1)
+def cerrar_factura(frame) -> None:
+    """Cierra el formulario de la factura y descarta la consulta de confirmación si aparece"""
+    frame.locator("#close").nth(1).click()
+    # Al cerrar aparece la consulta de confirmación o se vuelve a la lista
+    popup = frame.locator("div.fafpopup")
+    esperar("cerrar factura", visible(popup.or_(frame.locator("#ActionNewDF")).first))
+    if popup.is_visible():
+        frame.locator("#showAskPopupNoButton").click()
+        esperar("cerrar consulta", oculto(popup))
+
+def recargar_pagina(page) -> None:
+    """Recarga completa de la SPA: solo para recuperarse de un error"""
+    _contar_navegacion('recargas')
+    page.goto(page.url)
+
+def ir_a_lista_facturas(page, seccion: str = SECCION_FACTURAS):
+    """
+    Deja la página en la lista de facturas y retorna el frame que la contiene.
+    Desde una factura abierta se usa el botón cerrar; desde cualquier otra
+    pantalla, el menú de Favoritos (recargando antes si quedó un asistente a
+    medio completar). Lanza excepción si no se puede llegar.
+    """
+    pantalla, frame = detectar_pantalla(page)
+    print_with_time(f"Pantalla actual: {pantalla}")
+    if pantalla == 'factura':
+        try:
+            cerrar_factura(frame)
+            frame = esperar("lista de facturas", lambda t: wait_in_all_frames(page, "#ActionNewDF", timeout=t))
+            _contar_navegacion('en_app')
+            return frame
+        except Exception as e:
+            print_with_time(f"No se pudo cerrar la factura abierta: {e}")
+            recargar_pagina(page)
+    elif pantalla == 'lista':
+        _contar_navegacion('en_app')
+        return frame
+    elif pantalla == 'asistente':
+        # Asistente abandonado (p.ej. remito sin registros): no tiene acción de salida
+        recargar_pagina(page)
+
+    if not navigate_to_section(page, seccion, listo="#ActionNewDF"):
+        raise Exception(f"Failed to navigate to {seccion} section")
+    _contar_navegacion('menu')
+    return wait_in_all_frames(page, "#ActionNewDF")
+
+# ==================== Registro de frames ====================
+# Las pantallas de Finnegans viven en varios iframes. En lugar de recorrer todos
+# los frames en cada búsqueda, se recuerda en qué frame apareció cada selector y
+# se invalida la entrada cuando ese frame navega o se desconecta.
+
+# Selectores de referencia de las pantallas que se usan en los flujos
+LANDMARKS = {
+    'impresora': 'div.overDivPrint, #overDivPrint',
+    'asunto_mail': '#subjectInput',
+    'tinymce': '#tinymce',
+    'grilla_facturas': '#ActionNewDF',
+    'busqueda': 'input.TOOLBARTooltipSearch',
+    'factura_abierta': '#_onPrint',
+}
+
+class RegistroFrames:
+    """Índice selector -> frame de una página, mantenido con los eventos de frames"""
+
+    def __init__(self, page):
+        self.page = page
+        self.indice = {}
+        self.stats = {'aciertos': 0, 'escaneos': 0, 'frames_revisados': 0, 'ms': 0.0}
+        page.on("framenavigated", self._invalidar)
+        page.on("framedetached", self._invalidar)
+
+    def _invalidar(self, frame):
+        for selector in [s for s, f in self.indice.items() if f is frame]:
+            del self.indice[selector]
+
+    @staticmethod
+    def _contiene(frame, selector, visible):
+        try:
+            loc = frame.locator(selector)
+            if visible:
+                return loc.first.is_visible()
+            return loc.count() > 0
+        except Exception:
+            return False
+
+    def buscar(self, selector: str, visible: bool = True):
+        """Retorna el frame que contiene `selector` (visible si se pide) o None"""
+        selector = LANDMARKS.get(selector, selector)
+        inicio = time.monotonic()
+        try:
+            frame = self.indice.get(selector)
+            if frame is not None and not frame.is_detached() and self._contiene(frame, selector, visible):
+                self.stats['aciertos'] += 1
+                return frame
+            self.stats['escaneos'] += 1
+            for frame in self.page.frames:
+                self.stats['frames_revisados'] += 1
+                if self._contiene(frame, selector, visible):
+                    self.indice[selector] = frame
+                    return frame
+            self.indice.pop(selector, None)
+            return None
+        finally:
+            self.stats['ms'] += (time.monotonic() - inicio) * 1000
+
+    def esperar(self, selector: str, timeout: int = 15000):
+        """Espera a que `selector` sea visible en algún frame y retorna ese frame"""
+        limite = time.monotonic() + timeout / 1000
+        while True:
+            frame = self.buscar(selector)
+            if frame is not None:
+                return frame
+            if time.monotonic() > limite:
+                raise PlaywrightTimeoutError(f"No apareció el selector '{selector}' en ningún frame.")
+            # wait_for_timeout procesa los eventos de frames mientras espera
+            self.page.wait_for_timeout(100)
+
+def registro_frames(page) -> RegistroFrames:
+    registro = getattr(page, "_a4b_frames", None)
+    if registro is None:
+        registro = RegistroFrames(page)
+        page._a4b_frames = registro
+    return registro
+
+def get_frames_stats(page) -> dict:
+    """Aciertos del índice, escaneos completos, frames revisados y ms totales de resolución"""
+    return registro_frames(page).stats
+
+def wait_in_all_frames(page, selector, timeout=15000):
+    """
+    Espera hasta que selector exista en algún frame.
+    Devuelve el frame en el que apareció.
+    """
+    return registro_frames(page).esperar(selector, timeout=timeout)
     
 def find_frame_with_plantillas(page):
     for frame in page.frames:
@@ -156,78 +589,289 @@ def find_frame_with_plantillas(page):
             return frame
     return None
 
-#TODO: Modificar para buscar el frame con el div overDivPrint 
 def find_frame_with_printer(page):
-    for frame in page.frames:
-        try:
-            if frame.query_selector("div.overDivPrint") is not None:
-                return frame
-        except Exception:
-            pass
-    return None
+    return registro_frames(page).buscar('impresora', visible=False)
+
 def find_in_all_frames(page, selector):
     """
     Busca un selector dentro de todos los frames de la page.
     Retorna el frame donde el selector existe y es visible.
     """
-    for frame in page.frames:
-        loc = frame.locator(selector)
-        try:
-            if loc.count() > 0 and loc.first.is_visible():
-                return frame
-        except Exception as e:
-            traceback.print_exc()
-            print_with_time(f"Error checking frame for selector {selector}: {e}")
-            pass
-    return None  # si no se encuentra
+    return registro_frames(page).buscar(selector)
 
-def run_finnegans_login(playwright: Playwright) -> tuple:
+# ==================== Sesión persistida (storage_state) ====================
+
+def get_session_dir() -> Path:
+    """
+    Directorio donde se guarda la sesión de Finnegans (por defecto
+    state/finnegans_session). Tiene las cookies de una sesión logueada: nunca
+    dentro de data/, que la API sirve sin autenticación.
+    """
+    load_dotenv()
+    session_dir = os.getenv('FINNEGANS_SESSION_DIR')
+    if session_dir:
+        return Path(session_dir)
+    session_dir = get_state_dir() / "finnegans_session"
+    sacar_de_data("finnegans_session", session_dir)
+    return session_dir
+
+def _session_reuse_enabled() -> bool:
+    load_dotenv()
+    return os.getenv('FINNEGANS_SESSION_REUSE', 'true').lower() == 'true'
+
+def _read_json(path: Path) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print_with_time(f"Archivo de sesión ilegible ({path.name}): {e}")
+        return {}
+
+def _write_json(path: Path, data: dict) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print_with_time(f"No se pudo guardar {path.name}: {e}")
+
+def _guardar_sesion(context, page, duracion_login: float = None) -> None:
+    """
+    Persiste cookies y local storage del contexto logueado para las próximas
+    ejecuciones. `duracion_login` se informa solo después de un login completo.
+    """
+    session_dir = get_session_dir()
+    try:
+        session_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        state_path = session_dir / "storage_state.json"
+        tmp_path = session_dir / f"storage_state.{os.getpid()}.{threading.get_ident()}.tmp"
+        context.storage_state(path=str(tmp_path))
+        # Contiene las cookies de sesión: solo legible por el usuario del proceso
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, state_path)
+    except Exception as e:
+        print_with_time(f"No se pudo guardar la sesión de Finnegans: {e}")
+        return
+    with _sesion_lock:
+        meta = _read_json(session_dir / "session_meta.json")
+        logins = meta.get('duracion_logins', [])
+        if duracion_login is not None:
+            logins = logins[-19:] + [round(duracion_login, 2)]
+        _write_json(session_dir / "session_meta.json", {
+            'url': page.url,
+            'guardada': datetime.now().isoformat(),
+            'duracion_logins': logins,
+        })
+
+def _registrar_uso_sesion(tipo: str, duracion: float) -> None:
+    """
+    Acumula por día los logins completos, las sesiones reutilizadas y el tiempo
+    ahorrado (duración promedio de un login menos lo que tardó la validación).
+    """
+    session_dir = get_session_dir()
+    stats_path = session_dir / "session_stats.json"
+    with _sesion_lock:
+        stats = _read_json(stats_path)
+        dia = stats.setdefault(datetime.now().strftime('%Y-%m-%d'), {
+            'logins': 0, 'reutilizadas': 0, 'segundos_ahorrados': 0.0,
+        })
+        if tipo == 'login':
+            dia['logins'] += 1
+        else:
+            logins = _read_json(session_dir / "session_meta.json").get('duracion_logins') or []
+            ahorro = max(0.0, sum(logins) / len(logins) - duracion) if logins else 0.0
+            dia['reutilizadas'] += 1
+            dia['segundos_ahorrados'] = round(dia['segundos_ahorrados'] + ahorro, 1)
+            print_with_time(f"Sesión reutilizada en {duracion:.1f}s (ahorro estimado {ahorro:.1f}s)")
+        # Conservar solo los últimos 90 días
+        for fecha in sorted(stats)[:-90]:
+            del stats[fecha]
+        _write_json(stats_path, stats)
+    print_with_time(f"Sesiones hoy: {dia['logins']} logins, {dia['reutilizadas']} reutilizadas, {dia['segundos_ahorrados']:.0f}s ahorrados")
+
+def get_session_stats() -> dict:
+    """Retorna {fecha: {'logins', 'reutilizadas', 'segundos_ahorrados'}}"""
+    return _read_json(get_session_dir() / "session_stats.json")
+
+def _validar_sesion(page, url: str) -> bool:
+    """
+    Abre la URL de la app con la sesión guardada y verifica que cargue el menú
+    principal en lugar de redirigir al login.
+    """
+    load_dotenv()
+    timeout = int(os.getenv('FINNEGANS_SESSION_CHECK_TIMEOUT', '15000'))
+    try:
+        page.goto(url)
+        menu = page.locator("#menu_button i")
+        login = page.locator('input[name="password"]')
+        esperar("validar sesion", visible(menu.or_(login).first), timeout=timeout)
+        return menu.is_visible() and 'login' not in page.url.lower()
+    except Exception as e:
+        print_with_time(f"No se pudo validar la sesión guardada: {e}")
+        return False
+
+# ==================== Login ====================
+
+def _get_viewport() -> dict:
+    """Viewport fijo de los contextos (FINNEGANS_VIEWPORT, p.ej. 1280x720)"""
+    load_dotenv()
+    try:
+        ancho, alto = os.getenv('FINNEGANS_VIEWPORT', '1280x720').lower().split('x')
+        return {"width": int(ancho), "height": int(alto)}
+    except ValueError:
+        return {"width": 1280, "height": 720}
+
+def _get_context_options() -> dict:
     load_dotenv()
-    
-    username = os.getenv('USER_FINNEGANS')
-    password = os.getenv('PASSWORD_FINNEGANS')
-    workspace = os.getenv('WORKSPACE_FINNEGANS', '')
-    webpage = os.getenv('WEBPAGE_FINNEGANS', 'https://services.finneg.com/login')
     base_origin = 'https://core-web.finneg.com'
+    viewport = _get_viewport()
     
-    if not username or not password:
-        print_with_time("Error: USER_FINNEGANS and PASSWORD_FINNEGANS must be set in .env file")
-        return None, None, None
+    context_options = {
+        "viewport": viewport,
+        "user_agent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36',
+        "extra_http_headers": {
+            'Referer': base_origin + '/',
+            'Origin': base_origin,
+        }
+    }
     
     # Configurar grabación de video opcional
     enable_video = os.getenv('ENABLE_VIDEO_RECORDING', 'false').lower() == 'true'
-    context_options = {}
-    
     if enable_video:
         video_path = get_video_path()
         print_with_time(f"Video recording enabled - se guardará en: {video_path}")
-        context_options = {
-
-            "record_video_dir": str(video_path.parent),
-            "record_video_size": {"width": 1280, "height": 720},
-            "no_viewport": True,
-            "user_agent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36',
-            "extra_http_headers": {
-                'Referer': base_origin + '/',
-                'Origin': base_origin,
-            }
-
-        }
+        context_options["record_video_dir"] = str(video_path.parent)
+        context_options["record_video_size"] = viewport
     else:
         print_with_time("Video recording disabled")
-        context_options = {
+    return context_options
 
-            "no_viewport": True,
-            "user_agent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36',
-            "extra_http_headers": {
-                'Referer': base_origin + '/',
-                'Origin': base_origin,
-            }
+# ==================== Perfil liviano: bloqueo de recursos ====================
 
-        }
-    
-    # Configurar modo headless desde variable de entorno
-    headless_mode = os.getenv('HEADLESS', 'true').lower() == 'true'
+# Tamaño típico (bytes) por tipo de recurso para estimar lo ahorrado cuando
+# todavía no se vio ninguna respuesta de ese tipo en la sesión
+_TAMANIO_TIPICO = {'image': 25_000, 'font': 40_000, 'media': 500_000, 'script': 60_000, 'stylesheet': 20_000}
+
+# Extensiones con las que se reconoce cada tipo de recurso en la URL (bloqueo por ruta)
+_EXTENSIONES = {
+    'image': ('png', 'jpg', 'jpeg', 'gif', 'webp', 'svg', 'ico', 'bmp'),
+    'font': ('woff', 'woff2', 'ttf', 'otf', 'eot'),
+    'media': ('mp4', 'webm', 'mp3', 'ogg', 'wav', 'm4a'),
+    'stylesheet': ('css',),
+    'script': ('js',),
+}
+
+_HOSTS_RASTREO = (
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'hotjar.com',
+    'clarity.ms', 'facebook.net', 'facebook.com', 'segment.io', 'segment.com',
+    'intercom.io', 'newrelic.com', 'nr-data.net', 'sentry.io',
+)
+
+def _get_bloqueo_config() -> dict:
+    load_dotenv()
+    tipos = os.getenv('FINNEGANS_BLOCK_RESOURCES', 'image')
+    permitidos = os.getenv('FINNEGANS_ALLOWED_HOSTS', '')
+    return {
+        'activo': os.getenv('FINNEGANS_LEAN_PROFILE', 'true').lower() == 'true',
+        'chromium': os.getenv('PLAYWRIGHT_BROWSER', 'chromium').lower() not in ('firefox', 'webkit'),
+        'tipos': {t.strip() for t in tipos.split(',') if t.strip()},
+        # Si se indica, solo se permiten estos hosts (y sus subdominios)
+        'hosts_permitidos': [h.strip().lower() for h in permitidos.split(',') if h.strip()],
+    }
+
+def _args_bloqueo(config: dict) -> list:
+    """
+    Flags de Chromium del perfil liviano: imágenes desactivadas y hosts de
+    rastreo sin resolver. No interceptan pedidos, así la caché HTTP del
+    navegador sigue funcionando y nada pasa por el event loop de Python.
+    """
+    if not config['activo'] or not config['chromium']:
+        return []
+    reglas = ', '.join(f"MAP {h} ~NOTFOUND, MAP *.{h} ~NOTFOUND" for h in _HOSTS_RASTREO)
+    args = [f"--host-resolver-rules={reglas}"]
+    if 'image' in config['tipos']:
+        args.append('--blink-settings=imagesEnabled=false')
+    return args
+
+def _patron_bloqueo(config: dict) -> Optional[str]:
+    """
+    Regex de las URLs que hay que bloquear por ruta: lo que los flags de
+    Chromium no cubren (otros tipos, otros navegadores, FINNEGANS_ALLOWED_HOSTS).
+    None si no hace falta interceptar nada.
+    """
+    tipos = set(config['tipos'])
+    if config['chromium']:
+        tipos.discard('image')
+    patrones = []
+    extensiones = [e for t in sorted(tipos) for e in _EXTENSIONES.get(t, ())]
+    if extensiones:
+        patrones.append(rf"\.(?:{'|'.join(extensiones)})(?:[?#]|$)")
+    if not config['chromium']:
+        hosts = '|'.join(re.escape(h) for h in _HOSTS_RASTREO)
+        patrones.append(rf"^[a-z]+://(?:[^/?#]*\.)?(?:{hosts})(?::\d+)?(?:[/?#]|$)")
+    if config['hosts_permitidos']:
+        hosts = '|'.join(re.escape(h) for h in config['hosts_permitidos'])
+        patrones.append(rf"^(?!data:|blob:)(?![a-z]+://(?:[^/?#]*\.)?(?:{hosts})(?::\d+)?(?:[/?#]|$))")
+    return '|'.join(patrones) or None
+
+def instalar_bloqueo_recursos(context) -> None:
+    """
+    Bloquea por ruta solo las URLs que no cubren los flags de lanzamiento
+    (_args_bloqueo): extensiones de los otros tipos de FINNEGANS_BLOCK_RESOURCES
+    y, si está definido, lo que queda fuera de FINNEGANS_ALLOWED_HOSTS. El
+    patrón se le pasa a Playwright, así los pedidos que no coinciden no llegan
+    a Python; igual, con cualquier ruta Chromium desactiva su caché HTTP. Las
+    estadísticas quedan en get_bloqueo_stats(context).
+    """
+    config = _get_bloqueo_config()
+    if not config['activo']:
+        return
+    patron = _patron_bloqueo(config)
+    if patron is None:
+        return
+    stats = {'bloqueados': 0, 'por_tipo': {}, 'por_host': {}, 'bytes_estimados': 0}
+    # Bytes y cantidad de respuestas vistas por tipo para estimar el ahorro
+    vistos = {}
+    context._a4b_bloqueo = stats
+
+    def ruta(route):
+        request = route.request
+        tipo = request.resource_type
+        host = urlparse(request.url).hostname or ''
+        stats['bloqueados'] += 1
+        stats['por_tipo'][tipo] = stats['por_tipo'].get(tipo, 0) + 1
+        stats['por_host'][host] = stats['por_host'].get(host, 0) + 1
+        total, cantidad = vistos.get(tipo, (0, 0))
+        stats['bytes_estimados'] += total // cantidad if cantidad else _TAMANIO_TIPICO.get(tipo, 10_000)
+        route.abort()
+
+    def respuesta(response):
+        largo = response.headers.get('content-length')
+        if largo and largo.isdigit():
+            tipo = response.request.resource_type
+            total, cantidad = vistos.get(tipo, (0, 0))
+            vistos[tipo] = (total + int(largo), cantidad + 1)
+
+    context.route(re.compile(patron, re.IGNORECASE), ruta)
+    context.on("response", respuesta)
+
+def get_bloqueo_stats(context) -> dict:
+    return getattr(context, '_a4b_bloqueo', None) or {}
+
+def _nuevo_contexto(browser, **extra):
+    """Crea un contexto con las opciones comunes, el HUD y el perfil liviano"""
+    context = browser.new_context(**_get_context_options(), **extra)
+    instalar_bloqueo_recursos(context)
+    install_hud(context)
+    return context
+
+def launch_browser(playwright: Playwright):
+    """Lanza el navegador configurado en PLAYWRIGHT_BROWSER / HEADLESS"""
+    load_dotenv()
     browser_name = os.getenv('PLAYWRIGHT_BROWSER', 'chromium').lower()
     browser_type = {
         'chromium': playwright.chromium,
@@ -235,80 +879,447 @@ def run_finnegans_login(playwright: Playwright) -> tuple:
         'webkit': playwright.webkit,
     }.get(browser_name, playwright.chromium)
     
-    launch_options = {"headless": headless_mode}
-    if browser_type is playwright.chromium:
-        launch_options["args"] = ['--start-maximized']
-    browser = browser_type.launch(**launch_options)
-    context = browser.new_context(**context_options)
-    page = context.new_page()
-    install_hud(context)
-    try:
-        print_with_time("Navigating to Finnegans login page...")
-        page.goto(webpage)
-        
-        print_with_time("Waiting for page to load...")
-        #page.wait_for_load_state('networkidle')
+    return browser_type.launch(**_launch_options())
+
+def _launch_options() -> dict:
+    load_dotenv()
+    opciones = {"headless": os.getenv('HEADLESS', 'true').lower() == 'true'}
+    args = _args_bloqueo(_get_bloqueo_config())
+    if args:
+        opciones["args"] = args
+    return opciones
+
+def _login_form(page) -> bool:
+    """Completa y envía el formulario de login. Retorna True si se salió de la página de login"""
+    load_dotenv()
+    username = os.getenv('USER_FINNEGANS')
+    password = os.getenv('PASSWORD_FINNEGANS')
+    workspace = os.getenv('WORKSPACE_FINNEGANS', '')
+    webpage = os.getenv('WEBPAGE_FINNEGANS', 'https://services.finneg.com/login')
+
+    print_with_time("Navigating to Finnegans login page...")
+    page.goto(webpage)
     
+    print_with_time("Waiting for page to load...")
+    #page.wait_for_load_state('networkidle')
+
+
+
+    print_with_time("Looking for login form elements...")
+    esperar("formulario de login", visible(
+        page.locator('input[name="userName"], input[name="email"]').first
+    ), timeout=20000)
     
+    username_element = 'input[name="userName"]'
+    password_element = 'input[name="password"]'
+    company_element = 'input[name="empresa"]'
+    if not page.query_selector(username_element):
+        username_element = 'input[name="email"]'
+    if not page.query_selector(company_element):
+        company_element = 'input[name="workspace"]'
     
-        print_with_time("Looking for login form elements...")
-        page.wait_for_timeout(2000)
-        
-        username_element = 'input[name="userName"]'
-        password_element = 'input[name="password"]'
-        company_element = 'input[name="empresa"]'
-        if not page.query_selector(username_element):
-            username_element = 'input[name="email"]'
-        if not page.query_selector(company_element):
-            company_element = 'input[name="workspace"]'
-        
-        print_with_time("Filling credentials...")
-        page.fill(username_element, username)
-        page.fill(password_element, password)
-        
-        if workspace:
-            print_with_time(f"Filling company field with: {workspace}")
-            page.fill(company_element, workspace)
-        
-        print_with_time("Submitting login form...")
-        submit_button = page.locator('input[name="standardSubmit"]')
-        print_with_time("Taking screenshot for debugging...")
-        screenshot_bytes = page.screenshot()
-        save_screenshot(screenshot_bytes, "finnegans_login_page.png")
-        
-        submit_button.click()
+    print_with_time("Filling credentials...")
+    page.fill(username_element, username)
+    page.fill(password_element, password)
+    
+    if workspace:
+        print_with_time(f"Filling company field with: {workspace}")
+        page.fill(company_element, workspace)
+    
+    print_with_time("Submitting login form...")
+    submit_button = page.locator('input[name="standardSubmit"]')
+    print_with_time("Taking screenshot for debugging...")
+    capturar(page, "finnegans_login_page.png")
+    
+    submit_button.click()
+    
+    print_with_time("Waiting for login to complete...")
+    
+    # Esperar a que la URL cambie después del login
+    try:
+        page.wait_for_url(lambda url: 'login' not in url.lower(), timeout=15000)
+        current_url = page.url
+        print_with_time(f"Login successful! Redirected to: {current_url}")
         
-        print_with_time("Waiting for login to complete...")
+        # Tomar screenshot de la página después del login
+        capturar(page, "finnegans_post_login_page.png")
         
-        # Esperar a que la URL cambie después del login
-        try:
-            page.wait_for_url(lambda url: 'login' not in url.lower(), timeout=15000)
-            current_url = page.url
-            print_with_time(f"Login successful! Redirected to: {current_url}")
-            
-            # Tomar screenshot de la página después del login
-            screenshot_bytes = page.screenshot()
-            save_screenshot(screenshot_bytes, "finnegans_post_login_page.png")
-            
-            # Esperar a que la página se cargue completamente
-            page.wait_for_load_state('networkidle', timeout=10000)
-            
-        except Exception as redirect_error:
-            current_url = page.url
-            print_with_time(f"Login redirect timeout. Current URL: {current_url}")
-            if 'login' in current_url.lower():
-                print_with_time("Login may have failed - still on login page")
-                screenshot_bytes = page.screenshot()
-                save_screenshot(screenshot_bytes, "finnegans_login_failed_page.png")
-                return None, None, None
-            
-        time.sleep(1)
-        return browser, context, page
+        # Esperar a que la página se cargue completamente
+        page.wait_for_load_state('networkidle', timeout=10000)
         
+    except Exception:
+        current_url = page.url
+        print_with_time(f"Login redirect timeout. Current URL: {current_url}")
+        if 'login' in current_url.lower():
+            print_with_time("Login may have failed - still on login page")
+            volcar_capturas()
+            capturar(page, "finnegans_login_failed_page.png", guardar=True)
+            return False
+    return True
+
+def open_finnegans_context(browser) -> tuple:
+    """
+    Abre un contexto autenticado en Finnegans. Reutiliza la sesión guardada
+    (FINNEGANS_SESSION_REUSE) si sigue vigente y si no hace el login completo
+    y guarda la nueva sesión. Retorna (context, page) o (None, None).
+    """
+    load_dotenv()
+    if not os.getenv('USER_FINNEGANS') or not os.getenv('PASSWORD_FINNEGANS'):
+        print_with_time("Error: USER_FINNEGANS and PASSWORD_FINNEGANS must be set in .env file")
+        return None, None
+
+    session_dir = get_session_dir()
+    state_path = session_dir / "storage_state.json"
+    url_sesion = _read_json(session_dir / "session_meta.json").get('url')
+
+    if _session_reuse_enabled() and state_path.exists() and url_sesion:
+        inicio = time.monotonic()
+        context = _nuevo_contexto(browser, storage_state=str(state_path))
+        page = context.new_page()
+        print_with_time("Validando sesión guardada de Finnegans...")
+        with span('login.validar_sesion') as atributos:
+            atributos['valida'] = _validar_sesion(page, url_sesion)
+        if atributos['valida']:
+            _registrar_uso_sesion('reutilizada', time.monotonic() - inicio)
+            # Guardar las cookies renovadas por el servidor
+            _guardar_sesion(context, page)
+            return context, page
+        print_with_time("La sesión guardada expiró, se hace login completo")
+        context.close()
+
+    inicio = time.monotonic()
+    context = _nuevo_contexto(browser)
+    page = context.new_page()
+    try:
+        with span('login.formulario'):
+            login_ok = _login_form(page)
+        if not login_ok:
+            context.close()
+            return None, None
     except Exception as e:
         print_with_time(f"Error during login: {e}")
-        if context:
-            context.close()
-        if browser:
-            browser.close()
+        context.close()
+        return None, None
+
+    duracion = time.monotonic() - inicio
+    if _session_reuse_enabled():
+        _guardar_sesion(context, page, duracion)
+    _registrar_uso_sesion('login', duracion)
+    return context, page
+
+def run_finnegans_login(playwright: Playwright) -> tuple:
+    browser = launch_browser(playwright)
+    try:
+        context, page = open_finnegans_context(browser)
+    except Exception as e:
+        print_with_time(f"Error during login: {e}")
+        context, page = None, None
+    if not page:
+        browser.close()
+        return None, None, None
+    return browser, context, page
+
+
+# ---------- Supervisor de la sesión del navegador ----------
+
+# Mensajes de Playwright cuando la página, el contexto o el navegador ya no existen
+_ERRORES_SESION_CAIDA = (
+    'target page, context or browser has been closed',
+    'target closed',
+    'browser has been closed',
+    'browser has disconnected',
+    'page crashed',
+    'page closed',
+    'frame was detached',
+    'connection closed',
+)
+
+
+class SesionPerdida(Exception):
+    """El navegador se cayó más veces que las permitidas en la ejecución"""
+    pass
+
+
+def get_max_reinicios() -> int:
+    """Reinicios del navegador permitidos por ejecución (FINNEGANS_MAX_REINICIOS)"""
+    load_dotenv()
+    try:
+        return max(0, int(os.getenv('FINNEGANS_MAX_REINICIOS', '3')))
+    except ValueError:
+        return 3
+
+
+def _nuevo_login(playwright: Playwright = None, browser_type=None) -> tuple:
+    """
+    Lanza un navegador y hace login: con `playwright` vía run_finnegans_login y
+    si no (sesión del pool de la API) con el tipo de navegador indicado.
+    Retorna (browser, context, page) o (None, None, None).
+    """
+    if playwright is not None:
+        return run_finnegans_login(playwright)
+    browser = browser_type.launch(**_launch_options())
+    try:
+        context, page = open_finnegans_context(browser)
+    except Exception as e:
+        print_with_time(f"Error during login: {e}")
+        context, page = None, None
+    if not page:
+        browser.close()
         return None, None, None
+    return browser, context, page
+
+
+class SupervisorSesion:
+    """
+    Envuelve la sesión (browser, context, page) de una facturación y la
+    reconstruye si Chromium se cae, la página crashea o el frame principal
+    queda desconectado: relanza el navegador, vuelve a loguearse, selecciona
+    la empresa y deja que el flujo siga con el próximo remito. Después de
+    `max_reinicios` reinicios lanza SesionPerdida.
+
+    Con `playwright` se usa run_finnegans_login; sin él (sesión del pool de la
+    API) se relanza con el mismo tipo de navegador de la sesión original. Los
+    navegadores que abre el supervisor los cierra `cerrar()`.
+    """
+
+    def __init__(self, browser, context, page, company: str, playwright: Playwright = None, max_reinicios: int = None):
+        self.company = company
+        self.playwright = playwright
+        self.browser_type = browser.browser_type if browser else None
+        self.max_reinicios = get_max_reinicios() if max_reinicios is None else max_reinicios
+        self.reinicios = 0
+        self.propios = []
+        self._caida = None
+        self._oyentes = []
+        self._usar(browser, context, page)
+
+    def _usar(self, browser, context, page):
+        self._soltar()
+        self.browser, self.context, self.page = browser, context, page
+        self._caida = None
+        # Los eventos llegan mientras el hilo espera a Playwright
+        self._oyentes = [
+            (page, 'crash', lambda *_: self._marcar_caida('la página crasheó')),
+            (page, 'close', lambda *_: self._marcar_caida('la página se cerró')),
+            (browser, 'disconnected', lambda *_: self._marcar_caida('el navegador se desconectó')),
+        ]
+        for objeto, evento, oyente in self._oyentes:
+            objeto.on(evento, oyente)
+
+    def _soltar(self):
+        for objeto, evento, oyente in self._oyentes:
+            try:
+                objeto.remove_listener(evento, oyente)
+            except Exception:
+                pass
+        self._oyentes = []
+
+    def _marcar_caida(self, motivo: str):
+        if self._caida is None:
+            self._caida = motivo
+
+    def caida(self, error: Exception = None) -> bool:
+        """True si la sesión ya no se puede usar (evento de caída, navegador desconectado o error de Playwright)"""
+        if self._caida:
+            return True
+        try:
+            if self.page.is_closed() or not self.browser.is_connected() or self.page.main_frame.is_detached():
+                self._marcar_caida('sesión cerrada')
+                return True
+        except Exception as e:
+            self._marcar_caida(f'sesión inaccesible: {e}')
+            return True
+        if error is not None and any(m in str(error).lower() for m in _ERRORES_SESION_CAIDA):
+            self._marcar_caida(str(error).splitlines()[0][:200])
+            return True
+        return False
+
+    def reiniciar(self):
+        """Relanza el navegador, hace login y vuelve a seleccionar la empresa"""
+        motivo = self._caida or 'desconocido'
+        if self.reinicios >= self.max_reinicios:
+            raise SesionPerdida(f"Sesión del navegador perdida ({motivo}) y se alcanzó el máximo de {self.max_reinicios} reinicios")
+        self.reinicios += 1
+        print_with_time(f"Sesión del navegador caída ({motivo}). Reinicio {self.reinicios}/{self.max_reinicios}")
+        with span('sesion.reinicio', empresa=self.company, motivo=motivo, reinicio=self.reinicios):
+            anterior = self.browser
+            try:
+                self.context.close()
+            except Exception:
+                pass
+            if anterior in self.propios:
+                self.propios.remove(anterior)
+                try:
+                    anterior.close()
+                except Exception:
+                    pass
+
+            browser, context, page = _nuevo_login(self.playwright, self.browser_type)
+            if not page:
+                raise SesionPerdida(f"No se pudo volver a loguear después de la caída del navegador ({motivo})")
+            self.propios.append(browser)
+            self._usar(browser, context, page)
+            select_company_action(page, self.company)
+        print_with_time(f"Sesión restablecida en {page.url}")
+
+    def recuperar(self, error: Exception = None) -> bool:
+        """
+        Después de un error en un remito: reinicia la sesión si se cayó o recarga
+        la página si sigue viva. Retorna True si hubo reinicio.
+        """
+        if not self.caida(error):
+            try:
+                recargar_pagina(self.page)
+                return False
+            except Exception as e:
+                if not self.caida(e):
+                    raise
+        self.reiniciar()
+        return True
+
+    def cerrar(self):
+        """Cierra los navegadores abiertos por el supervisor (no la sesión original)"""
+        self._soltar()
+        for browser in self.propios:
+            try:
+                close_finnegans_session(browser, browser.contexts[0] if browser.contexts else None)
+            except Exception:
+                pass
+        self.propios = []
+
+
+# ---------- Sesión compartida entre empresas ----------
+
+class SesionCompartida:
+    """
+    Sesión de Finnegans que usan varias empresas de una misma ejecución: el
+    login se hace cuando la primera empresa lo necesita y las siguientes
+    reutilizan el navegador (cada flujo cambia de empresa con
+    select_company_action). Si el navegador se cayó entre una empresa y otra se
+    vuelve a loguear. Con `sesion` (pool de la API) se parte de esa sesión y no
+    se cierra.
+    """
+
+    def __init__(self, playwright: Playwright = None, sesion: tuple = None):
+        self.playwright = playwright
+        self.browser, self.context, self.page = sesion or (None, None, None)
+        self.browser_type = self.browser.browser_type if self.browser else None
+        self.externa = sesion is not None
+        self.url_inicio = self.page.url if self.page else None
+        self.empresas = 0
+
+    def _viva(self) -> bool:
+        try:
+            return bool(self.page) and not self.page.is_closed() and self.browser.is_connected()
+        except Exception:
+            return False
+
+    def _cerrar_propia(self):
+        if not self.externa and self.browser is not None:
+            try:
+                close_finnegans_session(self.browser, self.context)
+            except Exception:
+                pass
+        self.browser = self.context = self.page = None
+
+    def obtener(self) -> tuple:
+        """
+        Retorna (browser, context, page) lista para la próxima empresa, o
+        (None, None, None) si no se pudo loguear.
+        """
+        if self._viva():
+            if self.empresas:
+                # Volver a la pantalla inicial: no arrastrar frames ni listas de la empresa anterior
+                try:
+                    self.page.goto(self.url_inicio)
+                except Exception as e:
+                    print_with_time(f"No se pudo volver a la pantalla inicial ({e}), se vuelve a loguear")
+        if not self._viva():
+            if self.page is not None:
+                print_with_time("La sesión del navegador se cerró, se vuelve a loguear para la próxima empresa")
+            self._cerrar_propia()
+            if self.playwright is None and self.browser_type is None:
+                return None, None, None
+            self.externa = False
+            self.browser, self.context, self.page = _nuevo_login(self.playwright, self.browser_type)
+            if not self.page:
+                return None, None, None
+            self.url_inicio = self.page.url
+        self.empresas += 1
+        return self.browser, self.context, self.page
+
+    def cerrar(self):
+        """Cierra la sesión si la abrió esta ejecución (la del pool vuelve al pool)"""
+        self._cerrar_propia()
+
+
+def publicar_resumen_empresa(empresa: str, flujo: str, total: int, exitosos_lista: list, fallidos_lista: list,
+                             no_procesados_lista: list, inicio: datetime, fin: datetime, error: str = None,
+                             pasos: dict = None) -> None:
+    """
+    Agrega el resultado de una empresa al resultado estructurado de la
+    ejecución (finnegans_resultado): totales, un ítem por remito/factura con su
+    resultado, duración y datos de la factura, y el p50/p95 por paso.
+    """
+    items = tomar_items(empresa)
+    # Remitos que no llegaron a procesarse (login fallido, ya facturados, sesión perdida)
+    for fallido in fallidos_lista:
+        items.setdefault(fallido['comprobante'], {
+            'comprobante': fallido['comprobante'], 'resultado': 'fallido', 'error': str(fallido['error']).split('\n')[0],
+        })
+    for no_procesado in no_procesados_lista:
+        items.setdefault(no_procesado['comprobante'], {
+            'comprobante': no_procesado['comprobante'], 'resultado': 'no_procesado', 'razon': no_procesado.get('razon'),
+        })
+    resumen = {
+        'empresa': empresa,
+        'flujo': flujo,
+        'total_remitos': total,
+        'exitosos': len(exitosos_lista),
+        'fallidos': len(fallidos_lista),
+        'no_procesados': len(no_procesados_lista),
+        'exitosos_lista': list(exitosos_lista),
+        'fallidos_lista': [
+            {'comprobante': f['comprobante'], 'error': str(f['error']).split('\n')[0]} for f in fallidos_lista
+        ],
+        'no_procesados_lista': list(no_procesados_lista),
+        'items': list(items.values()),
+        'pasos': pasos or {},
+        'started_at': inicio.isoformat(),
+        'finished_at': fin.isoformat(),
+        'duration_seconds': round((fin - inicio).total_seconds(), 1),
+    }
+    if error:
+        resumen['error'] = error
+    registrar_resultado_empresa(resumen)
+
+
+def procesar_empresas(procesar, companies: list, sesion: tuple = None, flujo: str = None) -> Optional[dict]:
+    """
+    Ejecuta `procesar(company, compartida=...)` (process_company de
+    finnegans_login.py o finnegans_mail.py) para cada empresa, en orden y con
+    un único login. Las empresas repetidas se procesan una sola vez: una
+    empresa nunca corre dos veces en paralelo dentro de la misma sesión.
+    Retorna el resultado estructurado de la ejecución (finnegans_resultado).
+    """
+    empresas = list(dict.fromkeys(c.strip() for c in companies if c and c.strip()))
+    if len(empresas) > 1:
+        print_with_time(f"Procesando {len(empresas)} empresas en una misma sesión: {', '.join(empresas)}")
+    with (nullcontext() if sesion else sync_playwright()) as playwright:
+        compartida = SesionCompartida(playwright, sesion)
+        try:
+            for numero, company in enumerate(empresas, 1):
+                if len(empresas) > 1:
+                    print_with_time(f"===== EMPRESA {numero}/{len(empresas)}: {company} =====")
+                inicio = datetime.now()
+                set_empresa(company)
+                try:
+                    procesar(company, compartida=compartida)
+                except Exception as e:
+                    # Una empresa con error no impide procesar las siguientes
+                    print_with_time(f"!! Error procesando la empresa {company}: {e}")
+                    print_with_time(traceback.format_exc())
+                    publicar_resumen_empresa(company, flujo, 0, [], [], [], inicio, datetime.now(), error=str(e))
+        finally:
+            compartida.cerrar()
+    return tomar_resultado()
@@ -0,0 +1,172 @@
+import os
+import time
+import requests
+from urllib3.exceptions import NewConnectionError
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from util import print_with_time
+from finnegans_common import get_token
+from finnegans_reports import get_api_url
+
+# (conexión, lectura) en segundos para la creación de facturas
+FACTURA_API_TIMEOUT = (10, 120)
+
+# Códigos con los que la API rechaza el documento sin crearlo (validación).
+# Cualquier otro (408, 409, 429, 5xx...) puede llegar con la factura ya creada.
+FACTURA_API_RECHAZOS = (400, 422)
+
+# Nombres de los campos del pedido. No están verificados contra la API de
+# Finnegans: se pueden corregir con FINNEGANS_FACTURA_CAMPOS sin tocar el código.
+FACTURA_API_CAMPOS = {
+    'empresa': 'Empresa',
+    'comprobante': 'Comprobante',
+    'workflow': 'WorkflowCodigo',
+    'remito_docnroint': 'RemitoDocNroInt',
+    'remito_comprobante': 'RemitoComprobante',
+    'obtener_cae': 'ObtenerCAE',
+}
+
+
+class FacturaApiRechazada(Exception):
+    """La API rechazó el documento sin crearlo: es seguro reintentar por la UI."""
+    pass
+
+
+class FacturaApiIndeterminada(Exception):
+    """No se sabe si la factura se creó (timeout, 5xx, respuesta sin número)."""
+    pass
+
+
+def get_factura_backend() -> str:
+    """
+    Backend de creación de facturas (FINNEGANS_FACTURA_BACKEND):
+    'ui' (automatización web), 'api' (solo REST) o 'auto' (REST y UI si la API rechaza).
+    """
+    load_dotenv()
+    backend = os.getenv('FINNEGANS_FACTURA_BACKEND', 'ui').strip().lower()
+    return backend if backend in ('ui', 'api', 'auto') else 'ui'
+
+
+def _coalesce(d: Dict[str, Any], *keys: str) -> Optional[Any]:
+    for k in keys:
+        if k in d and d[k] not in (None, "", []):
+            return d[k]
+    return None
+
+
+def _parse_factura(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': _coalesce(data, 'DocNroInt', 'DOCNROINT', 'TransaccionID', 'id'),
+        'numero_factura': _coalesce(data, 'NumeroDocumento', 'NUMERODOCUMENTO', 'NumeroComprobante', 'Numero'),
+        'nro_cae': _coalesce(data, 'CAE', 'Cae', 'CAI', 'Cai', 'NroCAE'),
+        'total_retenciones': _coalesce(data, 'TotalRetenciones', 'TOTALRETENCIONES'),
+    }
+
+
+def get_factura_campos() -> Dict[str, str]:
+    """
+    Nombres de los campos del pedido: FACTURA_API_CAMPOS con los reemplazos de
+    FINNEGANS_FACTURA_CAMPOS ("clave=Campo,..."; un campo vacío no se envía).
+    """
+    load_dotenv()
+    campos = dict(FACTURA_API_CAMPOS)
+    for par in os.getenv('FINNEGANS_FACTURA_CAMPOS', '').split(','):
+        clave, _, campo = par.partition('=')
+        clave = clave.strip().lower()
+        if clave in campos:
+            campos[clave] = campo.strip()
+        elif clave:
+            print_with_time(f"FINNEGANS_FACTURA_CAMPOS: clave desconocida '{clave}' (válidas: {', '.join(campos)})")
+    return campos
+
+
+def build_factura_payload(remito: Dict[str, Any], company: str) -> Dict[str, Any]:
+    """Arma el pedido de Factura de Venta a partir del remito (mismo asistente que la UI)."""
+    load_dotenv()
+    valores = {
+        'empresa': company,
+        'comprobante': os.getenv('FINNEGANS_FACTURA_COMPROBANTE', 'Factura de Venta Electrónica 0005'),
+        'workflow': os.getenv('FINNEGANS_FACTURA_WORKFLOW', '160'),
+        'remito_docnroint': remito.get('docnroint'),
+        'remito_comprobante': remito.get('comprobante'),
+        'obtener_cae': True,
+    }
+    return {campo: valores[clave] for clave, campo in get_factura_campos().items() if campo}
+
+
+def get_factura(factura_id: Any, token: Optional[str] = None) -> Dict[str, Any]:
+    """Lee una factura creada para obtener número y CAE."""
+    load_dotenv()
+    path = os.getenv('FINNEGANS_FACTURA_API_PATH', 'facturaVenta').strip('/')
+    url = f"{get_api_url()}/{path}/{factura_id}"
+    response = requests.get(url, params={'ACCESS_TOKEN': token or get_token()}, timeout=FACTURA_API_TIMEOUT)
+    if response.status_code != 200:
+        raise FacturaApiIndeterminada(f"No se pudo leer la factura {factura_id}: {response.status_code} - {response.text[:200]}")
+    try:
+        return _parse_factura(response.json())
+    except (ValueError, AttributeError):
+        raise FacturaApiIndeterminada(f"La factura {factura_id} no es un objeto JSON válido: {response.text[:200]}")
+
+
+def crear_factura_desde_remito(remito: Dict[str, Any], company: str, cae_intentos: int = 5, cae_espera: float = 2.0) -> Dict[str, Any]:
+    """
+    Genera la Factura de Venta del remito vía REST y devuelve
+    {'id', 'numero_factura', 'nro_cae', 'total_retenciones'}.
+
+    Lanza FacturaApiRechazada si la API rechaza el documento (400/422 o error
+    antes de enviarlo) y FacturaApiIndeterminada si no se puede saber si se
+    creó (cualquier otro código que no sea 2xx).
+    Si la respuesta no trae CAE se relee la factura hasta `cae_intentos` veces;
+    si la relectura falla se retorna sin CAE (quien llama la registra como
+    'Error CAE'), nunca con una excepción que deje la factura sin registrar.
+    """
+    load_dotenv()
+    path = os.getenv('FINNEGANS_FACTURA_API_PATH', 'facturaVenta').strip('/')
+    url = f"{get_api_url()}/{path}"
+    token = get_token()
+    payload = build_factura_payload(remito, company)
+
+    print_with_time(f"Creando factura por API para remito {remito.get('comprobante')}")
+    try:
+        response = requests.post(url, params={'ACCESS_TOKEN': token}, json=payload, timeout=FACTURA_API_TIMEOUT)
+    except requests.ConnectTimeout as e:
+        raise FacturaApiRechazada(f"No se pudo conectar con la API: {e}")
+    except requests.ConnectionError as e:
+        # Solo es seguro reintentar si la conexión no llegó a establecerse
+        motivo = getattr(e.args[0], 'reason', None) if e.args else None
+        if isinstance(motivo, NewConnectionError):
+            raise FacturaApiRechazada(f"No se pudo conectar con la API: {e}")
+        raise FacturaApiIndeterminada(f"Conexión interrumpida con la API: {e}")
+    except requests.RequestException as e:
+        raise FacturaApiIndeterminada(f"Error en la llamada a la API: {e}")
+
+    if response.status_code in FACTURA_API_RECHAZOS:
+        raise FacturaApiRechazada(f"HTTP {response.status_code} - {response.text[:500]}")
+    if not 200 <= response.status_code < 300:
+        # 408, 409, 429, 5xx...: la factura pudo haberse creado, no se reintenta por la UI
+        raise FacturaApiIndeterminada(f"HTTP {response.status_code} - {response.text[:500]}")
+
+    try:
+        factura = _parse_factura(response.json())
+    except (ValueError, AttributeError):
+        raise FacturaApiIndeterminada(f"Respuesta de la API no es un objeto JSON válido: {response.text[:200]}")
+
+    for intento in range(cae_intentos):
+        if factura['numero_factura'] and factura['nro_cae']:
+            break
+        if not factura['id']:
+            break
+        time.sleep(cae_espera)
+        print_with_time(f"Releyendo factura {factura['id']} para obtener número/CAE ({intento + 1}/{cae_intentos})")
+        try:
+            releida = get_factura(factura['id'], token)
+        except (requests.RequestException, ValueError, FacturaApiIndeterminada) as e:
+            # La factura ya existe: se sigue con lo que se tiene (sin CAE queda 'Error CAE' y se aborta el lote)
+            print_with_time(f"No se pudo releer la factura {factura['id']}: {e}")
+            break
+        factura = {**factura, **{k: v for k, v in releida.items() if v}}
+
+    if not factura['numero_factura']:
+        raise FacturaApiIndeterminada(f"La API no devolvió número de factura: {response.text[:200]}")
+    return factura
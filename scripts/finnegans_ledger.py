@@ -0,0 +1,129 @@
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from util import print_with_time
+
+# Estados de un remito dentro de una ejecución (tabla facturacion_progreso)
+PENDIENTE = 'pendiente'
+EN_CURSO = 'en_curso'
+FACTURADO = 'facturado'
+NO_PROCESADO = 'no_procesado'
+FALLIDO = 'fallido'
+OMITIDO = 'omitido'
+# Quedó en curso cuando se cortó la ejecución: la factura puede existir en Finnegans
+REVISION = 'revision_manual'
+
+
+def _get_int(nombre: str, defecto: int) -> int:
+    try:
+        return max(0, int(os.getenv(nombre, str(defecto))))
+    except ValueError:
+        return defecto
+
+
+class LedgerFacturacion:
+    """
+    Registro de avance de una ejecución de facturación (run_id + comprobante).
+
+    Al arrancar consulta las ejecuciones anteriores de la empresa: los remitos
+    que ya tienen factura (facturas_generadas) o quedaron facturados se omiten,
+    los que fallaron se reintentan y el resto sigue en el orden original, así
+    una ejecución interrumpida (CAE faltante, caída del navegador, timeout del
+    job) continúa donde se cortó. Los que quedaron en curso no se reintentan:
+    la ejecución pudo cortarse a mitad del guardado, con la factura ya creada en
+    Finnegans y sin registro en facturas_generadas. Quedan en revisión manual
+    hasta que se los libere con FINNEGANS_LEDGER_REINTENTAR.
+
+    Si la base no está disponible el ledger se desactiva y se procesan todos los
+    remitos como antes.
+    """
+
+    def __init__(self, run_id: str, empresa: str):
+        load_dotenv()
+        self.run_id = run_id
+        self.empresa = empresa
+        self.activo = os.getenv('FINNEGANS_LEDGER', '1').strip().lower() not in ('0', 'false', 'no')
+        self.max_intentos = _get_int('FINNEGANS_LEDGER_MAX_INTENTOS', 3)
+        self.dias = _get_int('FINNEGANS_LEDGER_DIAS', 7)
+        # Comprobantes en revisión ya verificados en Finnegans (sin factura): se reintentan
+        self.liberados = {c.strip() for c in os.getenv('FINNEGANS_LEDGER_REINTENTAR', '').split(',') if c.strip()}
+        self._lock = threading.Lock()
+
+    def _desactivar(self, error: Exception) -> None:
+        with self._lock:
+            if self.activo:
+                self.activo = False
+                print_with_time(f"Ledger de facturación desactivado para esta ejecución: {error}")
+
+    def preparar(self, resumen: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Separa los remitos a procesar de los que se omiten por ejecuciones
+        anteriores. Retorna (a_procesar, omitidos) con omitidos como
+        [{'comprobante', 'razon'}] y registra los remitos como pendientes.
+        """
+        if not self.activo or not resumen:
+            return resumen, []
+        try:
+            from db import get_progreso_remitos
+            progreso = get_progreso_remitos(self.empresa, [r['comprobante'] for r in resumen], self.dias)
+        except Exception as e:
+            self._desactivar(e)
+            return resumen, []
+
+        a_procesar, omitidos, reintentos, ejecuciones = [], [], 0, set()
+        for remito in resumen:
+            previo = progreso.get(remito['comprobante'])
+            if not previo:
+                a_procesar.append(remito)
+                continue
+            if previo.get('run_id'):
+                ejecuciones.add(previo['run_id'])
+            if previo.get('estado_factura') or previo.get('estado') == FACTURADO:
+                numero = previo.get('numero_factura')
+                razon = f"Facturado en una ejecución anterior ({numero})" if numero else "Facturado en una ejecución anterior"
+                omitidos.append({'comprobante': remito['comprobante'], 'razon': razon, 'remito': remito, 'estado': FACTURADO})
+            elif previo.get('estado') in (EN_CURSO, REVISION) and remito['comprobante'] not in self.liberados:
+                omitidos.append({
+                    'comprobante': remito['comprobante'],
+                    'razon': "Quedó a medio facturar en una ejecución anterior: verificar en Finnegans si la factura "
+                             "existe (si no existe, liberarlo con FINNEGANS_LEDGER_REINTENTAR)",
+                    'remito': remito,
+                    'estado': REVISION,
+                })
+            elif self.max_intentos and previo.get('fallos', 0) >= self.max_intentos:
+                omitidos.append({
+                    'comprobante': remito['comprobante'],
+                    'razon': f"Falló en {previo['fallos']} ejecuciones anteriores, requiere revisión manual",
+                    'remito': remito,
+                    'estado': OMITIDO,
+                })
+            else:
+                if previo.get('estado') in (FALLIDO, EN_CURSO, REVISION):
+                    reintentos += 1
+                a_procesar.append(remito)
+
+        if ejecuciones:
+            print_with_time(
+                f"Reanudando facturación de {self.empresa} (ejecuciones anteriores: {', '.join(sorted(ejecuciones))}): "
+                f"{len(omitidos)} remitos omitidos, {reintentos} a reintentar, {len(a_procesar) - reintentos} pendientes"
+            )
+        self.registrar(a_procesar, PENDIENTE)
+        for estado in (FACTURADO, OMITIDO, REVISION):
+            # REVISION se vuelve a registrar en cada ejecución: no sale de la ventana de FINNEGANS_LEDGER_DIAS
+            self.registrar([o['remito'] for o in omitidos if o['estado'] == estado], estado, "Omitido al reanudar")
+        return a_procesar, [{'comprobante': o['comprobante'], 'razon': o['razon']} for o in omitidos]
+
+    def registrar(self, remitos: List[Dict[str, Any]], estado: str, detalle: Optional[str] = None) -> None:
+        """Registra la transición de estado de los remitos (no interrumpe la facturación si falla)"""
+        if not self.activo or not remitos:
+            return
+        try:
+            from db import registrar_progreso
+            registrar_progreso(self.run_id, self.empresa, remitos, estado, detalle)
+        except Exception as e:
+            self._desactivar(e)
+
+    def marcar(self, remito: Dict[str, Any], estado: str, detalle: Optional[str] = None) -> None:
+        self.registrar([remito], estado, detalle[:1000] if detalle else None)
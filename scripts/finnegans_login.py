@@ -1,100 +1,59 @@
 import os
 from dotenv import load_dotenv
-from playwright.sync_api import Playwright, sync_playwright
+from playwright.sync_api import sync_playwright
 import time
 import re
 import sys
 import os
 import requests
 import psycopg2
-from typing import List, Dict, Any, Optional
-from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
+import queue
 import threading
 import traceback
+from contextlib import nullcontext
+from finnegans_spans import get_run_id, publicar_spans, set_run_id, span
+from finnegans_resultado import empresas_con_error, registrar_item
+from finnegans_ledger import EN_CURSO, FACTURADO, FALLIDO, NO_PROCESADO, LedgerFacturacion
+from finnegans_timeouts import set_empresa
+from util import print_with_time, parse_fecha, capturar, iniciar_capturas, volcar_capturas, show_comprobante, hide_comprobante
+from finnegans_common import (
+    cae_disponible,
+    CapturaCae,
+    cerrar_factura,
+    close_finnegans_session,
+    contar_celdas_grilla,
+    esperar,
+    get_frames_stats,
+    get_token,
+    grilla_estable,
+    grilla_filtrada,
+    ir_a_lista_facturas,
+    navigate_to_section,
+    PasoTimeout,
+    procesar_empresas,
+    publicar_resumen_empresa,
+    run_finnegans_login,
+    select_company_action,
+    SesionCompartida,
+    SesionPerdida,
+    SupervisorSesion,
+    tomar_navegacion_stats,
+    valor_widget,
+    visible,
+    wait_in_all_frames,
+    xhr_inactivos,
+)
+from finnegans_reports import get_api_url, get_report_rows, set_force_refresh
+from finnegans_facturas_api import FacturaApiIndeterminada, FacturaApiRechazada, crear_factura_desde_remito, get_factura_backend
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_pool import redirigir_salida_del_hilo, salida_del_hilo
 
 # Excepción específica para abortar la facturación completa
 class FacturacionAbortada(Exception):
     pass
 
-def parse_fecha(value: Any) -> Optional[datetime]:
-    """
-    Parsea fechas comunes y retorna un datetime o None.
-    Soporta: ISO 8601 (incluyendo sufijo 'Z'), 'YYYY-MM-DD', 'DD/MM/YYYY',
-    y 'YYYY-MM-DDTHH:MM:SS'. Optimizado para decisiones rápidas.
-    """
-    if value is None:
-        return None
-    if isinstance(value, datetime):
-        return value
-    if isinstance(value, str):
-        s = value.strip()
-        if not s:
-            return None
-
-        # ISO 8601 rápido (maneja 'Z' como UTC)
-        if 'T' in s:
-            if s.endswith('Z'):
-                try:
-                    return datetime.fromisoformat(s.replace('Z', '+00:00'))
-                except Exception:
-                    pass
-            # 'YYYY-MM-DDTHH:MM:SS' (y posibles offsets)
-            if len(s) >= 19 and s[4:5] == '-' and s[7:8] == '-' and s[10:11] == 'T':
-                try:
-                    return datetime.fromisoformat(s)
-                except Exception:
-                    try:
-                        return datetime.strptime(s[:19], '%Y-%m-%dT%H:%M:%S')
-                    except Exception:
-                        pass
-
-        # 'YYYY-MM-DD'
-        if len(s) == 10 and s[4:5] == '-' and s[7:8] == '-':
-            try:
-                return datetime.strptime(s, '%Y-%m-%d')
-            except Exception:
-                pass
-
-        # 'DD/MM/YYYY'
-        if len(s) == 10 and s[2:3] == '/' and s[5:6] == '/':
-            try:
-                return datetime.strptime(s, '%d/%m/%Y')
-            except Exception:
-                pass
-
-    return None
-
-def timestamp() -> str:
-    """Retorna el timestamp actual formateado"""
-    return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-
-def print_with_time(message: str) -> None:
-    """Print con timestamp automático"""
-    print(f"[{timestamp()}] {message}")
-
-def get_token() -> str:
-    """Obtiene el token de autenticación desde la variable de entorno"""
-    load_dotenv()
-    
-    client_id = os.getenv('FINNEGANS_CLIENT_ID', '')
-    client_secret = os.getenv('FINNEGANS_SECRET', '')
-    url=f"https://api.teamplace.finneg.com/api/oauth/token?grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}"
-    
-    if not client_id or not client_secret:
-        print_with_time("Error: FINNEGANS_CLIENT_ID and FINNEGANS_SECRET must be set in .env file")
-        exit(1)
-    
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.text
-        return data
-    else:
-        print_with_time(f"Error al obtener el token: {response.status_code} - {response.text}")
-        exit(1)
-        
-        
 def _coalesce(d: Dict[str, Any], *keys: str) -> Optional[Any]:
     """Devuelve el primer valor no nulo/no vacío encontrado en d para las claves dadas."""
     for k in keys:
@@ -179,23 +138,29 @@ def resumir_transacciones(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 
 
 def get_remitos_pendientes(company: str) -> list:
-    """Obtiene la lista de remitos pendientes desde la variable de entorno"""
-    load_dotenv()
-    token=get_token()
+    """
+    Obtiene los remitos pendientes de la empresa. Si FINNEGANS_DESPACHO_EMPRESA_PARAM
+    está configurado el filtro se envía a la API; en todos los casos la respuesta se
+    parsea en streaming y solo se conservan las filas de la empresa. Nunca sale de
+    la caché: una copia vieja listaría remitos ya facturados y se facturarían dos veces.
+    """
     print_with_time(f"Obteniendo remitos pendientes para la empresa: {company}")
-    
-    url = f"https://api.teamplace.finneg.com/api/reports/analisisDespachoVenta?PARAMWEBREPORT_verPendientes=2&ACCESS_TOKEN={token}"
-    
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        remitos_company = [r for r in data if r.get('EMPRESA') == company]
-        return remitos_company
-    else:
-        print_with_time(f"Error al obtener los remitos: {response.status_code} - {response.text}")
-    
-    
-        return []
+
+    return get_report_rows(
+        'analisisDespachoVenta',
+        _remitos_pendientes_params(company),
+        filtro=lambda r: r.get('EMPRESA') == company,
+        filtro_key=company,
+        cache=False,
+    )
+
+def _remitos_pendientes_params(company: str) -> dict:
+    load_dotenv()
+    params = {'PARAMWEBREPORT_verPendientes': 2}
+    empresa_param = os.getenv('FINNEGANS_DESPACHO_EMPRESA_PARAM', '')
+    if empresa_param:
+        params[empresa_param] = company
+    return params
     
     
 def get_remito_detalle(DOCNROINT) -> list:
@@ -204,7 +169,7 @@ def get_remito_detalle(DOCNROINT) -> list:
     token=get_token()
     print_with_time(f"Obteniendo remitos pendientes para la empresa: {DOCNROINT}")
     
-    url = f"https://api.teamplace.finneg.com/api/pedidoVenta/{DOCNROINT}?ACCESS_TOKEN={token}"
+    url = f"{get_api_url()}/pedidoVenta/{DOCNROINT}?ACCESS_TOKEN={token}"
     
     response = requests.get(url)
     if response.status_code == 200:
@@ -216,30 +181,6 @@ def get_remito_detalle(DOCNROINT) -> list:
     
     
         return []
-def save_screenshot(image_bytes, filename):
-    """Guardar screenshot usando la ruta del .env"""
-    try:
-        load_dotenv()
-        photo_path = os.getenv('LOG_PHOTO_PATH', './media/photos/')
-        
-        # Crear el directorio si no existe
-        Path(photo_path).mkdir(parents=True, exist_ok=True)
-        
-        # Crear la ruta completa del archivo
-        full_path = Path(photo_path) / filename
-        
-        # Guardar el archivo
-        with open(full_path, 'wb') as f:
-            f.write(image_bytes)
-        
-        print_with_time(f"Screenshot guardado en: {full_path}")
-        return str(full_path)
-
-    
-    except Exception as e:
-        print_with_time(f"Error guardando screenshot: {e}")
-        return None
-
 # ==================== PostgreSQL logging de facturas ====================
 # Config DB igual a otros módulos (usando mismas variables que carga_padron_dgr.py)
 DB_CONFIG = {
@@ -353,198 +294,6 @@ def guardar_factura_generada(
         if conn:
             conn.close()
 
-def get_video_path():
-    """Obtener la ruta para guardar videos"""
-    load_dotenv()            
-    video_dir = os.getenv('LOG_VIDEO_PATH', './media/videos/')
-    Path(video_dir).mkdir(parents=True, exist_ok=True)
-    
-    timestamp_str = datetime.now().strftime('%Y%m%d_%H%M%S')
-    video_filename = f"finnegans_session_{timestamp_str}.webm"
-    return Path(video_dir) / video_filename
-
-def run_finnegans_login(playwright: Playwright) -> tuple:
-    load_dotenv()
-    
-    username = os.getenv('USER_FINNEGANS')
-    password = os.getenv('PASSWORD_FINNEGANS')
-    workspace = os.getenv('WORKSPACE_FINNEGANS', '')
-    webpage = os.getenv('WEBPAGE_FINNEGANS', 'https://services.finneg.com/login')
-    
-    if not username or not password:
-        print_with_time("Error: USER_FINNEGANS and PASSWORD_FINNEGANS must be set in .env file")
-        return None, None, None
-    
-    # Configurar grabación de video opcional
-    enable_video = os.getenv('ENABLE_VIDEO_RECORDING', 'false').lower() == 'true'
-    context_options = {}
-    
-    if enable_video:
-        video_path = get_video_path()
-        print_with_time(f"Video recording enabled - se guardará en: {video_path}")
-        context_options = {
-
-            "record_video_dir": str(video_path.parent),
-            "record_video_size": {"width": 1280, "height": 720},
-            "no_viewport": True,
-            "user_agent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36',
-            "extra_http_headers": {
-                'Referer': 'https://core-web.finneg.com/',
-                'Origin': 'https://core-web.finneg.com',
-            }
-
-        }
-    else:
-        print_with_time("Video recording disabled")
-        context_options = {
-
-            "no_viewport": True,
-            "user_agent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120 Safari/537.36',
-            "extra_http_headers": {
-                'Referer': 'https://core-web.finneg.com/',
-                'Origin': 'https://core-web.finneg.com',
-            }
-
-        }
-    
-    # Configurar modo headless desde variable de entorno
-    headless_mode = os.getenv('HEADLESS', 'true').lower() == 'true'
-    browser = playwright.chromium.launch(
-        headless=headless_mode,
-        args=['--start-maximized']
-    )
-    context = browser.new_context(**context_options)
-    page = context.new_page()
-    install_hud(context)
-    try:
-        print_with_time("Navigating to Finnegans login page...")
-        page.goto(webpage)
-        
-        print_with_time("Waiting for page to load...")
-        #page.wait_for_load_state('networkidle')
-        
-       
-        
-        print_with_time("Looking for login form elements...")
-        page.wait_for_timeout(2000)
-        
-        username_element = 'input[name="userName"]'
-        password_element = 'input[name="password"]'
-        company_element = 'input[name="empresa"]'
-        
-        print_with_time("Filling credentials...")
-        page.fill(username_element, username)
-        page.fill(password_element, password)
-        
-        if workspace:
-            print_with_time(f"Filling company field with: {workspace}")
-            page.fill(company_element, workspace)
-        
-        print_with_time("Submitting login form...")
-        submit_button = page.locator('input[name="standardSubmit"]')
-        print_with_time("Taking screenshot for debugging...")
-        screenshot_bytes = page.screenshot()
-        save_screenshot(screenshot_bytes, "finnegans_login_page.png")
-        
-        submit_button.click()
-        
-        print_with_time("Waiting for login to complete...")
-        
-        # Esperar a que la URL cambie después del login
-        try:
-            page.wait_for_url(lambda url: 'login' not in url.lower(), timeout=15000)
-            current_url = page.url
-            print_with_time(f"Login successful! Redirected to: {current_url}")
-            
-            # Tomar screenshot de la página después del login
-            screenshot_bytes = page.screenshot()
-            save_screenshot(screenshot_bytes, "finnegans_post_login_page.png")
-            
-            # Esperar a que la página se cargue completamente
-            page.wait_for_load_state('networkidle', timeout=10000)
-            
-        except Exception as redirect_error:
-            current_url = page.url
-            print_with_time(f"Login redirect timeout. Current URL: {current_url}")
-            if 'login' in current_url.lower():
-                print_with_time("Login may have failed - still on login page")
-                screenshot_bytes = page.screenshot()
-                save_screenshot(screenshot_bytes, "finnegans_login_failed_page.png")
-                return None, None, None
-            
-        time.sleep(1)
-        return browser, context, page
-        
-    except Exception as e:
-        print_with_time(f"Error during login: {e}")
-        if context:
-            context.close()
-        if browser:
-            browser.close()
-        return None, None, None
-
-def select_company( page, company_labels, company_checkboxs, company_checkboxes_angular, target_company: str) -> bool:
-    """
-    Selecciona la compañía especificada en la lista
-    """
-    for i in range(company_labels.count()):
-        company = company_labels.nth(i).inner_text().strip()
-        checked = company_checkboxs.nth(i).is_checked()
-        
-        print_with_time(f"Found company: {company} (checked: {checked})")
-        
-        if company == target_company:
-            if not checked:
-                print_with_time(f"Selecting company: {company}")
-                company_checkboxes_angular.nth(i).click()
-                time.sleep(1)  # Esperar un momento para que el cambio se registre
-            else:
-                print_with_time(f"Company {company} is already selected")
-                page.keyboard.press("Escape")
-            return True
-    
-    print_with_time(f"Company {target_company} not found in the list")
-    return False
-
-def select_company_action(page, target_company: str) -> bool:
-    print_with_time("Selecting company...")
-    page.get_by_text('Empresa', exact=True).click()
-    time.sleep(1)
-    
-    dialog = page.locator('.mdc-dialog__container')
-    company_labels = dialog.locator("label")
-    print_with_time(f"Found {company_labels.count()} companies in the list")
-    
-    company_checkboxs = dialog.locator("input[type='checkbox']")
-    company_checkboxs_angular = dialog.locator(".p-checkbox-box")
-    select_company(page, company_labels, company_checkboxs, company_checkboxs_angular, target_company)
-    print_with_time("Company selected")
-    
-def navigate_to_section(page, section_name: str) -> bool:
-    
-    time.sleep(2)
-    print_with_time(f"Trying to navigate to: {section_name}")
-    
-    try:
-        print_with_time(f"Navigating to {section_name} section...")
-        page.locator("#menu_button i").click()
-        
-        page.get_by_role("button", name="Favoritos").click()
-        #page.get_by_text("Ventas", exact=True).click()
-        
-        page.get_by_text(section_name, exact=True).click()
-        #new_page = new_page_info.value
-        time.sleep(1)
-        #page.wait_for_load_state('networkidle', timeout=10000)
-        print_with_time(f"Navigated to {section_name} section")
-        screenshot_bytes = page.screenshot()
-        save_screenshot(screenshot_bytes, "finnegans_facturacion_loaded.png")
-        
-    
-        return True
-    except Exception as e:
-        print_with_time(f"Error navigating to {section_name}: {e}")
-        return False
 def create_new_invoice(page, remito):
     print_with_time(f"Creating new invoice for remito: {remito['comprobante']}")
     # Aquí se pueden agregar los pasos para crear una nueva factura usando los datos del remito
@@ -552,12 +301,9 @@ def create_new_invoice(page, remito):
     # Esto dependerá de la estructura específica de la página y los datos disponibles en `remito`
     
 
-    time.sleep(1)
+    frame = esperar("boton nueva factura", lambda t: wait_in_all_frames(page, "#ActionNewDF", timeout=t), timeout=30000)
     print_with_time("Nueva Factura button is visible")
-    screenshot_bytes = page.screenshot()
-    save_screenshot(screenshot_bytes, "finnegans_facturacion_nueva_factura_1.png")
-    
-    frame = page.frames[1] # Ajusta el índice según sea necesario
+    capturar(page, "finnegans_facturacion_nueva_factura_1.png")
     
     print_with_time("Presionar boton nueva factura")
     btn_nueva_factura = frame.locator("#ActionNewDF")
@@ -574,28 +320,26 @@ def create_new_invoice(page, remito):
     elemento.click()
     
     print_with_time("seleccion del tipo de factura ")
-    time.sleep(2)
+    asistente = frame.locator("input[type=radio][name='WizardWorkflowSelect'][value='160']")
+    esperar("asistente de factura", visible(asistente))
     print_with_time("Nueva Factura button is visible")
-    screenshot_bytes = page.screenshot()
-    save_screenshot(screenshot_bytes, "finnegans_facturacion_nueva_factura_2.png")
+    capturar(page, "finnegans_facturacion_nueva_factura_2.png")
     
-    asistente = frame.locator("input[type=radio][name='WizardWorkflowSelect'][value='160']")
     asistente.click()
-    time.sleep(1)
     print_with_time("Nueva Factura button is visible")
-    screenshot_bytes = page.screenshot()
-    save_screenshot(screenshot_bytes, "finnegans_facturacion_nueva_factura_3.png")
+    capturar(page, "finnegans_facturacion_nueva_factura_3.png")
     
     frame.locator('#OPERACIONSIGUIENTEPASO1_0').click()
-    time.sleep(1)
+    esperar("grilla de remitos", visible(frame.locator("button[onclick^='VRefrescarOperaciones']")))
     return frame
 
-def search_and_make_invoice_avianca(page, frame, remito, company) -> None:
+def search_and_make_invoice_avianca(page, frame, remito, company) -> Optional[dict]:
     
     print_with_time("Exploring navigation to add remito details...")
         
+    celdas_antes = contar_celdas_grilla(frame)
     frame.locator("button[onclick^='VRefrescarOperaciones']").click()
-    time.sleep(2)
+    esperar("refrescar operaciones", grilla_estable(frame, celdas_antes))
     
     
     grid_bodys = frame.locator("div.webix_ss_body")
@@ -604,8 +348,6 @@ def search_and_make_invoice_avianca(page, frame, remito, company) -> None:
         if grid_bodys.nth(i).is_visible() == True:
             grid_body = grid_bodys.nth(i)
             break
-            
-    time.sleep(1)
     
     cells = grid_body.locator("div.webix_cell")
     
@@ -617,7 +359,17 @@ def search_and_make_invoice_avianca(page, frame, remito, company) -> None:
         filters = frame.locator("input.TOOLBARTooltipSearch")
         filters.nth(6).fill(remito["comprobante"])
         filters.nth(6).press('Enter')
-        time.sleep(2)
+        # Solo se marca la fila cuando la grilla muestra únicamente el remito buscado
+        try:
+            esperar("filtrar remito", xhr_inactivos(page))
+        except PasoTimeout as e:
+            print_with_time(str(e))
+        try:
+            esperar("remito en grilla", grilla_filtrada(frame, remito["comprobante"]))
+            filtrado = True
+        except PasoTimeout as e:
+            print_with_time(f"{e}: la grilla no quedó filtrada por {remito['comprobante']}")
+            filtrado = False
         grid_bodys = frame.locator("div.webix_ss_body")
     
         for i in range(grid_bodys.count()):
@@ -626,21 +378,27 @@ def search_and_make_invoice_avianca(page, frame, remito, company) -> None:
                 break
         
         cantidad_registros = grid_body.locator("div.webix_cell")
-        if cantidad_registros.count() >0:
+        if filtrado and cantidad_registros.count() >0:
             frame.locator("input.mainCheckbox").nth(1).check()
-            time.sleep(1)
             frame.locator('#OPERACIONSIGUIENTEPASO2_0').click()
-            time.sleep(1)
             frame.locator('#OPERACIONFINALIZAR_0').click()
-            time.sleep(3)
-            
-            print_with_time("Ingresando al detalle de la factura")
             
             # Hay dos botones con el mismo id, se toma el segundo que es el boton con la palabra "Guardar "
             boton_guardar = frame.locator("#_onSave")
+            esperar("detalle de la factura", visible(boton_guardar.nth(1)), timeout=30000)
+            print_with_time("Ingresando al detalle de la factura")
+            
             print_with_time("Guardando la factura")
             boton_guardar.nth(1).click()
-            time.sleep(5)
+            try:
+                esperar("numero de factura", valor_widget(frame, "wdg_NumeroDocumento"), timeout=60000, reducible=False)
+            except PasoTimeout as e:
+                print_with_time(str(e))
+            # La factura ya se guardó: si algún XHR sigue abierto se lee el número igual
+            try:
+                esperar("guardado de factura", xhr_inactivos(page), timeout=30000, reducible=False)
+            except PasoTimeout as e:
+                print_with_time(str(e))
 
             # Intentar leer el nro de factura asignado
             nro_factura = None
@@ -678,15 +436,8 @@ def search_and_make_invoice_avianca(page, frame, remito, company) -> None:
                 'Generado'
             )
 
-            boton_cerrar = frame.locator("#close")
-            boton_cerrar.nth(1).click()
-            time.sleep(1)
-            popup = frame.locator("div.fafpopup")
-            if popup.is_visible() == True:
-                close_button = frame.locator("#showAskPopupNoButton")
-                close_button.click()
-                time.sleep(3)
-            pass
+            cerrar_factura(frame)
+            return {'numero_factura': nro_factura, 'nro_cae': None, 'backend': 'ui'}
         else:
             print_with_time("No se encontraron registros para el remito")
         pass
@@ -709,24 +460,13 @@ def get_alicuotas(cuits: List[str]) -> Dict[str, Any]:
         print_with_time(f"Error al obtener las alícuotas: {response.status_code} - {response.text}")
         return {}
     
-def wait_for_widget_value(element, widget_name, timeout=15000):
-    selector = f'div.widget[name="{widget_name}"] input'
-    element.wait_for_function(
-        f"""() => {{
-            const el = document.querySelector('{selector}');
-            return el && el.value && el.value.trim() !== "" && el.value.trim() !== "0.00";
-        }}""",
-        timeout=timeout
-    )
-    # devolver valor una vez que está disponible
-    return element.locator(selector).get_attribute("value")
-
-def search_and_make_invoice_dasdach(page, frame, remito, company) -> None:
+def search_and_make_invoice_dasdach(page, frame, remito, company) -> Optional[dict]:
     
     print_with_time("Exploring navigation to add remito details...")
         
+    celdas_antes = contar_celdas_grilla(frame)
     frame.locator("button[onclick^='VRefrescarOperaciones']").click()
-    time.sleep(2)
+    esperar("refrescar operaciones", grilla_estable(frame, celdas_antes))
     
     
     grid_bodys = frame.locator("div.webix_ss_body")
@@ -735,8 +475,6 @@ def search_and_make_invoice_dasdach(page, frame, remito, company) -> None:
         if grid_bodys.nth(i).is_visible() == True:
             grid_body = grid_bodys.nth(i)
             break
-            
-    time.sleep(1)
     
     cells = grid_body.locator("div.webix_cell")
     
@@ -748,17 +486,24 @@ def search_and_make_invoice_dasdach(page, frame, remito, company) -> None:
         filters = frame.locator("input.TOOLBARTooltipSearch")
         filters.nth(6).fill(remito["comprobante"])
         filters.nth(6).press('Enter')
-        time.sleep(2)
+        # Solo se marca la fila cuando la grilla muestra únicamente el remito buscado
+        try:
+            esperar("filtrar remito", xhr_inactivos(page))
+        except PasoTimeout as e:
+            print_with_time(str(e))
+        try:
+            esperar("remito en grilla", grilla_filtrada(frame, remito["comprobante"]))
+            filtrado = True
+        except PasoTimeout as e:
+            print_with_time(f"{e}: la grilla no quedó filtrada por {remito['comprobante']}")
+            filtrado = False
         cantidad_registros = grid_body.locator("div.webix_cell")
-        if cantidad_registros.count() >0:
+        if filtrado and cantidad_registros.count() >0:
             frame.locator("input.mainCheckbox").nth(1).check()
-            time.sleep(1)
             frame.locator('#OPERACIONSIGUIENTEPASO2_0').click()
-            time.sleep(1)
             frame.locator('#OPERACIONFINALIZAR_0').click()
-            time.sleep(6)
             #frame = page.wait_for_event("frameattached", timeout=10000)
-            total_bruto = wait_for_widget_value(frame, "wdg_TotalBruto")
+            total_bruto = esperar("total bruto", valor_widget(frame, "wdg_TotalBruto"), timeout=30000)
             
             if total_bruto is None or total_bruto == '' or float(total_bruto.replace(",", "")) == 0.0:
                 print_with_time("Imposible generar factura: Total Bruto es cero o nulo")
@@ -766,12 +511,13 @@ def search_and_make_invoice_dasdach(page, frame, remito, company) -> None:
             
             print_with_time("Ingresando al detalle de la factura")
             
-            save_screenshot(page.screenshot(), f"finnegans_facturacion_factura_por_generar{remito['comprobante']}.png")
+            capturar(page, f"finnegans_facturacion_factura_por_generar{remito['comprobante']}.png")
             
             
             if remito['identificacion_tributaria'] == 'C.U.I.T.' or remito['identificacion_tributaria'] == 'CUIT':
                 cuit = re.sub(r'\D', '', remito['nro_de_identificacion'])
-                alicuotas_info = get_alicuotas([cuit])
+                with span('api.alicuotas', comprobante=remito['comprobante']):
+                    alicuotas_info = get_alicuotas([cuit])
                 
                 encontrado = alicuotas_info.get('encontrados', 0)
                 no_encontrado = alicuotas_info.get('no_encontrados', 0)
@@ -808,18 +554,19 @@ def search_and_make_invoice_dasdach(page, frame, remito, company) -> None:
             if widget.is_visible() == True:
                 checkbox = widget.locator('input[type="checkbox"]')
                 checkbox.check()
-                time.sleep(3)
+                esperar("CAE automatico", xhr_inactivos(page))
+            # El CAE se toma de la respuesta del guardado o del widget apenas aparece
+            captura_cae = CapturaCae(page)
             try:
                 # TODO: Guardar Documento
                 # Hay dos botones con el mismo id, se toma el segundo que es el boton con la palabra "Guardar "
                 boton_guardar = frame.locator("#_onSave")
                 print_with_time("Guardando la factura")
                 boton_guardar.nth(1).click()
-                time.sleep(7)
                 
                 
-                valor_factura_comprobante = wait_for_widget_value(frame, "wdg_NumeroDocumento")
-                save_screenshot(page.screenshot(), f"finnegans_facturacion_factura_guardada{remito['comprobante']}.png")
+                valor_factura_comprobante = esperar("numero de factura", valor_widget(frame, "wdg_NumeroDocumento"), timeout=60000, reducible=False)
+                capturar(page, f"finnegans_facturacion_factura_guardada{remito['comprobante']}.png")
                 
                 # Busco numero de comprobante y lo guardo en nro_factura
                 widget_doc = frame.locator('div.widget[name="wdg_NumeroDocumento"]')
@@ -832,23 +579,24 @@ def search_and_make_invoice_dasdach(page, frame, remito, company) -> None:
                 if nro_factura is None or nro_factura == '':
                     print_with_time("No se obtuvo numero de factura, la factura no fue generada correctamente")
                     raise ValueError("No se obtuvo numero de factura, la factura no fue generada correctamente")
-                time.sleep(5)
-                nro_cae = None
-                for intento in range(3):
-                    frame.locator('div.tab[name="OperacioninformacionFiscalTab"]').click()
-                    widget_cae = frame.locator('div.widget[name="wdg_cai"]')
-                    if widget_cae.is_visible() == True:
-                        print_with_time("Obtengo el CAI/CAE")
-                        nro_cae = frame.locator('div.widget[name="wdg_cai"] >> input[type="textbox"]').input_value()
-                        print_with_time(f"Nro de CAI: {nro_cae}")
-                        if nro_cae is not None and nro_cae != '':
-                            break
-                    if intento < 2:
-                        print_with_time(f"Reintentando obtener CAE ({intento+1}/3)")
-                        time.sleep(3)
-                    
+                print_with_time("Obtengo el CAI/CAE")
+                frame.locator('div.tab[name="OperacioninformacionFiscalTab"]').click()
+                try:
+                    nro_cae = esperar("CAE", cae_disponible(frame, captura_cae), timeout=20000, reducible=False)
+                except PasoTimeout as e:
+                    print_with_time(str(e))
+                    nro_cae = None
+                print_with_time(f"Nro de CAI: {nro_cae}")
+                # Factura guardada y con número: un XHR que no termina no debe impedir registrarla
+                try:
+                    esperar("guardado de factura", xhr_inactivos(page), timeout=30000, reducible=False)
+                except PasoTimeout as e:
+                    print_with_time(str(e))
+
                 if nro_cae is None or nro_cae == '':
                     print_with_time("No se obtuvo CAE, la factura no fue generada correctamente")
+                    cuit = re.sub(r'\D', '', remito.get('nro_de_identificacion', '') or '')
+                    provincia = remito.get('provincia_destino')
                     guardar_factura_generada(
                         datetime.now(),
                         remito.get('comprobante'),
@@ -884,41 +632,36 @@ def search_and_make_invoice_dasdach(page, frame, remito, company) -> None:
             except Exception as e:
                 print_with_time(f"Error al guardar la factura: {e}")
                 raise FacturacionAbortada("Error al guardar la factura {e}")
+            finally:
+                captura_cae.detener()
             
             
             
-            boton_cerrar = frame.locator("#close")
-            boton_cerrar.nth(1).click()
-            time.sleep(3)
-            popup = frame.locator("div.fafpopup")
-            if popup.is_visible() == True:
-                close_button = frame.locator("#showAskPopupNoButton")
-                close_button.click()
-                time.sleep(3)
-            pass
+            cerrar_factura(frame)
+            return {'numero_factura': nro_factura, 'nro_cae': nro_cae, 'backend': 'ui'}
         else:
             print_with_time("No se encontraron registros para el remito")
         pass
 
 def agregar_percepcion(frame, percepcion_valor):
     print_with_time(f"Agregando percepción por valor de: {percepcion_valor:.2f}")
-    time.sleep(1)
     # Navegar a la pestaña de percepciones
     frame.locator('div.tab[name="Retenciones y Percepciones"]').click()
-    time.sleep(1)
     
     # Hacer clic en el botón "Agregar Percepción"
     boton_agregar = frame.locator('div[name="Retenciones y Percepciones"] >> div.newButton')
+    esperar("pestaña percepciones", visible(boton_agregar))
     boton_agregar.click()
-    time.sleep(1)
     
     
     tipo_percepcion= "Percepcion IIBB BAs (Padrón)"
     
     tipo_rercepcion_input = frame.locator('div.widget[name="wdg_RetencionTipoID"] >> input[type="textbox"]')
+    esperar("formulario percepcion", visible(tipo_rercepcion_input))
     tipo_rercepcion_input.fill(tipo_percepcion)
     tipo_rercepcion_input.press('Enter')
-    time.sleep(1)
+    # El primer Enter busca el tipo en el servidor; el segundo lo selecciona
+    esperar("buscar tipo de percepcion", xhr_inactivos(frame.page))
     tipo_rercepcion_input.press('Enter')
     
     
@@ -927,7 +670,7 @@ def agregar_percepcion(frame, percepcion_valor):
     retencion_input.fill(retencion)
     
     retencion_input.press('Enter')
-    time.sleep(1)
+    esperar("buscar percepcion", xhr_inactivos(frame.page))
     retencion_input.press('Enter')
     importe = percepcion_valor
     
@@ -958,131 +701,329 @@ def agregar_percepcion(frame, percepcion_valor):
     boton_agregar.click()
     
     #TODO: capturar pantalla y guardar
-    screenshot_bytes = frame.page.screenshot()
-    save_screenshot(screenshot_bytes, "finnegans_facturacion_percepcion_1.png")
+    capturar(frame.page, "finnegans_facturacion_percepcion_1.png")
     
     boton_aceptar = frame.locator('#aceptar')
     boton_aceptar.click()
-    
-   
-    time.sleep(2)
+    esperar("aceptar percepcion", xhr_inactivos(frame.page))
     
     print_with_time("Percepción agregada exitosamente")
 
-def ejecutar_factura(page, remito, company) -> None:
+def facturar_por_api(remito, company) -> dict:
+    """
+    Genera la factura del remito por la API REST aplicando los mismos controles que
+    la automatización web (alícuota del padrón, percepción y CAE).
+    Lanza FacturaApiRechazada si conviene reintentar por la UI.
+    """
+    cuit = re.sub(r'\D', '', remito.get('nro_de_identificacion') or '')
+    provincia = remito.get('provincia_destino')
+    alicuotas_a_cobrar = 0.0
+    percepcion_valor = 0.0
+    es_cuit = remito.get('identificacion_tributaria') in ('C.U.I.T.', 'CUIT')
+    if es_cuit:
+        alicuotas_info = get_alicuotas([cuit])
+        if alicuotas_info.get('encontrados', 0) > 0:
+            alicuotas_a_cobrar = float(alicuotas_info.get('resultados')[0]['alicuota'])
+        elif provincia == 'Buenos Aires':
+            # La UI actualiza la percepción del cliente antes de facturar
+            raise FacturaApiRechazada("CUIT sin alícuota en el padrón para Buenos Aires")
+        percepcion_valor = remito['importe_no_gravado'] * alicuotas_a_cobrar / 100
+
     try:
-        # Navegar a la sección de facturación
-        time.sleep(2)
-        if not navigate_to_section(page, "Facturas de Venta - Das Dach"):
-            raise Exception("Failed to navigate to Facturación section")
-        time.sleep(4)
-        frame = create_new_invoice(page, remito)
+        factura = crear_factura_desde_remito(remito, company)
+    except FacturaApiIndeterminada as e:
+        print_with_time(f"No se pudo confirmar la factura creada por API: {e}")
+        raise FacturacionAbortada(f"No se pudo confirmar la factura creada por API: {e}")
+
+    nro_factura = factura['numero_factura']
+    nro_cae = factura['nro_cae']
+    print_with_time(f"Factura {nro_factura} creada por API - CAE: {nro_cae}")
+
+    estado = 'Generado'
+    if es_cuit and factura['total_retenciones'] is not None:
+        percepcion_calculada = round(float(str(factura['total_retenciones']).replace(",", "")), 2)
+        if percepcion_calculada != round(percepcion_valor, 2):
+            estado = 'Error Percepcion'
+    if not nro_cae:
+        estado = 'Error CAE'
+
+    guardar_factura_generada(
+        datetime.now(),
+        remito.get('comprobante'),
+        remito.get('docnroint'),
+        cuit,
+        company,
+        provincia,
+        alicuotas_a_cobrar,
+        nro_factura,
+        nro_cae,
+        estado
+    )
+    if estado == 'Error CAE':
+        raise FacturacionAbortada("No se obtuvo CAE, la factura no fue generada correctamente")
+    if estado == 'Error Percepcion':
+        raise FacturacionAbortada(f"Percepcion calculada no coincide con la esperada en la factura {nro_factura}: en Finnegans {percepcion_calculada:.2f} vs del padron {percepcion_valor:.2f}")
+
+    return {'numero_factura': nro_factura, 'nro_cae': nro_cae, 'backend': 'api'}
+
+def ejecutar_factura(page, remito, company) -> Optional[dict]:
+    backend = get_factura_backend()
+    if company != "AVIANCA" and backend in ('api', 'auto'):
+        try:
+            with span('factura.api', comprobante=remito['comprobante'], empresa=company):
+                return facturar_por_api(remito, company)
+        except FacturaApiRechazada as e:
+            if backend == 'api':
+                raise
+            print_with_time(f"La API rechazó el remito {remito['comprobante']}: {e}. Se usa la automatización web")
+    try:
+        # Volver a la lista de facturas (sin recargar la SPA)
+        with span('factura.navegar', comprobante=remito['comprobante']):
+            ir_a_lista_facturas(page)
+        with span('factura.nueva', comprobante=remito['comprobante']):
+            frame = create_new_invoice(page, remito)
         if not frame:
             raise Exception("Failed to create new invoice frame")
-        if company == "AVIANCA":
-            search_and_make_invoice_avianca(page, frame, remito, company)
-        else:
-            search_and_make_invoice_dasdach(page, frame, remito, company)
+        with span('factura.ui', comprobante=remito['comprobante'], empresa=company):
+            if company == "AVIANCA":
+                factura = search_and_make_invoice_avianca(page, frame, remito, company)
+            else:
+                factura = search_and_make_invoice_dasdach(page, frame, remito, company)
         print_with_time(f"Invoice created successfully for remito: {remito['comprobante']}")
+        return factura
 
     except Exception as e:
         print_with_time(f"Error processing remito {remito['comprobante']}: {e}")
         # Re-raise the exception to be caught by the calling function
         raise
     
-def run_finnegans_facturacion(browser, context, page, company, resumen) -> tuple:
-    if not page:
-        print_with_time("Error: No active page session")
-        return 0, 0, [], []
-
-    print_with_time("=== FACTURACION MODULE ===")
-    current_url = page.url
-    print_with_time(f"Current URL: {current_url}")
-
-    # Tomar screenshot del estado actual
-    screenshot_bytes = page.screenshot()
-    save_screenshot(screenshot_bytes, "finnegans_facturacion_start.png")
-    select_company_action(page, company)
-
-    # Contadores de éxito y error
-    remitos_exitosos = 0
-    remitos_fallidos = 0
-    remitos_no_procesados = 0
-
-    # Listas para tracking detallado
-    remitos_exitosos_lista = []
-    remitos_fallidos_lista = []
-    remitos_no_procesados_lista = []    
-    
-    # Flag para abortar proceso completo si falta CAE
-    abort_process = False
+def get_facturacion_workers(company: str) -> int:
+    """
+    Cantidad de navegadores que facturan en paralelo para la empresa:
+    FINNEGANS_FACTURACION_WORKERS_<EMPRESA> (p.ej. _DAS_DACH) o
+    FINNEGANS_FACTURACION_WORKERS (por defecto 1, secuencial).
+    """
+    load_dotenv()
+    clave = re.sub(r'[^A-Z0-9]+', '_', company.upper()).strip('_')
+    valor = os.getenv(f'FINNEGANS_FACTURACION_WORKERS_{clave}') or os.getenv('FINNEGANS_FACTURACION_WORKERS', '1')
+    try:
+        return max(1, int(valor))
+    except ValueError:
+        return 1
 
-    # Buscar elementos de navegación o menús
-    for i, remito in enumerate(resumen, 1):
+def procesar_remito(page, remito, company) -> Tuple[Optional[str], Optional[dict]]:
+    """
+    Factura un remito en la sesión `page`. Retorna (None, factura) si se
+    facturó o (razón, None) si no se procesa; las fallas se propagan como excepción.
+    """
+    if remito['importe'] in (0, None, ''):
+        print_with_time(f"Remito {remito['comprobante']} tiene monto 0, no se procesa")
+        return 'Monto 0', None
+
+    if company == "AVIANCA":
+        factura = ejecutar_factura(page, remito, company)
+        print_with_time(f"-> Remito {remito['comprobante']} procesado exitosamente")
+        return None, factura
+
+    with span('api.remito_detalle', comprobante=remito['comprobante']):
+        remito_detalle = get_remito_detalle(remito['docnroint'])
+
+    # Parsear y validar fecha de entrega menor a la fecha actual
+    fecha_entrega_dt = None
+    fecha_raw = None
+    if remito_detalle is not None:
+        fecha_raw = remito_detalle.get('USR_FechaEntrega')
+        print_with_time(f"Remito {remito['comprobante']} USR_FechaEntrega: {fecha_raw}")
+        if fecha_raw is not None:
+            fecha_entrega_dt = parse_fecha(fecha_raw)
+
+    if remito_detalle is not None and fecha_entrega_dt is not None and fecha_entrega_dt.date() < datetime.now().date():
+        print_with_time(f"Remito {remito['comprobante']} tiene fecha de entrega {fecha_raw}, se intenta procesar")
+        factura = ejecutar_factura(page, remito, company)
+        print_with_time(f"-> Remito {remito['comprobante']} Fecha Salida {fecha_raw} procesado exitosamente")
+        return None, factura
+
+    print_with_time(f"Remito {remito['comprobante']} no tiene fecha de salida registrada, no se procesa")
+    return 'Fecha de entrega no registrada o inválida', None
+
+def _facturar_cola(sesion, company, cola, total, resultado, lock, abortar, tiempos_remitos, ledger):
+    """
+    Toma remitos de `cola` y los factura en la sesión supervisada `sesion` hasta
+    vaciarla o hasta que algún worker marque `abortar` (CAE faltante). Acumula
+    en `resultado` y registra cada transición de estado en el `ledger` de la
+    ejecución. Si el navegador se cae, el supervisor lo reinicia y se sigue con
+    el próximo remito; al superar los reinicios permitidos el worker se detiene.
+    """
+    while not abortar.is_set():
         try:
-            print_with_time(f"Processing remito {i}/{len(resumen)}: {remito['comprobante']} for client {remito['cliente']} CUIT: {remito['nro_de_identificacion']}")
-            show_comprobante(page, f"Procesando remito: {remito['comprobante']} ({i}/{len(resumen)})")
-            if remito['importe'] in (0, None, ''):
-                remitos_no_procesados += 1
-                remitos_no_procesados_lista.append({'comprobante': remito['comprobante'], 'razon': 'Monto 0'})
-                print_with_time(f"Remito {remito['comprobante']} tiene monto 0, no se procesa")
-                #continue
-            else:
-                
-                if company == "AVIANCA":
-                    ejecutar_factura(page, remito, company)
-                    remitos_exitosos += 1
-                    remitos_exitosos_lista.append(remito['comprobante'])
-                    print_with_time(f"-> Remito {remito['comprobante']} procesado exitosamente")
+            i, remito = cola.get_nowait()
+        except queue.Empty:
+            return
+        page = sesion.page
+        inicio_remito = time.monotonic()
+        error_remito = None
+        iniciar_capturas(remito['comprobante'])
+        try:
+            print_with_time(f"Processing remito {i}/{total}: {remito['comprobante']} for client {remito['cliente']} CUIT: {remito['nro_de_identificacion']}")
+            show_comprobante(page, f"Procesando remito: {remito['comprobante']} ({i}/{total})")
+            ledger.marcar(remito, EN_CURSO)
+            with span('remito', comprobante=remito['comprobante'], empresa=company) as atributos:
+                razon, factura = procesar_remito(page, remito, company)
+                atributos['resultado'] = 'facturado' if razon is None else 'no_procesado'
+            ledger.marcar(remito, FACTURADO if razon is None else NO_PROCESADO, razon)
+            registrar_item(
+                company,
+                remito['comprobante'],
+                atributos['resultado'],
+                razon=razon,
+                duracion_ms=round((time.monotonic() - inicio_remito) * 1000, 1),
+                **(factura or {}),
+            )
+            with lock:
+                if razon is None:
+                    resultado['exitosos_lista'].append(remito['comprobante'])
                 else:
-                    remito_detalle = get_remito_detalle(remito['docnroint'])
-                    
-                    
-                    # Parsear y validar fecha de entrega menor a la fecha actual
-                    fecha_entrega_dt = None
-                    if remito_detalle is not None:
-                        fecha_raw = remito_detalle.get('USR_FechaEntrega')
-                        print_with_time(f"Remito {remito['comprobante']} USR_FechaEntrega: {fecha_raw}")
-                        if fecha_raw is not None:
-                            fecha_entrega_dt = parse_fecha(fecha_raw)
-
-                    if remito_detalle is not None and fecha_entrega_dt is not None and fecha_entrega_dt.date() < datetime.now().date():
-                        # Solo por Debug
-                        #if remito['comprobante'] == 'R-0001-00010644':
-                        print_with_time(f"Remito {remito['comprobante']} tiene fecha de entrega {fecha_raw}, se intenta procesar")
-                        ejecutar_factura(page, remito, company)
-                        remitos_exitosos += 1
-                        remitos_exitosos_lista.append(remito['comprobante'])
-                        print_with_time(f"-> Remito {remito['comprobante']} Fecha Salida {fecha_raw} procesado exitosamente")
-                    else:
-                        print_with_time(f"Remito {remito['comprobante']} no tiene fecha de salida registrada, no se procesa")
-                        remitos_no_procesados += 1
-                        remitos_no_procesados_lista.append({'comprobante': remito['comprobante'], 'razon': 'Fecha de entrega no registrada o inválida'})
-                        #continue  # Saltar al siguiente remito
-                        
-            
-            
+                    resultado['no_procesados_lista'].append({'comprobante': remito['comprobante'], 'razon': razon})
         except Exception as e:
-            remitos_fallidos += 1
+            error_remito = e
+            # Conservar en disco las capturas del remito fallido
+            capturar(page, "error.png")
+            volcar_capturas()
             error_trace = traceback.format_exc()
             error_msg = f"{str(e)}\n{error_trace}"
-            remitos_fallidos_lista.append({'comprobante': remito['comprobante'], 'error': error_msg})
+            ledger.marcar(remito, FALLIDO, str(e))
+            registrar_item(
+                company,
+                remito['comprobante'],
+                'fallido',
+                error=str(e).split('\n')[0],
+                duracion_ms=round((time.monotonic() - inicio_remito) * 1000, 1),
+            )
+            with lock:
+                resultado['fallidos_lista'].append({'comprobante': remito['comprobante'], 'error': error_msg})
             print_with_time(f"!! Error procesando remito {remito['comprobante']}: {str(e)}")
             print_with_time(f"Stack trace:\n{error_trace}")
             # Si no se obtuvo CAE, marcar para abortar proceso completo
             if isinstance(e, FacturacionAbortada) or 'No se obtuvo CAE' in str(e):
                 print_with_time("Abortando proceso de facturación por CAE faltante")
-                abort_process = True
+                abortar.set()
             # Continuar con el siguiente remito sin interrumpir el proceso
         finally:
-            hide_comprobante(page)
-            page.goto(page.url)
-            if abort_process:
-                print_with_time("Proceso de facturación abortado. No se procesarán más remitos.")
-                break
-            
+            tiempos_remitos.append(time.monotonic() - inicio_remito)
+            print_with_time(f"Remito {remito['comprobante']} procesado en {tiempos_remitos[-1]:.1f}s")
+        try:
+            if error_remito is not None:
+                # Estado de la pantalla incierto: recargar (o reiniciar el navegador si se cayó)
+                sesion.recuperar(error_remito)
+            else:
+                hide_comprobante(page)
+        except SesionPerdida as perdida:
+            print_with_time(f"!! {perdida}. Este navegador no toma más remitos")
+            return
+        except Exception as e_sesion:
+            if not sesion.caida(e_sesion):
+                raise
+            try:
+                sesion.reiniciar()
+            except SesionPerdida as perdida:
+                print_with_time(f"!! {perdida}. Este navegador no toma más remitos")
+                return
+    print_with_time("Proceso de facturación abortado. No se procesarán más remitos.")
+
+def _worker_facturacion(numero, run_id, salida, company, cola, total, resultado, lock, abortar, tiempos_remitos, ledger):
+    """Worker adicional: abre su propio navegador y sesión y factura de la cola compartida"""
+    # Los spans del worker se suman a los de la ejecución que lo lanzó
+    set_run_id(run_id)
+    set_empresa(company)
+    # En el pool, lo que imprime el worker va también a la salida del job
+    if salida:
+        redirigir_salida_del_hilo(salida)
+    with sync_playwright() as playwright:
+        browser, context, page = run_finnegans_login(playwright)
+        if not page:
+            print_with_time(f"Worker {numero}: login fallido, no toma remitos")
+            return
+        sesion = None
+        try:
+            select_company_action(page, company)
+            sesion = SupervisorSesion(browser, context, page, company, playwright)
+            _facturar_cola(sesion, company, cola, total, resultado, lock, abortar, tiempos_remitos, ledger)
+        except Exception as e:
+            print_with_time(f"Worker {numero}: error en la sesión: {e}")
+        finally:
+            if sesion:
+                sesion.cerrar()
+            close_finnegans_session(browser, context)
+
+def run_finnegans_facturacion(browser, context, page, company, resumen, ledger=None, playwright=None) -> tuple:
+    if not page:
+        print_with_time("Error: No active page session")
+        return 0, 0, [], []
+
+    print_with_time("=== FACTURACION MODULE ===")
+    current_url = page.url
+    print_with_time(f"Current URL: {current_url}")
+
+    # Tomar screenshot del estado actual
+    capturar(page, "finnegans_facturacion_start.png")
+    select_company_action(page, company)
 
-    return remitos_exitosos, remitos_fallidos, remitos_exitosos_lista, remitos_fallidos_lista, remitos_no_procesados, remitos_no_procesados_lista
+    # Listas para tracking detallado (compartidas por todos los workers)
+    resultado = {'exitosos_lista': [], 'fallidos_lista': [], 'no_procesados_lista': []}
+    lock = threading.Lock()
+    # Evento para abortar el proceso completo (en todos los workers) si falta CAE
+    abortar = threading.Event()
+    # Tiempo total (segundos) de cada remito procesado
+    tiempos_remitos = []
+    if ledger is None:
+        ledger = LedgerFacturacion(get_run_id(), company)
+
+    cola = queue.Queue()
+    for i, remito in enumerate(resumen, 1):
+        cola.put((i, remito))
+
+    # Un worker por navegador: este hilo usa la sesión recibida y los demás abren la suya
+    workers = min(get_facturacion_workers(company), len(resumen)) or 1
+    hilos = []
+    if workers > 1:
+        print_with_time(f"Facturando con {workers} navegadores en paralelo")
+        for numero in range(1, workers):
+            hilo = threading.Thread(
+                target=_worker_facturacion,
+                args=(numero, get_run_id(), salida_del_hilo(), company, cola, len(resumen), resultado, lock, abortar, tiempos_remitos, ledger),
+                daemon=True,
+            )
+            hilos.append(hilo)
+            hilo.start()
+
+    # Si Chromium se cae, el supervisor relanza y vuelve a loguear (sin `playwright`,
+    # sesión del pool, con el mismo tipo de navegador)
+    sesion = SupervisorSesion(browser, context, page, company, playwright)
+    try:
+        _facturar_cola(sesion, company, cola, len(resumen), resultado, lock, abortar, tiempos_remitos, ledger)
+        for hilo in hilos:
+            hilo.join()
+        # Se toman siempre: si no, quedan para la próxima empresa de la ejecución
+        navegacion = tomar_navegacion_stats()
+
+        if tiempos_remitos:
+            print_with_time(f"Tiempo por remito: promedio {sum(tiempos_remitos) / len(tiempos_remitos):.1f}s - máximo {max(tiempos_remitos):.1f}s")
+            print_with_time(f"Vueltas a la lista de facturas: {navegacion}")
+            print_with_time(f"Búsqueda de frames: {get_frames_stats(sesion.page)}")
+        if sesion.reinicios:
+            print_with_time(f"Reinicios del navegador durante la facturación: {sesion.reinicios}")
+    finally:
+        sesion.cerrar()
+
+    # Remitos que quedaron en la cola porque todos los navegadores se perdieron
+    while not abortar.is_set() and not cola.empty():
+        _, remito = cola.get_nowait()
+        resultado['no_procesados_lista'].append({'comprobante': remito['comprobante'], 'razon': 'Sesión del navegador perdida'})
+
+    remitos_exitosos_lista = resultado['exitosos_lista']
+    remitos_fallidos_lista = resultado['fallidos_lista']
+    remitos_no_procesados_lista = resultado['no_procesados_lista']
+    return len(remitos_exitosos_lista), len(remitos_fallidos_lista), remitos_exitosos_lista, remitos_fallidos_lista, len(remitos_no_procesados_lista), remitos_no_procesados_lista
 
 def run_finnegans_reports(browser, context, page) -> None:
     if not page:
@@ -1093,97 +1034,32 @@ def run_finnegans_reports(browser, context, page) -> None:
     current_url = page.url
     print_with_time(f"Current URL: {current_url}")
     
-    screenshot_bytes = page.screenshot()
-    save_screenshot(screenshot_bytes, "finnegans_reports_start.png")
+    capturar(page, "finnegans_reports_start.png")
     print_with_time("Ready for reports operations...")
 
 
     
-def close_finnegans_session(browser, context):
-    if context:
-        # Obtener el path del video antes de cerrar el contexto (solo si está habilitado)
-        enable_video = os.getenv('ENABLE_VIDEO_RECORDING', 'false').lower() == 'true'
-        if enable_video:
-            try:
-                pages = context.pages
-                for page in pages:
-                    if hasattr(page, 'video') and page.video:
-                        video_path = page.video.path()
-                        if video_path:
-                            print_with_time(f"Video grabado guardado en: {video_path}")
-                            break
-            except Exception as e:
-                print_with_time(f"Error obteniendo path del video: {e}")
-            
-            print_with_time("Video recording stopped")
-        
-        context.close()
-    if browser:
-        browser.close()
-    print_with_time("Session closed")
-
-def install_hud(context):
-    context.add_init_script("""
-        window.__hud = (function(){
-      const ID='a4b-hud-banner';
-      function ensure(){
-        let el = document.getElementById(ID);
-        if (!el) {
-          el = document.createElement('div');
-          el.id = ID;
-          el.style.cssText = [
-            'position:fixed',
-            'top:20px',
-            'left:50%',
-            'transform:translateX(-50%)',
-            'background:rgba(0,0,0,0.8)',
-            'color:#fff',
-            'padding:10px 20px',
-            'border-radius:12px',
-            'font:600 15px system-ui, sans-serif',
-            'z-index:2147483647',
-            'pointer-events:none',
-            'border:3px solid #02ceff',         /* 🔹 RECUADRO CELESTE */
-            'box-shadow:0 4px 20px rgba(0,0,0,.6)',
-            'backdrop-filter: blur(2px)',
-            'text-align:center',
-            'max-width:70vw'
-          ].join(';');
-          el.setAttribute('aria-live','polite');
-          document.body.appendChild(el);
-        }
-        return el;
-      }
-      return {
-        set(text){
-          const el = ensure();
-          el.textContent = text || '';
-        },
-        hide(){
-          const el = document.getElementById(ID);
-          if (el) el.remove();
-        }
-      };
-    })();
-    """)
-    
-def show_comprobante(page, texto):
-    page.evaluate(f"window.__hud && window.__hud.set('{texto}')")
-
-def hide_comprobante(page):
-    page.evaluate("window.__hud && window.__hud.hide()")
-    
-def process_company(company: str) -> None:
+def process_company(company: str, sesion: tuple = None, compartida: SesionCompartida = None) -> None:
+    """
+    Procesa la empresa. `sesion` = (browser, context, page) ya logueada (pool de
+    navegadores de la API); `compartida` = sesión que reutilizan varias empresas
+    (procesar_empresas). Si no se indica ninguna se abre y cierra una sesión propia.
+    """
     inicio = datetime.now()
     print_with_time("Starting Finnegans login automation...")
     print_with_time(f"Fecha y hora de inicio: {inicio.strftime('%Y-%m-%d %H:%M:%S')}")
 
 
-    remitos = get_remitos_pendientes(company)
+    with span('api.remitos_pendientes', empresa=company):
+        remitos = get_remitos_pendientes(company)
 
     resumen = resumir_transacciones(remitos)
     print_with_time(f"Found {len(resumen)} unique remitos to process")
 
+    # Retomar una ejecución anterior interrumpida: omitir lo ya facturado
+    ledger = LedgerFacturacion(get_run_id(), company)
+    a_procesar, omitidos = ledger.preparar(resumen)
+
     remitos_exitosos = 0
     remitos_fallidos = 0
     remitos_no_procesados = 0
@@ -1197,32 +1073,43 @@ def process_company(company: str) -> None:
     
      # Solo proceder si hay remitos para procesar
     
-    if len(resumen) > 0 and resumen is not None:
-        with sync_playwright() as playwright:
-            browser, context, page = run_finnegans_login(playwright)
+    if len(a_procesar) > 0:
+        with (nullcontext() if sesion or compartida else sync_playwright()) as playwright:
+            propia = compartida is None
+            if propia:
+                compartida = SesionCompartida(playwright, sesion)
+            browser, context, page = compartida.obtener()
 
             if browser and context and page:
                 print_with_time(f"=== POST-LOGIN URL: {page.url} ===")
 
                 # Ejecutar diferentes módulos
-                remitos_exitosos, remitos_fallidos, remitos_exitosos_lista, remitos_fallidos_lista, remitos_no_procesados, remitos_no_procesados_lista = run_finnegans_facturacion(browser, context, page, company, resumen)
+                remitos_exitosos, remitos_fallidos, remitos_exitosos_lista, remitos_fallidos_lista, remitos_no_procesados, remitos_no_procesados_lista = run_finnegans_facturacion(browser, context, page, company, a_procesar, ledger, compartida.playwright)
 
                 # Opcional: ejecutar otros módulos
                 # run_finnegans_reports(browser, context, page)
 
                 #input("\nPress Enter to close browser...")
-                close_finnegans_session(browser, context)
+                if propia:
+                    compartida.cerrar()
             else:
                 print_with_time("Login failed, skipping additional operations")
-                remitos_fallidos = len(resumen)
-                remitos_fallidos_lista = [{'comprobante': r['comprobante'], 'error': 'Login failed'} for r in resumen]
+                remitos_fallidos = len(a_procesar)
+                remitos_fallidos_lista = [{'comprobante': r['comprobante'], 'error': 'Login failed'} for r in a_procesar]
+                ledger.registrar(a_procesar, FALLIDO, 'Login failed')
             
     else:
         print_with_time("No remitos found to process")
 
+    if omitidos:
+        remitos_no_procesados_lista = remitos_no_procesados_lista + omitidos
+        remitos_no_procesados = len(remitos_no_procesados_lista)
+
+    pasos = publicar_spans(company, 'facturacion')
     fin = datetime.now()
     tiempo_transcurrido = fin - inicio
     print_summary(remitos_exitosos, remitos_fallidos, remitos_exitosos_lista, remitos_fallidos_lista, remitos_no_procesados, remitos_no_procesados_lista, resumen, inicio, fin, fin - inicio)
+    publicar_resumen_empresa(company, 'facturacion', len(resumen), remitos_exitosos_lista, remitos_fallidos_lista, remitos_no_procesados_lista, inicio, fin, pasos=pasos)
 
 def print_summary(remitos_exitosos, remitos_fallidos, remitos_exitosos_lista, remitos_fallidos_lista, remitos_no_procesados, remitos_no_procesados_lista, resumen, inicio, fin, tiempo_transcurrido):
     print_with_time("=" * 50)
@@ -1283,20 +1170,19 @@ def print_summary(remitos_exitosos, remitos_fallidos, remitos_exitosos_lista, re
     
 def customer_update(page, cuit):
     navigate_to_section(page, "Clientes")
-    time.sleep(2)
-    frame = page.wait_for_event("frameattached", timeout=10000)
-    frame=page.frames[1] # Ajusta el índice según sea necesario
+    frame = wait_in_all_frames(page, 'busqueda', timeout=30000)
     percepcion_valor = 0.0
     filters = frame.locator("input.TOOLBARTooltipSearch")
     filters.fill(cuit)
     filters.press('Enter')
+    esperar("buscar cliente", xhr_inactivos(page))
     grid_body = frame.locator("div.webix_ss_body")
     cantidad_registros = grid_body.locator("div.webix_cell")
     if cantidad_registros.count() >0:
         percepcion_valor = 0
         link = frame.locator('div.webix_column[column="2"] a')
         link.first.click()
-        time.sleep(2)
+        esperar("abrir cliente", visible(frame.locator('div.tab[name="Retenciones y Percepciones"]')))
         agregar_percepcion( frame, percepcion_valor)
     
     boton_guardar = frame.locator("#_onSave")
@@ -1304,16 +1190,24 @@ def customer_update(page, cuit):
     #boton_guardar.nth(1).click()
     boton_cerrar = frame.locator("#close")
     boton_cerrar.nth(1).click()
-    time.sleep(1)
+    esperar("cerrar cliente", xhr_inactivos(page))
     
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(description='Process company invoices')
-    parser.add_argument('--company', type=str, required=True, help='Company name to process')
+    parser.add_argument('--company', type=str, nargs='+', required=True, help='Company name(s) to process in one browser session')
+    parser.add_argument('--refresh-cache', action='store_true', help='Ignore cached Finnegans report responses')
     args = parser.parse_args()
 
-    process_company(args.company)
+    if args.refresh_cache:
+        set_force_refresh()
+    resultado = procesar_empresas(process_company, args.company, flujo='facturacion')
+    # Código de salida distinto de 0 si alguna empresa falló: la API marca el job como fallido
+    fallidas = empresas_con_error(resultado)
+    if resultado is None or fallidas:
+        print_with_time(f"Empresas con error: {', '.join(fallidas) or ', '.join(args.company)}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
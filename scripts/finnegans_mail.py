@@ -11,11 +11,21 @@ from pathlib import Path
 from datetime import datetime
 import threading
 import traceback
+import json
+import html
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from util import print_with_time, timestamp, parse_fecha, save_screenshot
-from finnegans_common import close_finnegans_session, install_hud, navigate_to_section, run_finnegans_login, select_company_action, find_in_all_frames, find_frame_with_printer,find_frame_with_plantillas, wait_in_all_frames
+from finnegans_resultado import empresas_con_error, registrar_item
+from finnegans_spans import get_run_id, publicar_spans, registrar_span, set_run_id, span
+from finnegans_common import install_hud, navigate_to_section, procesar_empresas, publicar_resumen_empresa, select_company_action, SesionCompartida, find_in_all_frames, find_frame_with_printer,find_frame_with_plantillas, get_frames_stats, wait_in_all_frames
 from db import get_facturas_envio_pendiente, update_factura_estado
+from finnegans_reports import get_api_url, get_cache_dir, get_report_rows, get_saldos_api_url, set_force_refresh
  
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from email_service import smtp_service
+from browser_pool import redirigir_salida_del_hilo, salida_del_hilo
 
 
 def get_token() -> str:
@@ -24,7 +34,7 @@ def get_token() -> str:
 
     client_id = os.getenv('FINNEGANS_CLIENT_ID', '')
     client_secret = os.getenv('FINNEGANS_SECRET', '')
-    url = f"https://api.teamplace.finneg.com/api/oauth/token?grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}"
+    url = f"{get_api_url()}/oauth/token?grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}"
 
     if not client_id or not client_secret:
         print_with_time("Error: FINNEGANS_CLIENT_ID and FINNEGANS_SECRET must be set in .env file")
@@ -37,56 +47,104 @@ def get_token() -> str:
     exit(1)
 
 
-def get_vencimientos(fecha: Optional[str] = None, circuito: str = "CIRCGRAL", domain: str = "DASDACH") -> List[Dict[str, Any]]:
+def _vencimientos_cache_path(fecha: str, domain: str) -> Path:
+    return get_cache_dir() / f"vencimientos_{domain}_{fecha}.json"
+
+
+def _cargar_vencimientos_cache(fecha: str, domain: str) -> Dict[str, List[Any]]:
+    try:
+        with open(_vencimientos_cache_path(fecha, domain), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print_with_time(f"Caché de vencimientos ilegible: {e}")
+        return {}
+
+
+def _guardar_vencimientos_cache(fecha: str, domain: str, index: Dict[str, List[Any]]) -> None:
+    path = _vencimientos_cache_path(fecha, domain)
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Temporal con nombre único: dos jobs que guardan la misma fecha no se pisan
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent, prefix=path.stem, suffix='.tmp', delete=False) as f:
+            tmp_path = f.name
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print_with_time(f"No se pudo guardar la caché de vencimientos: {e}")
+        if tmp_path:
+            Path(tmp_path).unlink(missing_ok=True)
+
+
+def get_vencimientos(
+    facturas: List[Dict[str, Any]],
+    fecha: Optional[str] = None,
+    circuito: str = "CIRCGRAL",
+    domain: str = "DASDACH",
+) -> Dict[str, List[Any]]:
+    """
+    Obtiene las FECHACASHFLOW solo de las facturas indicadas (por numero_factura).
+
+    Los vencimientos ya conocidos para la fecha se leen de la caché en disco; para
+    el resto se consulta COMPOSICIONSALDOSCLIENTES conservando únicamente las filas
+    de esas facturas. Si FINNEGANS_SALDOS_CLIENTE_PARAM está configurado, la consulta
+    se hace por cliente (CUIT) en lugar de traer el reporte completo.
+    """
+    load_dotenv()
     if not fecha:
         fecha = datetime.now().strftime('%Y%m%d')
-    token = get_token()
-    url = (
-        "https://api.finneg.com/api/reports/COMPOSICIONSALDOSCLIENTES"
-        f"?domain={domain}"
-        f"&PARAMWEBREPORT_fecha={fecha}"
-        f"&PARAMWEBREPORT_circuitocontable={circuito}"
-        f"&ACCESS_TOKEN={token}"
-    )
-    response = requests.get(url)
-    if response.status_code != 200:
-        print_with_time(f"Error al obtener vencimientos: {response.status_code} - {response.text}")
-        return []
-    try:
-        data = response.json()
-        
-    except Exception:
-        print_with_time("Error al parsear vencimientos: respuesta no es JSON válido")
-        return []
-    rows = [
-        {"COMPROBANTE": row.get("COMPROBANTE"), "FECHACASHFLOW": row.get("FECHACASHFLOW")}
-        for row in data
-        if row.get("COMPROBANTE") and row.get("FECHACASHFLOW")
-    ]
-    rows.sort(key=lambda r: (r["COMPROBANTE"], r["FECHACASHFLOW"]))
-    return rows
-
-
-vencimientos = [] #get_vencimientos()
-_vencimientos_index = None
-_vencimientos_index_source = None
-
-def get_fechacashflow_por_comprobante(comprobante: str, vencimientos_list: Optional[List[Dict[str, Any]]] = None) -> List[Any]:
-    """Obtiene las FECHACASHFLOW de un comprobante buscando en el array vencimientos."""
-    global _vencimientos_index, _vencimientos_index_source
-    if vencimientos_list is None:
-        vencimientos_list = vencimientos
-
-    if _vencimientos_index is None or _vencimientos_index_source is not vencimientos_list:
-        index: Dict[str, List[Any]] = {}
-        for row in vencimientos_list:
-            comp = row.get("COMPROBANTE")
-            if not comp:
-                continue
-            index.setdefault(comp, []).append(row.get("FECHACASHFLOW"))
-        _vencimientos_index = index
-        _vencimientos_index_source = vencimientos_list
 
+    index = _cargar_vencimientos_cache(fecha, domain)
+    faltantes: Dict[str, set] = {}
+    for factura in facturas:
+        numero = factura.get('numero_factura')
+        if numero and numero not in index:
+            faltantes.setdefault(factura.get('cuit') or '', set()).add(numero)
+
+    total_faltantes = sum(len(v) for v in faltantes.values())
+    print_with_time(f"Vencimientos en caché: {len(facturas) - total_faltantes}, a consultar: {total_faltantes}")
+    if total_faltantes == 0:
+        return index
+
+    params = {
+        'domain': domain,
+        'PARAMWEBREPORT_fecha': fecha,
+        'PARAMWEBREPORT_circuitocontable': circuito,
+    }
+    cliente_param = os.getenv('FINNEGANS_SALDOS_CLIENTE_PARAM', '')
+    if cliente_param:
+        consultas = [({**params, cliente_param: cuit} if cuit else params, numeros) for cuit, numeros in faltantes.items()]
+    else:
+        consultas = [(params, set().union(*faltantes.values()))]
+
+    encontrados: Dict[str, List[Any]] = {}
+    for consulta_params, numeros in consultas:
+        rows = get_report_rows(
+            'COMPOSICIONSALDOSCLIENTES',
+            consulta_params,
+            filtro=lambda row, numeros=numeros: row.get("COMPROBANTE") in numeros and bool(row.get("FECHACASHFLOW")),
+            api_url=get_saldos_api_url(),
+        )
+        for row in rows:
+            encontrados.setdefault(row["COMPROBANTE"], []).append(row["FECHACASHFLOW"])
+
+    for comprobante, fechas in encontrados.items():
+        index[comprobante] = sorted(fechas)
+    if encontrados:
+        _guardar_vencimientos_cache(fecha, domain, index)
+    return index
+
+
+_vencimientos_index: Dict[str, List[Any]] = {}
+
+def actualizar_vencimientos_index(vencimientos_por_comprobante: Dict[str, List[Any]]) -> None:
+    """Incorpora vencimientos al índice en memoria sin reconstruirlo."""
+    _vencimientos_index.update(vencimientos_por_comprobante)
+
+def get_fechacashflow_por_comprobante(comprobante: str) -> List[Any]:
+    """Obtiene las FECHACASHFLOW de un comprobante desde el índice de vencimientos."""
     return _vencimientos_index.get(comprobante, [])
 
 def get_remito_detalle(DOCNROINT) -> list:
@@ -95,7 +153,7 @@ def get_remito_detalle(DOCNROINT) -> list:
     token = get_token()
     print_with_time(f"Obteniendo remitos pendientes para la empresa: {DOCNROINT}")
 
-    url = f"https://api.teamplace.finneg.com/api/pedidoVenta/{DOCNROINT}?ACCESS_TOKEN={token}"
+    url = f"{get_api_url()}/pedidoVenta/{DOCNROINT}?ACCESS_TOKEN={token}"
 
     response = requests.get(url)
     if response.status_code == 200:
@@ -106,6 +164,157 @@ def get_remito_detalle(DOCNROINT) -> list:
     return []
 
 
+def get_mail_backend() -> str:
+    """Backend de envío (FINNEGANS_MAIL_BACKEND): 'ui' (diálogo de Finnegans) o 'smtp'."""
+    load_dotenv()
+    backend = os.getenv('FINNEGANS_MAIL_BACKEND', 'ui').strip().lower()
+    return backend if backend in ('ui', 'smtp') else 'ui'
+
+
+def armar_mail_factura(numero_factura: str, oc: Optional[str], vencimientos_factura: List[Any]) -> tuple[str, str, str]:
+    """Retorna (asunto, línea de OC, línea de vencimientos) del mail de una factura."""
+    if oc is None or oc.strip() == '':
+        oc_text = ""
+    else:
+        oc_text = f" OC: {oc}"
+    asunto = f"Envío de Factura Das Dach {numero_factura} {oc_text}"
+    vencimiento_text = f"Vencimientos: {vencimientos_factura[0] if len(vencimientos_factura) > 0 else 'N/A'}"
+    return asunto, oc_text, vencimiento_text
+
+
+def get_factura_pdf(factura: Dict[str, Any], token: str) -> bytes:
+    """
+    Descarga el PDF de una factura desde la URL configurada en FINNEGANS_FACTURA_PDF_URL,
+    que admite {api}, {numero_factura}, {docnroint}, {comprobante} y {token}.
+    """
+    url_template = os.getenv('FINNEGANS_FACTURA_PDF_URL', '')
+    url = url_template.format(
+        api=get_api_url(),
+        numero_factura=factura.get('numero_factura') or '',
+        docnroint=factura.get('docnroint') or '',
+        comprobante=factura.get('comprobante') or '',
+        token=token,
+    )
+    params = {} if '{token}' in url_template else {'ACCESS_TOKEN': token}
+    response = requests.get(url, params=params, timeout=(10, 120))
+    if response.status_code != 200:
+        raise Exception(f"Error al obtener el PDF de la factura {factura.get('numero_factura')}: {response.status_code} - {response.text[:200]}")
+    if not response.content.startswith(b'%PDF'):
+        raise Exception(f"La respuesta para la factura {factura.get('numero_factura')} no es un PDF")
+    return response.content
+
+
+EMAIL_VALIDO = re.compile(r'^[^@\s;,]+@[^@\s;,]+\.[^@\s;,]+$')
+
+
+class SinDestinatario(Exception):
+    """El remito no tiene un mail de facturación verificado: la factura no se envía."""
+    pass
+
+
+def get_destinatario_factura(detalle_remito: Any) -> Optional[str]:
+    """
+    Mail de facturación del cliente desde el detalle del remito: el primer campo
+    de FINNEGANS_MAIL_TO_FIELDS (solo campos de mail de facturación, no se
+    adivina con otros mails del cliente) que tenga una única dirección válida.
+    """
+    if not isinstance(detalle_remito, dict):
+        return None
+    campos = os.getenv('FINNEGANS_MAIL_TO_FIELDS', 'USR_EmailFacturacion,EmailFacturacion')
+    for campo in [c.strip() for c in campos.split(',') if c.strip()]:
+        valor = str(detalle_remito.get(campo) or '').strip()
+        if EMAIL_VALIDO.match(valor):
+            return valor
+        if valor:
+            print_with_time(f"El campo {campo} del remito no es un mail válido: {valor}")
+    return None
+
+
+def enviar_factura_smtp(factura: Dict[str, Any], token: str) -> str:
+    """Descarga el PDF de la factura y lo envía por SMTP. Retorna el destinatario."""
+    numero_factura = factura['numero_factura']
+    detalle_remito = get_remito_detalle(factura.get('docnroint'))
+    oc = detalle_remito.get('USROCNUM') if detalle_remito else ''
+    destinatario = get_destinatario_factura(detalle_remito)
+    if not destinatario:
+        raise SinDestinatario(f"El remito {factura['comprobante']} no tiene mail de facturación verificado")
+
+    asunto, oc_text, vencimiento_text = armar_mail_factura(numero_factura, oc, get_fechacashflow_por_comprobante(numero_factura))
+    pdf = get_factura_pdf(factura, token)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = Path(tmp_dir) / f"{numero_factura}.pdf"
+        pdf_path.write_bytes(pdf)
+        body = f"<p>{html.escape(oc_text)}</p><p>{html.escape(vencimiento_text)}</p>"
+        resultado = smtp_service.send_email(destinatario, asunto, body, 'html', str(pdf_path))
+    if not resultado.get('success'):
+        raise Exception(resultado.get('error', 'Error enviando email'))
+    return destinatario
+
+
+def run_envio_facturas_smtp(company: str, facturas: list[dict]) -> tuple:
+    """
+    Envía las facturas sin navegador: PDF por API + SMTPEmailService, en paralelo
+    (FINNEGANS_MAIL_WORKERS hilos). Cada factura pasa a 'Enviado' apenas sale su
+    mail (si el proceso se corta no se reenvía). Las que no tienen mail de
+    facturación verificado quedan sin procesar y pendientes.
+    """
+    fac_exitosos_lista = []
+    fac_fallidos_lista = []
+    fac_no_procesados_lista = []
+
+    load_dotenv()
+    if not os.getenv('FINNEGANS_FACTURA_PDF_URL'):
+        raise Exception("FINNEGANS_FACTURA_PDF_URL debe estar configurada para enviar facturas por SMTP")
+
+    token = get_token()
+    workers = max(1, int(os.getenv('FINNEGANS_MAIL_WORKERS', '4')))
+    print_with_time(f"Enviando {len(facturas)} facturas por SMTP con {workers} hilos")
+
+    run_id = get_run_id()
+    duraciones = {}
+    salida = salida_del_hilo()
+
+    def enviar(factura):
+        set_run_id(run_id)
+        # En el pool, lo que imprime el envío va también a la salida del job
+        if salida:
+            redirigir_salida_del_hilo(salida)
+        t0 = time.monotonic()
+        try:
+            with span('mail.smtp', comprobante=factura['comprobante']):
+                destinatario = enviar_factura_smtp(factura, token)
+            # En el hilo del envío: queda registrada aunque el resto del lote no termine
+            update_factura_estado(factura['id'], factura['comprobante'], 'Enviado')
+            return destinatario
+        finally:
+            duraciones[factura['comprobante']] = round((time.monotonic() - t0) * 1000, 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futuros = {executor.submit(enviar, factura): factura for factura in facturas}
+        for futuro in as_completed(futuros):
+            factura = futuros[futuro]
+            comprobante = factura['comprobante']
+            try:
+                destinatario = futuro.result()
+                fac_exitosos_lista.append(f"{comprobante} - Factura {factura['numero_factura']}")
+                registrar_item(company, comprobante, 'enviado', numero_factura=factura['numero_factura'],
+                               destinatario=destinatario, duracion_ms=duraciones.get(comprobante), backend='smtp')
+                print_with_time(f"Factura {comprobante} enviada por mail a {destinatario}")
+            except SinDestinatario as e:
+                fac_no_procesados_lista.append({'comprobante': comprobante, 'razon': str(e)})
+                registrar_item(company, comprobante, 'no_procesado', numero_factura=factura['numero_factura'],
+                               razon=str(e), duracion_ms=duraciones.get(comprobante), backend='smtp')
+                print_with_time(f"Factura {comprobante} sin enviar: {e}")
+            except Exception as e:
+                fac_fallidos_lista.append({'comprobante': comprobante, 'error': str(e)})
+                registrar_item(company, comprobante, 'fallido', numero_factura=factura['numero_factura'],
+                               error=str(e), duracion_ms=duraciones.get(comprobante), backend='smtp')
+                print_with_time(f"Error enviando factura {comprobante}: {e}")
+
+    return len(fac_exitosos_lista), len(fac_fallidos_lista), fac_exitosos_lista, fac_fallidos_lista, len(fac_no_procesados_lista), fac_no_procesados_lista
+
+
 def run_finnegans_print_factura(browser, context, page, company: str, facturas: list[dict]) -> tuple[int, int, list[dict], list[dict]]:
     fac_exitosos = 0
     fac_fallidos = 0
@@ -125,11 +334,10 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
     time.sleep(2)
     if not navigate_to_section(page, "Facturas de Venta - Das Dach"):
         raise Exception("Failed to navigate to Facturación section")
-    time.sleep(6)
-    frame = page.frames[1]
-    frame_search = wait_in_all_frames(page, "input.TOOLBARTooltipSearch")
+    frame_search = wait_in_all_frames(page, 'busqueda', timeout=30000)
     filters = frame_search.locator("input.TOOLBARTooltipSearch")
     for factura in facturas:
+        t_factura = time.monotonic()
         
         comprobante = factura['comprobante']
         numero_factura = factura['numero_factura']
@@ -148,6 +356,7 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
         if filters.count() > 1:
             filters = filters.nth(0)
 
+        t_paso = time.monotonic()
         filters.clear()
         filters.fill(numero_factura)
         filters.press('Enter')
@@ -157,6 +366,7 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
         
             
         print_with_time(f"Found {cells.count()} cells in the grid")
+        registrar_span('mail.buscar', t_paso, comprobante=comprobante)
         if cells.count() > 0:
                 
             time.sleep(1)
@@ -169,11 +379,11 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
                 # Simulamos éxito
                 
                 # Hace clic cobre la factura para abrirla
+                t_paso = time.monotonic()
                 grid_body.locator('div.webix_column[column="3"] a').first.click()
                 
-                time.sleep(3)
-                
-                frame_factura = find_in_all_frames(page, '#_onPrint')
+                frame_factura = wait_in_all_frames(page, 'factura_abierta')
+                registrar_span('mail.abrir', t_paso, comprobante=comprobante)
                 time.sleep(4)
                 mail = frame_factura.locator('#_onPrint')
                 count_mail = frame_factura.locator('#count_onMail')
@@ -182,13 +392,10 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
                 count_mail_value = int(count_mail_text) if count_mail_text else 0
                 
                 if count_mail_value == 0:
+                    t_paso = time.monotonic()
                     mail.click()
                 
-                    time.sleep(2)
-                
-
-
-                    frame_printer = find_in_all_frames(page, '#overDivPrint')
+                    frame_printer = wait_in_all_frames(page, 'impresora')
                     # NO SE REQUIERAN PLANTILLAS
                     # template = frame_mail.locator("a.TOOLBARBtnStandard.secondary.dropDown", has_text="Plantillas")
                     # template.last.click()
@@ -208,32 +415,30 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
                                             "a.WIDGETWidgetButton",
                                             has_text="Enviar por Mail"
                                         ).click()
-                    time.sleep(3)
-                    frame_mail = find_in_all_frames(page, '#subjectInput')
+                    frame_mail = wait_in_all_frames(page, 'asunto_mail')
                     
                     subject_object = frame_mail.locator("#subjectInput")
                     subject_object.clear()
-                    if OC_text is None or OC_text.strip() == '':
-                        OC_text = ""
-                    else:
-                        OC_text = f" OC: {OC_text}"  
-                    subject_object.fill(f"Envío de Factura Das Dach {numero_factura} {OC_text}")
+                    asunto, OC_text, vencimiento_text = armar_mail_factura(numero_factura, OC_text, vencimientos_factura)
+                    subject_object.fill(asunto)
                     
                     subject_object.press('Tab')
-                    body_frame = find_in_all_frames(page, "#tinymce")
+                    body_frame = wait_in_all_frames(page, 'tinymce')
                     body = body_frame.locator('#tinymce')
                     parrafo1 = body.locator("p").first
                     
                     parrafo1.fill(f"{OC_text}")
                     parrafo2 = body.locator("p").nth(1)
                     
-                    parrafo2.fill(f"Vencimientos: {vencimientos_factura[0] if len(vencimientos_factura) > 0 else 'N/A'}")
+                    parrafo2.fill(vencimiento_text)
 
                     frame_mail_botom = find_in_all_frames(page, "div.sendButton")
                     boton_enviar = frame_mail_botom.locator("div.sendButton")
                     boton_enviar.click()
+                    registrar_span('mail.enviar', t_paso, comprobante=comprobante)
                     fac_exitosos += 1
                     fac_exitosos_lista.append(f"{comprobante} - Factura {numero_factura}")
+                    resultado = 'enviado'
                     print_with_time(f"Factura {comprobante} Mail sent successfully")
                     
                     time.sleep(4)
@@ -252,6 +457,7 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
                     print_with_time(f"Factura {comprobante} not processed, mail count: {count_mail_value}")
                     fac_no_procesados += 1
                     fac_no_procesados_lista.append({'comprobante': comprobante, 'razon': f"Mail count is {count_mail_value}, Mail ya enviado"})
+                    resultado = 'no_procesado'
                     update_factura_estado(factura.get('id'), comprobante, 'Enviado')
                 
                 
@@ -262,8 +468,15 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
                                         "a.TOOLBARBtnStandard",
                                         has_text="Cerrar"
                                     ).first.click()
+                registro = registrar_span('mail.factura', t_factura, comprobante=comprobante)
+                registrar_item(company, comprobante, resultado, numero_factura=numero_factura,
+                               razon=fac_no_procesados_lista[-1]['razon'] if resultado == 'no_procesado' else None,
+                               duracion_ms=registro['duracion_ms'], backend='ui')
                 
             except Exception as e:
+                registro = registrar_span('mail.factura', t_factura, ok=False, comprobante=comprobante)
+                registrar_item(company, comprobante, 'fallido', numero_factura=numero_factura, error=str(e),
+                               duracion_ms=registro['duracion_ms'], backend='ui')
                 fac_fallidos += 1
                 fac_fallidos_lista.append({'comprobante': comprobante, 'error': str(e)})
                 print_with_time(f"Error processing factura {comprobante}: {e}")
@@ -272,15 +485,21 @@ def run_finnegans_print_factura(browser, context, page, company: str, facturas:
         else:
             print_with_time(f"No cells found in the grid for factura {numero_factura}")
         time.sleep(3)
+    print_with_time(f"Búsqueda de frames: {get_frames_stats(page)}")
     return fac_exitosos, fac_fallidos, fac_exitosos_lista, fac_fallidos_lista, fac_no_procesados, fac_no_procesados_lista
 
-def process_company(company: str) -> None:
+def process_company(company: str, sesion: tuple = None, compartida: SesionCompartida = None) -> None:
+    """
+    Procesa la empresa. `sesion` = (browser, context, page) ya logueada (pool de
+    navegadores de la API); `compartida` = sesión que reutilizan varias empresas
+    (procesar_empresas). Si no se indica ninguna se abre y cierra una sesión propia.
+    """
     inicio = datetime.now()
     print_with_time("Starting Finnegans login automation...")
     print_with_time(f"Fecha y hora de inicio: {inicio.strftime('%Y-%m-%d %H:%M:%S')}")
 
 
-    facturas_envio_pendiente = get_facturas_envio_pendiente()
+    facturas_envio_pendiente = get_facturas_envio_pendiente(company)
     print_with_time(f"Found {len(facturas_envio_pendiente)} unique remitos to process")
 
     fac_exitosos = 0
@@ -297,35 +516,42 @@ def process_company(company: str) -> None:
      # Solo proceder si hay remitos para procesar
     
     if len(facturas_envio_pendiente) > 0 and facturas_envio_pendiente is not None:
-        global vencimientos, _vencimientos_index, _vencimientos_index_source
-        vencimientos = get_vencimientos()
-        _vencimientos_index = None
-        _vencimientos_index_source = None
-        with sync_playwright() as playwright:
-            browser, context, page = run_finnegans_login(playwright)
-
-            if browser and context and page:
-                print_with_time(f"=== POST-LOGIN URL: {page.url} ===")
-
-                # Ejecutar diferentes módulos
-                fac_exitosos, fac_fallidos, fac_exitosos_lista, fac_fallidos_lista, fac_no_procesados, fac_no_procesados_lista = run_finnegans_print_factura(browser, context, page, company, facturas_envio_pendiente)
-
-                # Opcional: ejecutar otros módulos
-                # run_finnegans_reports(browser, context, page)
-
-                #input("\nPress Enter to close browser...")
-                close_finnegans_session(browser, context)
-            else:
-                print_with_time("Login failed, skipping additional operations")
-                #remitos_fallidos = len(resumen)
-                #remitos_fallidos_lista = [{'comprobante': r['comprobante'], 'error': 'Login failed'} for r in resumen]
+        with span('api.vencimientos', empresa=company):
+            actualizar_vencimientos_index(get_vencimientos(facturas_envio_pendiente))
+        if get_mail_backend() == 'smtp':
+            fac_exitosos, fac_fallidos, fac_exitosos_lista, fac_fallidos_lista, fac_no_procesados, fac_no_procesados_lista = run_envio_facturas_smtp(company, facturas_envio_pendiente)
+        else:
+            with (nullcontext() if sesion or compartida else sync_playwright()) as playwright:
+                propia = compartida is None
+                if propia:
+                    compartida = SesionCompartida(playwright, sesion)
+                browser, context, page = compartida.obtener()
+
+                if browser and context and page:
+                    print_with_time(f"=== POST-LOGIN URL: {page.url} ===")
+
+                    # Ejecutar diferentes módulos
+                    fac_exitosos, fac_fallidos, fac_exitosos_lista, fac_fallidos_lista, fac_no_procesados, fac_no_procesados_lista = run_finnegans_print_factura(browser, context, page, company, facturas_envio_pendiente)
+
+                    # Opcional: ejecutar otros módulos
+                    # run_finnegans_reports(browser, context, page)
+
+                    #input("\nPress Enter to close browser...")
+                    if propia:
+                        compartida.cerrar()
+                else:
+                    print_with_time("Login failed, skipping additional operations")
+                    #remitos_fallidos = len(resumen)
+                    #remitos_fallidos_lista = [{'comprobante': r['comprobante'], 'error': 'Login failed'} for r in resumen]
             
     else:
         print_with_time("No remitos found to process")
 
+    pasos = publicar_spans(company, 'mail')
     fin = datetime.now()
     tiempo_transcurrido = fin - inicio
     print_summary(fac_exitosos, fac_fallidos, fac_exitosos_lista, fac_fallidos_lista, fac_no_procesados, fac_no_procesados_lista, facturas_envio_pendiente, inicio, fin, fin - inicio)
+    publicar_resumen_empresa(company, 'mail', len(facturas_envio_pendiente), fac_exitosos_lista, fac_fallidos_lista, fac_no_procesados_lista, inicio, fin, pasos=pasos)
 
 def print_summary(remitos_exitosos, remitos_fallidos, remitos_exitosos_lista, remitos_fallidos_lista, remitos_no_procesados, remitos_no_procesados_lista, resumen, inicio, fin, tiempo_transcurrido):
     print_with_time("=" * 50)
@@ -389,10 +615,18 @@ def main():
     import argparse
 
     parser = argparse.ArgumentParser(description='Process company invoices')
-    parser.add_argument('--company', type=str, required=True, help='Company name to process')
+    parser.add_argument('--company', type=str, nargs='+', required=True, help='Company name(s) to process in one browser session')
+    parser.add_argument('--refresh-cache', action='store_true', help='Ignore cached Finnegans report responses')
     args = parser.parse_args()
 
-    process_company(args.company)
+    if args.refresh_cache:
+        set_force_refresh()
+    resultado = procesar_empresas(process_company, args.company, flujo='mail')
+    # Código de salida distinto de 0 si alguna empresa falló: la API marca el job como fallido
+    fallidas = empresas_con_error(resultado)
+    if resultado is None or fallidas:
+        print_with_time(f"Empresas con error: {', '.join(fallidas) or ', '.join(args.company)}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+import codecs
+import hashlib
+import json
+import os
+import threading
+import time
+import tempfile
+import requests
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from util import get_state_dir, print_with_time, sacar_de_data
+from finnegans_common import get_token
+
+# Tamaño de cada bloque leído de la respuesta al parsear en streaming
+REPORT_CHUNK_SIZE = 64 * 1024
+# (conexión, lectura) en segundos para las llamadas a reportes
+REPORT_TIMEOUT = (15, 300)
+
+_JSON_SEPARATORS = ' \t\r\n,'
+
+# Forzar la descarga aunque exista una respuesta vigente en caché (--refresh-cache).
+# Es por hilo: los jobs del pool de la API corren en el mismo proceso y cada uno tiene el suyo
+_force_refresh = threading.local()
+
+
+def get_api_url() -> str:
+    """Retorna la URL base de la API de Finnegans (configurable para pruebas)"""
+    load_dotenv()
+    return os.getenv('FINNEGANS_API_URL', 'https://api.teamplace.finneg.com/api').rstrip('/')
+
+
+def get_saldos_api_url() -> str:
+    """URL base usada para el reporte COMPOSICIONSALDOSCLIENTES"""
+    load_dotenv()
+    return os.getenv('FINNEGANS_SALDOS_API_URL', 'https://api.finneg.com/api').rstrip('/')
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """
+    Parsea incrementalmente un array JSON recibido en bloques de bytes y devuelve
+    cada elemento apenas está completo, sin mantener la respuesta entera en memoria.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    started = False
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer = buffer[pos:] + utf8.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in _JSON_SEPARATORS:
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("La respuesta no es un array JSON")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Elemento incompleto: leer el próximo bloque
+                break
+            if not isinstance(item, (dict, list)) and (end >= len(buffer) or buffer[end] not in _JSON_SEPARATORS + ']'):
+                # Un escalar (p.ej. un número) puede continuar en el próximo bloque
+                break
+            yield item
+            pos = end
+
+    raise ValueError("Respuesta JSON incompleta")
+
+
+def set_force_refresh(value: bool = True) -> None:
+    """Ignora la caché de reportes en el hilo actual (las respuestas nuevas se guardan igual)"""
+    _force_refresh.activo = value
+
+
+def get_cache_dir() -> Path:
+    """Directorio de la caché de reportes (por defecto state/finnegans_cache, fuera del /data público)"""
+    load_dotenv()
+    cache_dir = os.getenv('FINNEGANS_CACHE_DIR')
+    if cache_dir:
+        return Path(cache_dir)
+    cache_dir = get_state_dir() / "finnegans_cache"
+    sacar_de_data("finnegans_cache", cache_dir)
+    return cache_dir
+
+
+def get_cache_ttl() -> int:
+    """Segundos de validez de una respuesta en caché (0 desactiva la caché)"""
+    load_dotenv()
+    try:
+        return int(os.getenv('FINNEGANS_CACHE_TTL', '300'))
+    except ValueError:
+        return 300
+
+
+def _cache_path(url: str, params: Dict[str, Any], filtro_key: Optional[str]) -> Path:
+    clave = json.dumps(
+        {'url': url, 'params': {k: str(v) for k, v in params.items()}, 'filtro': filtro_key},
+        sort_keys=True,
+    )
+    return get_cache_dir() / f"{hashlib.sha256(clave.encode('utf-8')).hexdigest()}.json"
+
+
+def _read_cache(path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print_with_time(f"Caché de reportes ilegible ({path.name}): {e}")
+        return None
+
+
+def _write_cache(path: Path, entry: Dict[str, Any]) -> None:
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Temporal con nombre único: dos hilos o procesos que guardan el mismo reporte no se pisan
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent, prefix=path.stem, suffix='.tmp', delete=False) as f:
+            tmp_path = f.name
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print_with_time(f"No se pudo guardar la caché de reportes: {e}")
+        if tmp_path:
+            Path(tmp_path).unlink(missing_ok=True)
+
+
+def get_report_rows(
+    endpoint: str,
+    params: Dict[str, Any],
+    filtro: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    api_url: Optional[str] = None,
+    filtro_key: Optional[str] = None,
+    cache: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Descarga un reporte de api/reports/<endpoint> parseándolo en streaming y
+    conserva solo las filas que cumplen `filtro`. Retorna [] ante cualquier error.
+
+    Las respuestas se guardan en disco por endpoint + parámetros (+ `filtro_key`,
+    que identifica al filtro) y se reutilizan durante FINNEGANS_CACHE_TTL segundos.
+    Vencido ese plazo se revalidan con If-None-Match / If-Modified-Since si la API
+    devolvió ETag o Last-Modified. Con filtro y sin `filtro_key` no se usa caché.
+    Con `cache=False` (listas de trabajo que el flujo modifica, como los remitos
+    pendientes de facturar) siempre se consulta la API y no se guarda nada.
+    """
+    url = f"{(api_url or get_api_url()).rstrip('/')}/reports/{endpoint}"
+    ttl = get_cache_ttl()
+    usar_cache = cache and ttl > 0 and (filtro is None or filtro_key is not None)
+    cache_path = _cache_path(url, params, filtro_key) if usar_cache else None
+    entry = _read_cache(cache_path) if usar_cache else None
+
+    headers = {}
+    if entry is not None and not getattr(_force_refresh, 'activo', False):
+        edad = time.time() - entry.get('fetched_at', 0)
+        if edad < ttl:
+            print_with_time(f"Reporte {endpoint}: {len(entry['rows'])} filas desde caché ({edad:.0f}s)")
+            return entry['rows']
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    query = dict(params)
+    query['ACCESS_TOKEN'] = get_token()
+
+    try:
+        with requests.get(url, params=query, headers=headers, stream=True, timeout=REPORT_TIMEOUT) as response:
+            if response.status_code == 304 and entry is not None:
+                print_with_time(f"Reporte {endpoint}: sin cambios, se reutiliza la caché")
+                entry['fetched_at'] = time.time()
+                _write_cache(cache_path, entry)
+                return entry['rows']
+            if response.status_code != 200:
+                print_with_time(f"Error al obtener el reporte {endpoint}: {response.status_code} - {response.text}")
+                return []
+            rows = []
+            leidas = 0
+            for row in iter_json_array(response.iter_content(chunk_size=REPORT_CHUNK_SIZE)):
+                leidas += 1
+                if filtro is None or filtro(row):
+                    rows.append(row)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+    except ValueError as e:
+        print_with_time(f"Error al parsear el reporte {endpoint}: {e}")
+        return []
+    except requests.RequestException as e:
+        print_with_time(f"Error de conexión al obtener el reporte {endpoint}: {e}")
+        return []
+
+    print_with_time(f"Reporte {endpoint}: {len(rows)} filas conservadas de {leidas} leídas")
+    if usar_cache:
+        _write_cache(cache_path, {
+            'endpoint': endpoint,
+            'params': {k: str(v) for k, v in params.items()},
+            'filtro': filtro_key,
+            'fetched_at': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'rows': rows,
+        })
+    return rows
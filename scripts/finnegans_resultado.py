@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from finnegans_spans import get_run_id
+from finnegans_timeouts import get_empresa
+
+# Resultado estructurado de cada ejecución, para la API (en lugar de leer el log):
+# {run_id: {'run_id', 'flujo', 'started_at', 'finished_at', 'empresas': {empresa: resumen}}}.
+# El resumen de cada empresa incluye un ítem por remito/factura con su resultado,
+# su duración y los datos de la factura. Un subproceso lo escribe en
+# FINNEGANS_RESULT_FILE al terminar cada empresa; en el pool de la API lo
+# devuelve procesar_empresas.
+
+_items: Dict[tuple, Dict[str, Dict[str, Any]]] = {}
+_resultados: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+
+def registrar_item(empresa: Optional[str], comprobante: str, resultado: str, **datos) -> None:
+    """
+    Registra el resultado de un remito (facturación) o factura (mails):
+    'facturado', 'enviado', 'no_procesado' o 'fallido', con datos como
+    duracion_ms, numero_factura, nro_cae, backend, razon o error.
+    """
+    item = {'comprobante': comprobante, 'resultado': resultado, **{k: v for k, v in datos.items() if v is not None}}
+    with _lock:
+        _items.setdefault((get_run_id(), empresa or get_empresa()), {})[comprobante] = item
+
+
+def tomar_items(empresa: str) -> Dict[str, Dict[str, Any]]:
+    """Ítems registrados para la empresa en la ejecución del hilo (y los olvida)"""
+    with _lock:
+        return _items.pop((get_run_id(), empresa), {})
+
+
+def _get_result_file() -> Optional[Path]:
+    load_dotenv()
+    ruta = os.getenv('FINNEGANS_RESULT_FILE')
+    return Path(ruta) if ruta else None
+
+
+def registrar_resultado_empresa(resumen: Dict[str, Any]) -> None:
+    """Agrega el resumen de una empresa al resultado de la ejecución y lo escribe en FINNEGANS_RESULT_FILE"""
+    run_id = get_run_id()
+    with _lock:
+        resultado = _resultados.setdefault(run_id, {
+            'run_id': run_id,
+            'flujo': resumen.get('flujo'),
+            'started_at': resumen.get('started_at'),
+            'empresas': {},
+        })
+        resultado['empresas'][resumen['empresa']] = resumen
+        resultado['finished_at'] = resumen.get('finished_at') or datetime.now().isoformat()
+        documento = json.dumps(resultado, ensure_ascii=False, default=str)
+    ruta = _get_result_file()
+    if ruta:
+        # Reemplazo atómico: la API nunca lee un documento a medio escribir
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = ruta.with_name(ruta.name + '.tmp')
+        temporal.write_text(documento, encoding='utf-8')
+        os.replace(temporal, ruta)
+
+
+def tomar_resultado(run_id: str = None) -> Optional[Dict[str, Any]]:
+    """Resultado de la ejecución (y lo olvida); None si no terminó ninguna empresa"""
+    with _lock:
+        return _resultados.pop(run_id or get_run_id(), None)
+
+
+def empresas_con_error(resultado: Optional[Dict[str, Any]]) -> list:
+    """Empresas del resultado que terminaron con error (no llegaron a procesarse completas)"""
+    return [empresa for empresa, resumen in ((resultado or {}).get('empresas') or {}).items() if resumen.get('error')]
+
+
+def leer_resultado(ruta: Path) -> Optional[Dict[str, Any]]:
+    """Lee el resultado que escribió un subproceso; None si no llegó a escribirlo"""
+    try:
+        return json.loads(Path(ruta).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+from util import get_state_dir, print_with_time, sacar_de_data
+
+# Spans por ejecución: {run_id: [span, ...]}. El run_id es por hilo para que
+# los jobs que corren en el mismo proceso (pool de la API) no se mezclen.
+_spans: Dict[str, List[Dict[str, Any]]] = {}
+_spans_lock = threading.Lock()
+_run_local = threading.local()
+_run_id_proceso = None
+
+
+def get_run_id() -> str:
+    """Id de la ejecución: el fijado en el hilo, FINNEGANS_RUN_ID (el job_id de la API) o uno generado"""
+    global _run_id_proceso
+    run_id = getattr(_run_local, 'run_id', None)
+    if run_id:
+        return run_id
+    if _run_id_proceso is None:
+        load_dotenv()
+        _run_id_proceso = os.getenv('FINNEGANS_RUN_ID') or f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    return _run_id_proceso
+
+
+def set_run_id(run_id: str) -> None:
+    """Asocia el hilo actual a una ejecución (jobs del pool, workers en paralelo)"""
+    _run_local.run_id = run_id
+
+
+def registrar_span(paso: str, t0: float, ok: bool = True, **atributos) -> Dict[str, Any]:
+    """Registra un span que empezó en `t0` (time.monotonic()) y terminó ahora"""
+    duracion = time.monotonic() - t0
+    registro = {
+        'run_id': get_run_id(),
+        'paso': paso,
+        'inicio': datetime.fromtimestamp(time.time() - duracion).isoformat(),
+        'duracion_ms': round(duracion * 1000, 1),
+        'ok': ok,
+        **atributos,
+    }
+    with _spans_lock:
+        _spans.setdefault(registro['run_id'], []).append(registro)
+    print(f"SPAN {json.dumps(registro, ensure_ascii=False, default=str)}", flush=True)
+    return registro
+
+
+@contextmanager
+def span(paso: str, **atributos):
+    """
+    Mide un paso del flujo y lo emite como una línea JSON (`SPAN {...}`).
+    Los atributos extra (comprobante, empresa, ...) se incluyen en el span;
+    se pueden agregar más desde adentro modificando el dict que se devuelve.
+    """
+    t0 = time.monotonic()
+    ok = True
+    try:
+        yield atributos
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        registrar_span(paso, t0, ok, **atributos)
+
+
+def get_spans(run_id: str = None) -> List[Dict[str, Any]]:
+    with _spans_lock:
+        return list(_spans.get(run_id or get_run_id(), []))
+
+
+def _percentil(valores: List[float], p: float) -> float:
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(round(p * (len(valores) - 1))))]
+
+
+def resumen_spans(run_id: str = None) -> Dict[str, Dict[str, Any]]:
+    """{paso: {'n', 'errores', 'p50_ms', 'p95_ms', 'max_ms', 'total_ms'}}"""
+    por_paso: Dict[str, List[Dict[str, Any]]] = {}
+    for registro in get_spans(run_id):
+        por_paso.setdefault(registro['paso'], []).append(registro)
+    resumen = {}
+    for paso, registros in sorted(por_paso.items()):
+        duraciones = [r['duracion_ms'] for r in registros]
+        resumen[paso] = {
+            'n': len(registros),
+            'errores': sum(1 for r in registros if not r['ok']),
+            'p50_ms': _percentil(duraciones, 0.50),
+            'p95_ms': _percentil(duraciones, 0.95),
+            'max_ms': max(duraciones),
+            'total_ms': round(sum(duraciones), 1),
+        }
+    return resumen
+
+
+def _get_spans_file() -> Path:
+    load_dotenv()
+    ruta = os.getenv('FINNEGANS_SPANS_FILE')
+    if ruta:
+        return Path(ruta)
+    # Fuera de data/, que la API sirve sin autenticación en /data
+    ruta = get_state_dir() / "finnegans_spans.jsonl"
+    sacar_de_data("finnegans_spans.jsonl", ruta)
+    return ruta
+
+
+def publicar_spans(empresa: str, flujo: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Persiste los spans en Postgres para consultar tendencias y recalcular los
+    timeouts aprendidos de la empresa. Si la base no está disponible se
+    agregan a un archivo JSONL. Retorna el resumen p50/p95 por paso (va en el
+    resultado de la empresa).
+    """
+    run_id = get_run_id()
+    spans = get_spans(run_id)
+    if not spans:
+        return {}
+    resumen = resumen_spans(run_id)
+    with _spans_lock:
+        _spans.pop(run_id, None)
+    try:
+        from db import guardar_spans
+        guardar_spans(spans, empresa, flujo)
+    except Exception as e:
+        print_with_time(f"No se pudieron guardar los spans en PostgreSQL ({e}), se usan archivos locales")
+        try:
+            ruta = _get_spans_file()
+            ruta.parent.mkdir(parents=True, exist_ok=True)
+            with open(ruta, 'a', encoding='utf-8') as f:
+                for registro in spans:
+                    f.write(json.dumps({**registro, 'empresa': empresa, 'flujo': flujo}, ensure_ascii=False, default=str) + '\n')
+        except Exception as e2:
+            print_with_time(f"No se pudieron guardar los spans: {e2}")
+        return resumen
+    try:
+        from finnegans_timeouts import recalcular_timeouts
+        recalcular_timeouts(empresa)
+    except Exception as e:
+        print_with_time(f"No se pudieron recalcular los timeouts de {empresa}: {e}")
+    return resumen
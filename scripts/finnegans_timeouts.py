@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from dotenv import load_dotenv
+from util import print_with_time
+
+# Timeouts aprendidos de la duración histórica de cada paso (tabla
+# finnegans_timeouts, recalculada desde finnegans_spans al terminar cada
+# ejecución): timeout = percentil (p99) x factor de seguridad, acotado entre un
+# mínimo y un máximo. Sin historia suficiente se usa el timeout fijo del paso.
+
+# Paso sintético con la duración total de cada ejecución, por flujo (timeout del job en la API)
+PASO_EJECUCION = 'ejecucion'
+
+_empresa_local = threading.local()
+_cache: Dict[str, Dict[str, int]] = {}
+_cache_cargado: Dict[str, float] = {}
+_cache_lock = threading.Lock()
+_avisados = set()
+
+
+def _get_float(nombre: str, defecto: float) -> float:
+    try:
+        return float(os.getenv(nombre, str(defecto)))
+    except ValueError:
+        return defecto
+
+
+_config = None
+
+
+def get_config() -> dict:
+    """Configuración de los timeouts adaptativos (se lee una vez por proceso: se consulta en cada espera)"""
+    global _config
+    if _config is not None:
+        return _config
+    load_dotenv()
+    _config = {
+        'activo': os.getenv('FINNEGANS_TIMEOUTS_ADAPTATIVOS', 'true').strip().lower() not in ('0', 'false', 'no'),
+        'percentil': min(max(_get_float('FINNEGANS_TIMEOUT_PERCENTIL', 0.99), 0.5), 1.0),
+        'factor': max(_get_float('FINNEGANS_TIMEOUT_FACTOR', 3.0), 1.0),
+        'min_ms': int(_get_float('FINNEGANS_TIMEOUT_MIN_MS', 2000)),
+        'max_ms': int(_get_float('FINNEGANS_TIMEOUT_MAX_MS', 180000)),
+        'muestras': int(_get_float('FINNEGANS_TIMEOUT_MUESTRAS', 20)),
+        'dias': int(_get_float('FINNEGANS_TIMEOUT_DIAS', 14)),
+        'recarga_segundos': int(_get_float('FINNEGANS_TIMEOUT_RECARGA', 3600)),
+        'job_min_s': int(_get_float('FINNEGANS_JOB_TIMEOUT_MIN', 1800)),
+        'job_max_s': int(_get_float('FINNEGANS_JOB_TIMEOUT_MAX', 7200)),
+    }
+    return _config
+
+
+def set_empresa(empresa: Optional[str]) -> None:
+    """Empresa que procesa el hilo actual (los timeouts aprendidos son por empresa)"""
+    _empresa_local.empresa = empresa
+
+
+def get_empresa() -> Optional[str]:
+    return getattr(_empresa_local, 'empresa', None)
+
+
+def _timeouts_empresa(empresa: str, config: dict) -> Dict[str, int]:
+    """{paso: timeout_ms} de la empresa, leído de la base una vez por hora"""
+    with _cache_lock:
+        cargado = _cache_cargado.get(empresa)
+        if cargado is not None and time.monotonic() - cargado < config['recarga_segundos']:
+            return _cache.get(empresa, {})
+        # Marcar como cargado antes de consultar: si la base falla no se reintenta en cada paso
+        _cache_cargado[empresa] = time.monotonic()
+    try:
+        from db import get_timeouts_pasos
+        timeouts = get_timeouts_pasos(empresa)
+    except Exception as e:
+        print_with_time(f"No se pudieron leer los timeouts aprendidos de {empresa} ({e}), se usan los fijos")
+        timeouts = {}
+    with _cache_lock:
+        _cache[empresa] = timeouts
+    if timeouts:
+        print_with_time(f"Timeouts aprendidos para {empresa}: {len(timeouts)} pasos")
+    return timeouts
+
+
+def timeout_para(paso: str, defecto: int, empresa: str = None, reducible: bool = True) -> int:
+    """
+    Timeout (ms) del paso para la empresa del hilo: el aprendido si hay
+    historia suficiente, si no `defecto`. Con `reducible=False` (pasos
+    posteriores al guardado de la factura, donde un timeout deja una factura
+    sin registrar) el aprendido solo puede alargarlo, nunca bajar de `defecto`.
+    """
+    config = get_config()
+    empresa = empresa or get_empresa()
+    if not config['activo'] or not empresa:
+        return defecto
+    aprendido = _timeouts_empresa(empresa, config).get(paso)
+    if aprendido is None:
+        return defecto
+    if not reducible:
+        aprendido = max(aprendido, defecto)
+    if (empresa, paso) not in _avisados:
+        _avisados.add((empresa, paso))
+        print_with_time(f"Timeout de '{paso}' para {empresa}: {aprendido} ms (fijo {defecto} ms)")
+    return aprendido
+
+
+def timeout_job(empresas: Iterable[str], flujo: str, defecto: int = 1800) -> int:
+    """
+    Límite (segundos) de un job de la API: suma de los timeouts aprendidos de
+    la ejecución completa del flujo ('facturacion' o 'mail') de cada empresa,
+    o `defecto` si alguna no tiene historia. Nunca es menor que `defecto` ni
+    que FINNEGANS_JOB_TIMEOUT_MIN: la duración aprendida no depende de la
+    cantidad de remitos, y una semana de ejecuciones chicas no debe cortar el
+    lote grande de fin de mes.
+    """
+    config = get_config()
+    if not config['activo']:
+        return defecto
+    total_ms = 0
+    for empresa in empresas:
+        aprendido = _timeouts_empresa(empresa, config).get(f"{PASO_EJECUCION}.{flujo}")
+        if aprendido is None:
+            return defecto
+        total_ms += aprendido
+    return int(min(max(total_ms / 1000, config['job_min_s'], defecto), config['job_max_s']))
+
+
+def recalcular_timeouts(empresa: str) -> None:
+    """Recalcula los timeouts de la empresa desde finnegans_spans (al terminar cada ejecución)"""
+    config = get_config()
+    if not config['activo']:
+        return
+    from db import actualizar_timeouts_pasos
+    actualizar_timeouts_pasos(
+        empresa,
+        percentil=config['percentil'],
+        factor=config['factor'],
+        min_ms=config['min_ms'],
+        max_ms=config['max_ms'],
+        muestras=config['muestras'],
+        dias=config['dias'],
+        paso_ejecucion=PASO_EJECUCION,
+        max_ejecucion_ms=config['job_max_s'] * 1000,
+    )
+    with _cache_lock:
+        _cache_cargado.pop(empresa, None)
@@ -1,6 +1,11 @@
 
+import atexit
+import queue
+import threading
+from collections import deque
 from datetime import datetime
 import os
+import shutil
 from pathlib import Path
 from typing import Any, Optional
 
@@ -112,17 +117,22 @@ def install_hud(context):
     })();
     """)
     
+_photo_dir = None
+
+def get_photo_dir() -> Path:
+    """Directorio de screenshots (LOG_PHOTO_PATH); se resuelve y crea una sola vez"""
+    global _photo_dir
+    if _photo_dir is None:
+        load_dotenv()
+        _photo_dir = Path(os.getenv('LOG_PHOTO_PATH', './media/photos/'))
+        _photo_dir.mkdir(parents=True, exist_ok=True)
+    return _photo_dir
+
 def save_screenshot(image_bytes, filename):
     """Guardar screenshot usando la ruta del .env"""
     try:
-        load_dotenv()
-        photo_path = os.getenv('LOG_PHOTO_PATH', './media/photos/')
-        
-        # Crear el directorio si no existe
-        Path(photo_path).mkdir(parents=True, exist_ok=True)
-        
         # Crear la ruta completa del archivo
-        full_path = Path(photo_path) / filename
+        full_path = get_photo_dir() / filename
         
         # Guardar el archivo
         with open(full_path, 'wb') as f:
@@ -135,7 +145,114 @@ def save_screenshot(image_bytes, filename):
     except Exception as e:
         print_with_time(f"Error guardando screenshot: {e}")
         return None
-    
+
+# ==================== Capturas en memoria ====================
+# Las capturas de cada remito se toman en JPEG y se guardan en un anillo en
+# memoria; solo se escriben a disco (en un hilo aparte) si el remito falla o
+# si FINNEGANS_SCREENSHOT_DEBUG=true.
+
+_capturas = threading.local()
+_cola_escritura = queue.Queue()
+_escritor = None
+_escritor_lock = threading.Lock()
+
+def _get_captura_config() -> dict:
+    load_dotenv()
+    return {
+        'debug': os.getenv('FINNEGANS_SCREENSHOT_DEBUG', 'false').lower() == 'true',
+        'calidad': int(os.getenv('FINNEGANS_SCREENSHOT_QUALITY', '50')),
+        'anillo': int(os.getenv('FINNEGANS_SCREENSHOT_RING', '8')),
+    }
+
+def _escribir_capturas():
+    while True:
+        nombre, data = _cola_escritura.get()
+        try:
+            save_screenshot(data, nombre)
+        finally:
+            _cola_escritura.task_done()
+
+def _encolar_escritura(nombre: str, data: bytes) -> None:
+    global _escritor
+    with _escritor_lock:
+        if _escritor is None:
+            _escritor = threading.Thread(target=_escribir_capturas, name="screenshot-writer", daemon=True)
+            _escritor.start()
+    _cola_escritura.put((nombre, data))
+
+def esperar_escrituras() -> None:
+    """Bloquea hasta que el hilo escritor haya guardado todas las capturas encoladas"""
+    if _escritor is not None:
+        _cola_escritura.join()
+
+# Que las capturas encoladas lleguen a disco antes de que termine el proceso
+atexit.register(esperar_escrituras)
+
+def iniciar_capturas(clave: str) -> None:
+    """Empieza un anillo nuevo de capturas (p.ej. por remito) en el hilo actual"""
+    _capturas.config = _get_captura_config()
+    _capturas.clave = clave
+    _capturas.anillo = deque(maxlen=max(1, _capturas.config['anillo']))
+
+def _nombre_captura(nombre: str) -> str:
+    nombre = Path(nombre).with_suffix('.jpg').name
+    clave = getattr(_capturas, 'clave', 'general')
+    return nombre if clave == 'general' else f"{clave}_{nombre}"
+
+def capturar(page, nombre: str, guardar: bool = False) -> None:
+    """
+    Toma una captura JPEG liviana. Con `guardar` (o en modo debug) se escribe en
+    segundo plano; si no, queda en el anillo del remito actual.
+    """
+    if not hasattr(_capturas, 'anillo'):
+        iniciar_capturas('general')
+    config = _capturas.config
+    try:
+        data = page.screenshot(type='jpeg', quality=config['calidad'])
+    except Exception as e:
+        print_with_time(f"Error tomando screenshot {nombre}: {e}")
+        return
+    if guardar or config['debug']:
+        _encolar_escritura(_nombre_captura(nombre), data)
+    else:
+        _capturas.anillo.append((_nombre_captura(nombre), data))
+
+def volcar_capturas() -> None:
+    """Escribe a disco (en segundo plano) las capturas del anillo actual y lo vacía"""
+    anillo = getattr(_capturas, 'anillo', None)
+    while anillo:
+        _encolar_escritura(*anillo.popleft())
+
+def get_state_dir() -> Path:
+    """
+    Directorio del estado interno de los flujos: sesión, caché de reportes,
+    spans (FINNEGANS_STATE_DIR, por defecto state/ en la raíz del proyecto).
+    No debe estar dentro de data/: la API sirve data/ en /data sin autenticación.
+    """
+    load_dotenv()
+    state_dir = os.getenv('FINNEGANS_STATE_DIR')
+    if state_dir:
+        return Path(state_dir)
+    return Path(__file__).resolve().parent.parent / "state"
+
+def sacar_de_data(nombre: str, destino: Path) -> None:
+    """
+    Mueve `data/<nombre>` (ubicación anterior, pública en /data) a `destino`.
+    Si `destino` ya existe, la copia vieja se borra.
+    """
+    anterior = Path(__file__).resolve().parent.parent / "data" / nombre
+    if not anterior.exists() or anterior.resolve() == Path(destino).resolve():
+        return
+    try:
+        if Path(destino).exists():
+            shutil.rmtree(anterior) if anterior.is_dir() else anterior.unlink()
+        else:
+            Path(destino).parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(anterior), str(destino))
+        print_with_time(f"data/{nombre} movido fuera del directorio público: {destino}")
+    except Exception as e:
+        print_with_time(f"No se pudo sacar data/{nombre} del directorio público: {e}")
+
 def get_video_path():
     """Obtener la ruta para guardar videos"""
     load_dotenv()            
@@ -0,0 +1,241 @@
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+from dotenv import load_dotenv
+
+# Cola de entregas de webhooks (notificaciones de jobs de Finnegans, eventos de
+# carga_padron_dgr.py). Cada notificación se guarda en la tabla
+# webhook_entregas y el entregador de la API la envía en segundo plano, con
+# reintentos y espera exponencial: quien notifica no queda bloqueado si n8n
+# está lento, y las entregas pendientes sobreviven a un reinicio. Si la base no
+# está disponible, dentro de la API se encolan en memoria. Un script suelto
+# (carga_padron_dgr.py) envía primero directo y encola solo si falla: lo
+# encolado se entrega cuando la API está corriendo con la misma base.
+
+
+def get_config() -> dict:
+    load_dotenv()
+
+    def entero(nombre: str, defecto: int) -> int:
+        try:
+            return int(os.getenv(nombre, str(defecto)))
+        except ValueError:
+            return defecto
+
+    return {
+        'max_intentos': max(1, entero('WEBHOOK_MAX_INTENTOS', 8)),
+        'backoff_s': max(1, entero('WEBHOOK_BACKOFF_S', 10)),
+        'backoff_max_s': max(1, entero('WEBHOOK_BACKOFF_MAX_S', 3600)),
+        'timeout_s': max(1, entero('WEBHOOK_TIMEOUT_S', 15)),
+        'workers': max(1, entero('WEBHOOK_WORKERS', 4)),
+        'gzip': os.getenv('WEBHOOK_GZIP', 'false').strip().lower() in ('1', 'true', 'si', 'yes'),
+        'retencion_dias': entero('WEBHOOK_RETENCION_DIAS', 30),
+    }
+
+
+def espera_reintento(intentos: int, config: dict) -> int:
+    """Segundos hasta el próximo intento después de `intentos` fallidos (exponencial con ±20%)"""
+    espera = min(config['backoff_s'] * 2 ** max(intentos - 1, 0), config['backoff_max_s'])
+    return int(espera * random.uniform(0.8, 1.2))
+
+
+def entregar(destino: str, payload: Dict[str, Any], comprimir: bool, timeout: int) -> Tuple[bool, Optional[int], Optional[str], float]:
+    """Un intento de entrega: (ok, status HTTP, error, duración ms). Con `comprimir` el cuerpo va en gzip."""
+    cuerpo = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if comprimir:
+        cuerpo = gzip.compress(cuerpo)
+        headers['Content-Encoding'] = 'gzip'
+    t0 = time.monotonic()
+    try:
+        response = requests.post(destino, data=cuerpo, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        return False, None, str(e), round((time.monotonic() - t0) * 1000, 1)
+    duracion = round((time.monotonic() - t0) * 1000, 1)
+    if 200 <= response.status_code < 300:
+        return True, response.status_code, None, duracion
+    return False, response.status_code, f"HTTP {response.status_code}: {response.text[:200]}", duracion
+
+
+def encolar_webhook(destino: str, payload: Dict[str, Any], origen: str, referencia: str = None,
+                    comprimir: Optional[bool] = None) -> bool:
+    """
+    Encola una notificación. Retorna False si no se pudo guardar ni encolar en
+    memoria (sin base y fuera de la API): quien llama decide si la envía directo.
+    """
+    if comprimir is None:
+        comprimir = get_config()['gzip']
+    try:
+        from db import insertar_webhook
+        insertar_webhook(origen, referencia, destino, payload, comprimir)
+    except Exception as e:
+        if _entregador is None:
+            print(f"[webhooks] No se pudo encolar el webhook de {origen} {referencia or ''} ({e})")
+            return False
+        print(f"[webhooks] Base no disponible ({e}), el webhook de {origen} {referencia or ''} se encola en memoria")
+        _entregador.encolar_en_memoria(origen, referencia, destino, payload, comprimir)
+        return True
+    if _entregador is not None:
+        _entregador.despertar()
+    return True
+
+
+class EntregadorWebhooks:
+    """
+    Hilo de la API que envía las entregas pendientes (de la tabla y las
+    encoladas en memoria) en paralelo. `oyentes[origen](entrega, intento)` se
+    llama después de cada intento (p.ej. para registrarlo en el job).
+    """
+
+    def __init__(self, oyentes: Dict[str, Callable[[dict, dict], None]] = None, intervalo: float = 5.0):
+        self.config = get_config()
+        self.oyentes = oyentes or {}
+        self.intervalo = intervalo
+        self.evento = threading.Event()
+        self.detener = threading.Event()
+        self.lock = threading.Lock()
+        self.en_memoria: List[dict] = []
+        self.base_ok = True
+        self.ejecutor = ThreadPoolExecutor(max_workers=self.config['workers'], thread_name_prefix="webhook")
+        self.hilo = None
+
+    def start(self):
+        try:
+            from db import purgar_webhooks
+            if self.config['retencion_dias'] > 0:
+                purgar_webhooks(self.config['retencion_dias'])
+        except Exception as e:
+            print(f"[webhooks] No se pudieron purgar las entregas viejas: {e}")
+        self.hilo = threading.Thread(target=self._loop, name="webhook-entregador", daemon=True)
+        self.hilo.start()
+
+    def stop(self):
+        self.detener.set()
+        self.evento.set()
+        self.ejecutor.shutdown(wait=False)
+
+    def despertar(self):
+        self.evento.set()
+
+    def encolar_en_memoria(self, origen: str, referencia: Optional[str], destino: str, payload: dict, comprimir: bool):
+        with self.lock:
+            self.en_memoria.append({
+                'id': None, 'origen': origen, 'referencia': referencia, 'destino': destino,
+                'payload': payload, 'comprimir': comprimir, 'intentos': 0, 'proximo': time.monotonic(),
+            })
+        self.evento.set()
+
+    def _pendientes(self) -> List[dict]:
+        entregas = []
+        try:
+            from db import tomar_webhooks_pendientes
+            entregas = tomar_webhooks_pendientes(self.config['workers'] * 2, self.config['timeout_s'] * 2 + 5)
+            if not self.base_ok:
+                print("[webhooks] Base disponible de nuevo")
+            self.base_ok = True
+        except Exception as e:
+            # Solo al cambiar de estado: no repetir el error en cada vuelta
+            if self.base_ok:
+                print(f"[webhooks] No se pudieron leer las entregas pendientes: {e}")
+            self.base_ok = False
+        ahora = time.monotonic()
+        with self.lock:
+            for entrega in self.en_memoria:
+                if entrega['proximo'] <= ahora:
+                    # Reservada mientras se intenta
+                    entrega['proximo'] = ahora + self.config['timeout_s'] * 2 + 5
+                    entregas.append(entrega)
+        return entregas
+
+    def _loop(self):
+        while not self.detener.is_set():
+            self.evento.wait(self.intervalo)
+            self.evento.clear()
+            if self.detener.is_set():
+                break
+            entregas = self._pendientes()
+            futuros = []
+            for entrega in entregas:
+                # stop() puede cerrar el ejecutor mientras se leían las pendientes
+                if self.detener.is_set():
+                    break
+                try:
+                    futuros.append(self.ejecutor.submit(self._intentar, entrega))
+                except RuntimeError:
+                    break
+            for futuro in futuros:
+                try:
+                    futuro.result()
+                except Exception as e:
+                    print(f"[webhooks] Error en una entrega: {e}")
+            if len(entregas) >= self.config['workers'] * 2:
+                # Puede haber más vencidas: no esperar el intervalo
+                self.evento.set()
+
+    def _intentar(self, entrega: dict):
+        ok, status, error, duracion = entregar(entrega['destino'], entrega['payload'], entrega['comprimir'], self.config['timeout_s'])
+        intentos = entrega['intentos'] + 1
+        if ok:
+            estado, reintentar_en = 'entregado', None
+        elif intentos >= self.config['max_intentos']:
+            estado, reintentar_en = 'fallido', None
+        else:
+            estado, reintentar_en = 'pendiente', espera_reintento(intentos, self.config)
+
+        if entrega['id'] is not None:
+            try:
+                from db import registrar_intento_webhook
+                registrar_intento_webhook(entrega['id'], estado, status, error, reintentar_en)
+            except Exception as e:
+                print(f"[webhooks] No se pudo registrar el intento {intentos} de la entrega {entrega['id']}: {e}")
+        else:
+            with self.lock:
+                entrega['intentos'] = intentos
+                if estado == 'pendiente':
+                    entrega['proximo'] = time.monotonic() + reintentar_en
+                elif entrega in self.en_memoria:
+                    self.en_memoria.remove(entrega)
+
+        print(f"[webhooks] {entrega['origen']} {entrega['referencia'] or ''} -> {entrega['destino']}: "
+              f"intento {intentos} {estado}{f' ({error})' if error else ''}")
+        oyente = self.oyentes.get(entrega['origen'])
+        if oyente:
+            try:
+                oyente(entrega, {
+                    'intento': intentos,
+                    'at': datetime.now().isoformat(),
+                    'estado': estado,
+                    'status': status,
+                    'error': error,
+                    'duracion_ms': duracion,
+                    'reintentar_en_segundos': reintentar_en,
+                })
+            except Exception as e:
+                print(f"[webhooks] Error registrando el intento de {entrega['referencia']}: {e}")
+
+
+_entregador: Optional[EntregadorWebhooks] = None
+
+
+def iniciar_entregador(oyentes: Dict[str, Callable[[dict, dict], None]] = None) -> EntregadorWebhooks:
+    """Inicia el entregador del proceso (la API); los scripts sueltos no lo inician"""
+    global _entregador
+    if _entregador is None:
+        _entregador = EntregadorWebhooks(oyentes)
+        _entregador.start()
+    return _entregador
+
+
+def detener_entregador():
+    global _entregador
+    if _entregador is not None:
+        _entregador.stop()
+        _entregador = None